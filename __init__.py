@@ -0,0 +1 @@
+default_app_config = 'django_irods.apps.DjangoIrodsConfig'
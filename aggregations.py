@@ -0,0 +1,109 @@
+"""Cached map from storage path to the aggregation of the files of a resource.
+
+views.download has to know whether a requested file belongs to a single file
+aggregation. Rather than scanning every ResourceFile of the resource on each
+download, the files of a resource are read once and grouped by folder:
+
+    {storage_path: (logical file type name, is single file aggregation)}
+
+holds the files of a folder that belong to an aggregation. Each folder's dict, and
+the set of folders having one, is kept under its own key in the Django cache named
+by IRODS_AGGREGATION_MAP_CACHE ('default') for IRODS_AGGREGATION_MAP_TTL seconds
+(3600), so that a resource with tens of thousands of files does not exceed the
+item size limit of the cache.
+
+Saving or deleting a ResourceFile, and saving or deleting a logical file, moves
+the resource to a new map version, so the next lookup rebuilds the map;
+DjangoIrodsConfig.ready() connects the receivers below to the model signals for
+this. A map built while the files change is stored under the old version and
+never read. Changes that bypass the model signals, such as queryset update(),
+are seen once the map expires.
+"""
+
+import posixpath
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+
+from hs_core.models import ResourceFile
+
+KEY_PREFIX = 'django_irods:aggregations:'
+
+
+def _cache():
+    from django.core.cache import caches
+    return caches[getattr(settings, 'IRODS_AGGREGATION_MAP_CACHE', 'default')]
+
+
+def _ttl():
+    return getattr(settings, 'IRODS_AGGREGATION_MAP_TTL', 3600)
+
+
+def _version(cache, resource_id):
+    key = '{}version:{}'.format(KEY_PREFIX, resource_id)
+    version = cache.get(key)
+    if version is None:
+        # a version set concurrently by add() or invalidate() wins
+        cache.add(key, uuid4().hex, _ttl())
+        version = cache.get(key)
+    return version
+
+
+def _build(resource_id):
+    aggregations = {}
+    for f in ResourceFile.objects.filter(object_id=resource_id):
+        if f.has_logical_file:
+            logical_file = f.logical_file
+            aggregations[f.storage_path] = (type(logical_file).__name__,
+                                            bool(logical_file.is_single_file_aggregation))
+    return aggregations
+
+
+def folder_aggregations(resource_id, folder):
+    """Returns the dict of storage path -> (logical file type name, is single file
+    aggregation) of the files in folder of the resource that belong to an aggregation.
+    """
+    cache = _cache()
+    prefix = '{}map:{}:{}:'.format(KEY_PREFIX, resource_id, _version(cache, resource_id))
+
+    def key(folder):
+        return prefix + md5(folder.encode('utf-8')).hexdigest()
+
+    # the folders holding aggregations are kept too, so that the other folders need no
+    # key of their own
+    found = cache.get_many([prefix + 'folders', key(folder)])
+    if key(folder) in found:
+        return found[key(folder)]
+    if prefix + 'folders' in found and folder not in found[prefix + 'folders']:
+        return {}
+    folders = {}
+    for path, aggregation in _build(resource_id).items():
+        folders.setdefault(posixpath.dirname(path), {})[path] = aggregation
+    values = dict((key(f), entries) for f, entries in folders.items())
+    values[prefix + 'folders'] = set(folders)
+    cache.set_many(values, _ttl())
+    return folders.get(folder, {})
+
+
+def is_single_file_aggregation(resource_id, storage_path):
+    return folder_aggregations(resource_id, posixpath.dirname(storage_path)).get(
+        storage_path, (None, False))[1]
+
+
+def invalidate(resource_id):
+    _cache().set('{}version:{}'.format(KEY_PREFIX, resource_id), uuid4().hex, _ttl())
+
+
+def resource_file_changed(sender, instance, **kwargs):
+    invalidate(instance.object_id)
+
+
+def logical_file_changed(sender, instance, **kwargs):
+    resource_id = getattr(instance, 'resource_id', None)
+    if resource_id is None:
+        # logical files without a resource field reach it through their files
+        resource_file = instance.files.first()
+        resource_id = resource_file.object_id if resource_file is not None else None
+    if resource_id is not None:
+        invalidate(resource_id)
@@ -0,0 +1,287 @@
+"""asyncio variant of icommands.Session.
+
+AsyncSession runs icommands for an existing Session on an event loop through
+asyncio subprocess support, so one loop can keep many iRODS operations in
+flight. Coroutines are written in the trollius style (yield From(...)) so the
+module works on the Python 2 interpreters this app is deployed on; the trollius
+package is required.
+
+    asession = AsyncSession(GLOBAL_SESSION, max_concurrency=32)
+    stdout, stderr = loop.run_until_complete(asession.run('ils', None, path))
+
+Cancelling a pending coroutine kills the icommand it started, along with any
+processes it started, as SubprocessBackend does.
+
+Like Session, commands are recorded in the metrics, make the session busy for
+the session pool, and are bounded by the timeout given to the call, else the
+session's default_timeout, and the deadline current when the coroutine is
+created. Unlike Session, AsyncSession always runs the icommand binaries, whatever
+the session's backend, and neither retries failed commands nor re-runs iinit when
+the authentication expired.
+"""
+
+import os
+import signal
+import time
+from collections import deque
+
+import trollius as asyncio
+from django.conf import settings
+from trollius import From, Return
+from trollius.subprocess import PIPE
+
+from django_irods.backends import SubprocessBackend
+from django_irods.icommands import (SessionException, SessionTimeoutException,
+                                    BatchException, CommandResult, COLLECT_ALL, FAIL_FAST,
+                                    STREAM_CHUNK_SIZE, STDERR_LIMIT, TIMEOUT_EXITCODE)
+
+
+def _kill(proc):
+    if proc.returncode is None:
+        try:
+            # the child leads its own process group, see _start
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass  # already gone
+
+
+def _remaining(expires):
+    """Returns the seconds left until expires, or None if there is no limit; raises
+    SessionTimeoutException once it passed.
+    """
+    if expires is None:
+        return None
+    remaining = expires - time.time()
+    if remaining <= 0:
+        raise SessionTimeoutException(0)
+    return remaining
+
+
+class AsyncCommandStream(object):
+    """Async counterpart of icommands.CommandStream.
+
+    Call the coroutine read() until it returns '' (which checks the exit code and may
+    raise SessionException) or close() to stop early and kill the child. The child is
+    killed once timeout seconds have passed, and read() then raises
+    SessionTimeoutException.
+    """
+    def __init__(self, proc, semaphore, chunk_size=STREAM_CHUNK_SIZE,
+                 stderr_limit=STDERR_LIMIT, loop=None, on_finish=None, timeout=None):
+        self.proc = proc
+        self.chunk_size = chunk_size
+        self.stderr_limit = stderr_limit
+        self.finished = False
+        self.on_finish = on_finish  # called with (exitcode, stdout bytes, stderr bytes)
+        self.bytes_read = 0
+        self.timeout = timeout
+        self.timed_out = False
+        self._semaphore = semaphore
+        self._stderr = deque()
+        self._stderr_size = 0
+        self._drain = asyncio.ensure_future(self._drain_stderr(), loop=loop)
+        self._timer = None
+        if timeout is not None:
+            self._timer = (loop or asyncio.get_event_loop()).call_later(timeout, self._expire)
+
+    def _expire(self):
+        self.timed_out = True
+        _kill(self.proc)
+
+    @asyncio.coroutine
+    def _drain_stderr(self):
+        while True:
+            chunk = yield From(self.proc.stderr.read(4096))
+            if not chunk:
+                break
+            self._stderr.append(chunk)
+            self._stderr_size += len(chunk)
+            while self._stderr_size - len(self._stderr[0]) >= self.stderr_limit:
+                self._stderr_size -= len(self._stderr.popleft())
+
+    @property
+    def stderr(self):
+        return ''.join(self._stderr)[-self.stderr_limit:]
+
+    @asyncio.coroutine
+    def read(self):
+        if self.finished:
+            raise Return('')
+        try:
+            chunk = yield From(self.proc.stdout.read(self.chunk_size))
+            if chunk:
+                self.bytes_read += len(chunk)
+                raise Return(chunk)
+            returncode = yield From(self.proc.wait())
+            yield From(self._drain)
+        except asyncio.CancelledError:
+            self.close()
+            raise
+        self._release(returncode)
+        if self.timed_out:
+            raise SessionTimeoutException(self.timeout, '', self.stderr)
+        if returncode:
+            raise SessionException(returncode, '', self.stderr)
+        raise Return('')
+
+    def _release(self, returncode):
+        if not self.finished:
+            self.finished = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._semaphore.release()
+            if self.on_finish is not None:
+                self.on_finish(TIMEOUT_EXITCODE if self.timed_out else returncode,
+                               self.bytes_read, self._stderr_size)
+
+    def close(self):
+        if not self.finished:
+            _kill(self.proc)
+            self._drain.cancel()
+        self._release(-signal.SIGKILL)
+
+
+class AsyncSession(object):
+    """Runs icommands for session on an asyncio event loop.
+
+    At most max_concurrency icommands (IRODS_ASYNC_MAX_CONCURRENCY, default 16) run
+    at once for this AsyncSession; further calls wait for a free slot.
+    """
+    def __init__(self, session, max_concurrency=None, loop=None):
+        self.session = session
+        self.loop = loop or asyncio.get_event_loop()
+        if max_concurrency is None:
+            max_concurrency = getattr(settings, 'IRODS_ASYNC_MAX_CONCURRENCY', 16)
+        self._semaphore = asyncio.Semaphore(max_concurrency, loop=self.loop)
+        self._environ = SubprocessBackend().environ(session)
+
+    @asyncio.coroutine
+    def _start(self, icommand, args, stdin=None):
+        argList = [os.path.join(self.session.icommands_path, icommand)]
+        argList.extend(args)
+        # in a process group of its own, so that _kill reaches what the icommand starts
+        proc = yield From(asyncio.create_subprocess_exec(
+            *argList, stdin=stdin, stdout=PIPE, stderr=PIPE, env=self._environ,
+            preexec_fn=os.setsid, loop=self.loop))
+        raise Return(proc)
+
+    @asyncio.coroutine
+    def _execute(self, icommand, args, data=None, expires=None):
+        uargs = [x.encode('utf-8') for x in args]
+        with (yield From(self._semaphore)):
+            timeout = _remaining(expires)
+            finish = self.session._observe(icommand, uargs)
+            try:
+                proc = yield From(self._start(icommand, uargs, stdin=PIPE if data else None))
+            except BaseException:
+                finish(1)
+                raise
+            try:
+                stdout, stderr = yield From(asyncio.wait_for(proc.communicate(input=data),
+                                                             timeout, loop=self.loop))
+            except asyncio.TimeoutError:
+                _kill(proc)
+                yield From(proc.wait())
+                finish(TIMEOUT_EXITCODE)
+                raise SessionTimeoutException(timeout)
+            except asyncio.CancelledError:
+                _kill(proc)
+                finish(-signal.SIGKILL)
+                raise
+        finish(proc.returncode, len(stdout or ''), len(stderr or ''))
+        raise Return((proc.returncode, stdout, stderr))
+
+    @asyncio.coroutine
+    def run(self, icommand, data=None, *args, **kwargs):
+        """Coroutine returning tuple (stdout, stderr) of an icommand; raises
+        SessionException on a non-zero exit code like Session.run, and
+        SessionTimeoutException once the optional keyword argument timeout, else the
+        session default_timeout, or the deadline expires.
+        """
+        returncode, stdout, stderr = yield From(self._execute(
+            icommand, args, data=data, expires=self.session._expires(kwargs.get('timeout'))))
+        if returncode:
+            raise SessionException(returncode, stdout, stderr)
+        raise Return((stdout, stderr))
+
+    @asyncio.coroutine
+    def stream(self, icommand, *args, **kwargs):
+        """Coroutine returning an AsyncCommandStream over the stdout of an icommand.
+
+        The concurrency slot is held until the stream is exhausted or closed. The
+        optional keyword argument timeout bounds the whole transfer as for run().
+        """
+        expires = self.session._expires(kwargs.pop('timeout', None))
+        uargs = [x.encode('utf-8') for x in args]
+        yield From(self._semaphore.acquire())
+        try:
+            timeout = _remaining(expires)
+            finish = self.session._observe(icommand, uargs)
+            try:
+                proc = yield From(self._start(icommand, uargs))
+            except BaseException:
+                finish(1)
+                raise
+        except BaseException:
+            self._semaphore.release()
+            raise
+        raise Return(AsyncCommandStream(proc, self._semaphore, loop=self.loop,
+                                        on_finish=finish, timeout=timeout, **kwargs))
+
+    def iget(self, path, **kwargs):
+        """Coroutine returning an AsyncCommandStream over the contents of data object path.
+        """
+        return self.stream('iget', path, '-', **kwargs)
+
+    @asyncio.coroutine
+    def runbatch(self, icommands, mode=COLLECT_ALL, timeout=None):
+        """Coroutine running (icommand, args) pairs concurrently, bounded by the session
+        concurrency cap, and returning CommandResult in input order.
+
+        Raises BatchException like Session.run_many; in FAIL_FAST mode the commands
+        still running when the first one fails are cancelled and killed. timeout bounds
+        the batch as a whole; commands killed when it expires are reported with exit
+        code TIMEOUT_EXITCODE.
+        """
+        expires = self.session._expires(timeout)
+
+        @asyncio.coroutine
+        def execute(icommand, args):
+            start = time.time()
+            try:
+                returncode, stdout, stderr = yield From(self._execute(icommand, args,
+                                                                      expires=expires))
+            except SessionTimeoutException as ex:
+                returncode, stdout, stderr = ex.exitcode, ex.stdout, ex.stderr
+            raise Return(CommandResult(icommand, list(args), returncode, stdout, stderr,
+                                       time.time() - start))
+
+        tasks = [asyncio.ensure_future(execute(icommand, args), loop=self.loop)
+                 for icommand, args in icommands]
+        if not tasks:
+            raise Return([])
+        if mode == FAIL_FAST:
+            pending = set(tasks)
+            while pending:
+                done, pending = yield From(asyncio.wait(
+                    pending, loop=self.loop, return_when=asyncio.FIRST_COMPLETED))
+                if any(t.exception() is None and t.result().exitcode for t in done):
+                    for t in pending:
+                        t.cancel()
+                    if pending:
+                        # lets the cancelled commands kill their processes
+                        yield From(asyncio.wait(pending, loop=self.loop))
+                    break
+        else:
+            yield From(asyncio.wait(tasks, loop=self.loop))
+
+        results = []
+        for t in tasks:
+            if t.cancelled() or not t.done():
+                results.append(None)
+            elif t.exception() is not None:
+                raise t.exception()
+            else:
+                results.append(t.result())
+        if any(r is not None and r.exitcode for r in results):
+            raise BatchException(results)
+        raise Return(results)
@@ -0,0 +1,30 @@
+from django.apps import AppConfig, apps
+from django.db.models.signals import post_delete, post_save, pre_delete
+
+
+class DjangoIrodsConfig(AppConfig):
+    name = 'django_irods'
+
+    def ready(self):
+        from django_irods import aggregations
+
+        # keeps the cached aggregation maps of resources current
+        post_save.connect(aggregations.resource_file_changed,
+                          sender=aggregations.ResourceFile,
+                          dispatch_uid='django_irods.aggregations.saved')
+        post_delete.connect(aggregations.resource_file_changed,
+                            sender=aggregations.ResourceFile,
+                            dispatch_uid='django_irods.aggregations.deleted')
+        try:
+            from hs_file_types.models.base import AbstractLogicalFile
+        except ImportError:
+            return
+        for model in apps.get_models():
+            if issubclass(model, AbstractLogicalFile):
+                uid = 'django_irods.aggregations.{}.{}'.format(model._meta.app_label,
+                                                               model._meta.model_name)
+                post_save.connect(aggregations.logical_file_changed, sender=model,
+                                  dispatch_uid=uid + '.saved')
+                # before the delete, while the files still lead to the resource
+                pre_delete.connect(aggregations.logical_file_changed, sender=model,
+                                   dispatch_uid=uid + '.deleted')
@@ -0,0 +1,647 @@
+"""Execution backends for icommands.Session.
+
+A backend decides how an icommand is actually carried out on behalf of a
+Session. The default SubprocessBackend forks the icommand binary exactly as
+Session always has. ClientBackend keeps a pool of authenticated iRODS protocol
+connections per session (through python-irodsclient) and serves the commonly
+used icommands natively, falling back to the binaries for everything else.
+
+The backend used by new sessions is selected with the IRODS_SESSION_BACKEND
+setting, e.g. 'django_irods.backends.ClientBackend'.
+"""
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    from irods.session import iRODSSession
+    from irods.exception import (CollectionDoesNotExist, DataObjectDoesNotExist,
+                                 iRODSException)
+    from irods.meta import iRODSMeta
+    import irods.keywords as kw
+except ImportError:
+    iRODSSession = None
+
+DEFAULT_BACKEND = 'django_irods.backends.SubprocessBackend'
+
+# exit code reported for commands served natively that fail
+ERROR_EXITCODE = 3
+
+# socket timeout in seconds of protocol connections when no command timeout is given
+NATIVE_CONNECTION_TIMEOUT = 120
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(path=None):
+    """Returns the shared backend instance named by path or IRODS_SESSION_BACKEND.
+    """
+    path = path or getattr(settings, 'IRODS_SESSION_BACKEND', DEFAULT_BACKEND)
+    with _backends_lock:
+        if path not in _backends:
+            _backends[path] = import_string(path)()
+        return _backends[path]
+
+
+class CommandTimeout(Exception):
+    """Raised by a backend when a command was killed because its timeout expired.
+    """
+    def __init__(self, timeout, stdout='', stderr=''):
+        super(CommandTimeout, self).__init__(timeout)
+        self.timeout = timeout
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class ExecutionBackend(object):
+    """Interface every Session execution backend implements.
+    """
+
+    # whether popen_at() starts reading at an offset rather than returning None
+    seekable = False
+
+    def execute(self, session, icommand, args, data=None, timeout=None):
+        """Runs icommand with args for session, feeding data to its stdin if given.
+
+        Returns tuple (returncode, stdout, stderr); never raises for a failed command.
+        If the command is still running after timeout seconds it is killed and
+        CommandTimeout raised.
+        """
+        raise NotImplementedError
+
+    def popen(self, session, icommand, args, data=None):
+        """Starts icommand and returns a Popen-like object whose stdout can be read
+        incrementally.
+        """
+        raise NotImplementedError
+
+    def popen_at(self, session, path, offset):
+        """Starts reading data object path from byte offset on and returns a Popen-like
+        object as popen does, or None if the backend cannot start at an offset.
+        """
+        return None
+
+    def open_write(self, session, path):
+        """Returns a file object that replaces data object path with what is written to
+        it, or None if the backend cannot stream uploads.
+        """
+        return None
+
+    def kill(self, proc):
+        """Kills a process returned by popen, including any child it started.
+        """
+        proc.kill()
+
+    def close(self, session):
+        """Releases any resource held on behalf of session.
+        """
+        pass
+
+
+class SubprocessBackend(ExecutionBackend):
+    """Runs every icommand by forking the icommand binary.
+
+    Each icommand gets its own process group so that a timeout kills it along
+    with anything it spawned.
+    """
+
+    def environ(self, session):
+        myenv = os.environ.copy()
+        myenv['IRODS_ENVIRONMENT_FILE'] = os.path.join(session.session_path,
+                                                       "irods_environment.json")
+        myenv['IRODS_AUTHENTICATION_FILE'] = os.path.join(session.session_path, ".irodsA")
+        return myenv
+
+    def start(self, session, icommand, args, stdin=None):
+        argList = [os.path.join(session.icommands_path, icommand)]
+        argList.extend(args)
+
+        return subprocess.Popen(
+            argList,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self.environ(session),
+            preexec_fn=os.setsid
+        )
+
+    def kill(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass  # already gone
+
+    def popen(self, session, icommand, args, data=None):
+        proc = self.start(session, icommand, args,
+                          stdin=subprocess.PIPE if data else None)
+        if data:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        return proc
+
+    def execute(self, session, icommand, args, data=None, timeout=None):
+        proc = self.start(session, icommand, args,
+                          stdin=subprocess.PIPE if data else None)
+        timer = None
+        killed = []
+        if timeout is not None:
+            def expire():
+                killed.append(True)
+                self.kill(proc)
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            stdout, stderr = proc.communicate(input=data) if data else proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if killed:
+            raise CommandTimeout(timeout, stdout, stderr)
+        return proc.returncode, stdout, stderr
+
+
+class NativeProcess(object):
+    """Popen-like wrapper around a data object opened through a protocol connection.
+    """
+
+    def __init__(self, stdout):
+        self.stdin = None
+        self.stdout = stdout
+        self.stderr = StringIO()
+        self.pid = None
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = 0
+        return self.returncode
+
+    def communicate(self, input=None):
+        stdout = self.stdout.read()
+        self.stdout.close()
+        return stdout, ''
+
+    def kill(self):
+        if self.returncode is None:
+            self.stdout.close()
+            self.returncode = -9
+
+    terminate = kill
+
+
+class NativeCommandError(Exception):
+    pass
+
+
+class UnsupportedCommand(Exception):
+    """Raised by a native handler to hand the command over to the fallback backend.
+    """
+    pass
+
+
+def _parse_args(args, valued=()):
+    """Splits icommand arguments into (flags, options, positionals).
+
+    Single-letter flags may be combined ('-rf'); the letters listed in valued take
+    the following argument as their value.
+    """
+    flags = set()
+    options = {}
+    positionals = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('-') and len(arg) > 1:
+            for i, letter in enumerate(arg[1:]):
+                if letter in valued:
+                    value = arg[i + 2:] or (args.pop(0) if args else '')
+                    options[letter] = value
+                    break
+                flags.add(letter)
+        else:
+            positionals.append(arg)
+    return flags, options, positionals
+
+
+class ClientBackend(ExecutionBackend):
+    """Serves ils/imeta/iget/iput/imkdir/irm/imv/icp over pooled protocol connections.
+
+    One authenticated iRODSSession is kept per Session (keyed by its session path);
+    python-irodsclient pools the underlying connections. The connection settings are
+    read from the session's irods_environment.json and the password is taken from
+    the session's iinit call, so the backend can equally be pointed at a local
+    stand-in server. Anything not handled natively goes to the fallback backend.
+
+    The socket timeout is a setting of the iRODSSession, which threads share, so a
+    command run with a timeout takes a spare iRODSSession of its own for the call, at
+    most IRODS_CLIENT_MAX_CONNECTIONS (8) per session at a time. A watchdog closes
+    that iRODSSession when the timeout expires, and the command then raises
+    CommandTimeout, as the icommand killed by SubprocessBackend does.
+    """
+
+    native_commands = ('iinit', 'iexit', 'ils', 'imeta', 'iget', 'iput', 'imkdir', 'irm',
+                       'imv', 'icp')
+    seekable = True
+
+    def __init__(self, fallback=None):
+        if iRODSSession is None:
+            raise ImproperlyConfigured("python-irodsclient is required to use the "
+                                       "django_irods ClientBackend")
+        self.fallback = fallback or SubprocessBackend()
+        self._connections = {}
+        self._spare = {}  # session path -> idle iRODSSessions for commands with a timeout
+        self._in_use = {}  # session path -> the iRODSSessions taken from the spare ones
+        self._local = threading.local()  # the iRODSSession of the running command
+        self._passwords = {}
+        self._fallback_authenticated = set()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    def connection(self, session):
+        """Returns the pooled iRODSSession for session, opening it on first use, or the
+        one the command running in this thread took for itself.
+        """
+        key = session.session_path
+        current = getattr(self._local, 'connection', None)
+        if current is not None and current[0] == key:
+            return current[1]
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is None:
+                conn = self._open(session)
+                conn.connection_timeout = NATIVE_CONNECTION_TIMEOUT
+                self._connections[key] = conn
+            return conn
+
+    def _open(self, session):
+        # called with self._lock held
+        key = session.session_path
+        if key not in self._passwords:
+            raise NativeCommandError("CAT_INVALID_AUTHENTICATION: iinit has not "
+                                     "been run for this session")
+        env = self.environment(session)
+        return iRODSSession(host=env['irods_host'], port=env['irods_port'],
+                            user=env['irods_user_name'], zone=env['irods_zone_name'],
+                            password=self._passwords[key])
+
+    def _checkout(self, session, timeout):
+        """Returns an iRODSSession for session used by no other thread, with each network
+        wait bounded by timeout. Raises CommandTimeout if none becomes available within
+        timeout seconds.
+        """
+        key = session.session_path
+        limit = getattr(settings, 'IRODS_CLIENT_MAX_CONNECTIONS', 8)
+        expires = time.time() + timeout
+        with self._available:
+            while True:
+                spare = self._spare.get(key)
+                in_use = self._in_use.setdefault(key, set())
+                if spare:
+                    conn = spare.pop()
+                    break
+                if len(in_use) < limit:
+                    conn = self._open(session)
+                    break
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    raise CommandTimeout(timeout)
+                self._available.wait(remaining)
+            in_use.add(conn)
+        conn.connection_timeout = max(timeout, 1)
+        return conn
+
+    def _checkin(self, session, conn, broken=False):
+        key = session.session_path
+        with self._available:
+            in_use = self._in_use.get(key, set())
+            if conn in in_use:
+                in_use.discard(conn)
+                self._available.notify()
+                if not broken:
+                    self._spare.setdefault(key, []).append(conn)
+                    return
+        conn.cleanup()  # closed by the watchdog, or the session was closed meanwhile
+
+    def _execute_timed(self, session, handler, args, timeout):
+        """Runs the native handler on an iRODSSession of its own, which a watchdog closes
+        once timeout seconds have passed; raises CommandTimeout then.
+        """
+        conn = self._checkout(session, timeout)
+        expired = []
+
+        def expire():
+            expired.append(True)
+            conn.cleanup()  # breaks off the network wait in progress
+
+        watchdog = threading.Timer(timeout, expire)
+        watchdog.daemon = True
+        watchdog.start()
+        self._local.connection = (session.session_path, conn)
+        try:
+            stdout = handler(session, args) or ''
+        except Exception:
+            if expired:
+                raise CommandTimeout(timeout)
+            raise
+        finally:
+            watchdog.cancel()
+            self._local.connection = None
+            self._checkin(session, conn, broken=bool(expired))
+        if expired:
+            raise CommandTimeout(timeout)
+        return stdout
+
+    def environment(self, session):
+        env_path = os.path.join(session.session_path, "irods_environment.json")
+        with open(env_path) as env_file:
+            return json.load(env_file)
+
+    def abspath(self, session, path):
+        if path.startswith('/'):
+            return path.rstrip('/') or '/'
+        return os.path.join(self.environment(session)['irods_cwd'], path).rstrip('/')
+
+    def close(self, session):
+        key = session.session_path
+        with self._lock:
+            conns = [self._connections.pop(key, None)] + self._spare.pop(key, [])
+            self._in_use.pop(key, None)  # cleaned up when they are checked in
+            self._passwords.pop(key, None)
+            self._fallback_authenticated.discard(key)
+            self._available.notify_all()
+        for conn in conns:
+            if conn is not None:
+                conn.cleanup()
+
+    def _ensure_fallback_auth(self, session):
+        key = session.session_path
+        if key in self._fallback_authenticated or key not in self._passwords:
+            return
+        returncode, stdout, stderr = self.fallback.execute(session, 'iinit',
+                                                           [self._passwords[key]])
+        if not returncode:
+            self._fallback_authenticated.add(key)
+
+    def popen(self, session, icommand, args, data=None):
+        if icommand == 'iget' and not data:
+            flags, options, positionals = _parse_args(args, valued='nNRX')
+            if len(positionals) == 2 and positionals[1] == '-' and not options:
+                try:
+                    conn = self.connection(session)
+                    obj = conn.data_objects.get(self.abspath(session, positionals[0]))
+                    return NativeProcess(obj.open('r'))
+                except (NativeCommandError, iRODSException):
+                    # let the icommand report the failure through its exit code
+                    pass
+        self._ensure_fallback_auth(session)
+        return self.fallback.popen(session, icommand, args, data=data)
+
+    def popen_at(self, session, path, offset):
+        try:
+            conn = self.connection(session)
+            obj = conn.data_objects.get(self.abspath(session, path)).open('r')
+        except (NativeCommandError, iRODSException):
+            return None  # reading from the start reports the failure
+        obj.seek(offset)
+        return NativeProcess(obj)
+
+    def open_write(self, session, path):
+        try:
+            conn = self.connection(session)
+            return conn.data_objects.open(self.abspath(session, path), 'w')
+        except (NativeCommandError, iRODSException):
+            return None  # iput from a local copy reports the failure
+
+    def kill(self, proc):
+        if isinstance(proc, NativeProcess):
+            proc.kill()
+        else:
+            self.fallback.kill(proc)
+
+    def execute(self, session, icommand, args, data=None, timeout=None):
+        handler = getattr(self, '_' + icommand, None)
+        if icommand in self.native_commands and handler is not None and not data:
+            try:
+                if timeout is None or icommand in ('iinit', 'iexit'):
+                    return 0, handler(session, list(args)) or '', ''
+                return 0, self._execute_timed(session, handler, list(args), timeout), ''
+            except UnsupportedCommand:
+                pass
+            except (NativeCommandError, iRODSException, IOError, OSError) as ex:
+                stderr = "ERROR: {icommand}: {name}: {msg}".format(
+                    icommand=icommand, name=type(ex).__name__, msg=ex)
+                return ERROR_EXITCODE, '', stderr
+        self._ensure_fallback_auth(session)
+        return self.fallback.execute(session, icommand, args, data=data, timeout=timeout)
+
+    # native command handlers. Each returns the stdout the icommand would have printed.
+
+    def _iinit(self, session, args):
+        key = session.session_path
+        self.close(session)
+        with self._lock:
+            self._passwords[key] = args[0] if args else ''
+        # connect and authenticate now so a bad password fails here, as with iinit
+        self.connection(session).server_version
+
+    def _iexit(self, session, args):
+        self.close(session)
+
+    def _is_collection(self, conn, path):
+        try:
+            conn.collections.get(path)
+            return True
+        except CollectionDoesNotExist:
+            return False
+
+    def _ils_line(self, obj, name, long_format):
+        if not long_format:
+            return "  {name}\n".format(name=name)
+        return "  {owner:<16} {repl:>2} {resc:<16} {size:>12} {date} & {name}\n".format(
+            owner=obj.owner_name, repl=obj.replica_number, resc=obj.resource_name,
+            size=obj.size, date=obj.modify_time.strftime('%Y-%m-%d.%H:%M'), name=name)
+
+    def _ils(self, session, args):
+        flags, options, positionals = _parse_args(args)
+        if flags - set('l') or len(positionals) > 1:
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        path = self.abspath(session, positionals[0] if positionals else '.')
+        long_format = 'l' in flags
+        if self._is_collection(conn, path):
+            coll = conn.collections.get(path)
+            lines = ["{path}:\n".format(path=path)]
+            for obj in coll.data_objects:
+                lines.append(self._ils_line(obj, obj.name, long_format))
+            for sub in coll.subcollections:
+                lines.append("  C- {path}\n".format(path=sub.path))
+            return ''.join(lines)
+        try:
+            obj = conn.data_objects.get(path)
+        except DataObjectDoesNotExist:
+            raise NativeCommandError("USER_FILE_DOES_NOT_EXIST: srcPath {path} does not "
+                                     "exist or user lacks access permission".format(path=path))
+        return self._ils_line(obj, obj.name if long_format else path, long_format)
+
+    def _imeta(self, session, args):
+        if len(args) < 3 or args[0] not in ('ls', 'set', 'add', 'rm') or \
+           args[1] not in ('-C', '-d'):
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        path = self.abspath(session, args[2])
+        if args[1] == '-C':
+            target, kind = conn.collections.get(path), 'collection'
+        else:
+            target, kind = conn.data_objects.get(path), 'dataObj'
+
+        if args[0] == 'ls':
+            avus = target.metadata.get_all(args[3]) if len(args) > 3 else target.metadata.items()
+            lines = ["AVUs defined for {kind} {name}:\n".format(kind=kind, name=args[2])]
+            if not avus:
+                lines.append("None\n")
+            for i, avu in enumerate(avus):
+                if i:
+                    lines.append("----\n")
+                lines.append("attribute: {name}\nvalue: {value}\nunits: {units}\n".format(
+                    name=avu.name, value=avu.value, units=avu.units or ''))
+            return ''.join(lines)
+
+        if len(args) < 5 and args[0] != 'rm':
+            raise NativeCommandError("imeta {cmd}: not enough arguments".format(cmd=args[0]))
+        meta = iRODSMeta(args[3], args[4] if len(args) > 4 else '',
+                         args[5] if len(args) > 5 else None)
+        if args[0] == 'set':
+            for avu in target.metadata.get_all(meta.name):
+                target.metadata.remove(avu)
+            target.metadata.add(meta)
+        elif args[0] == 'add':
+            target.metadata.add(meta)
+        else:
+            for avu in target.metadata.get_all(meta.name):
+                if len(args) < 5 or avu.value == meta.value:
+                    target.metadata.remove(avu)
+
+    def _iget(self, session, args):
+        flags, options, positionals = _parse_args(args, valued='nNRX')
+        if flags - set('f') or options or len(positionals) < 2:
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        sources, dest = positionals[:-1], positionals[-1]
+        if dest == '-':
+            out = []
+            for src in sources:
+                with conn.data_objects.get(self.abspath(session, src)).open('r') as f:
+                    out.append(f.read())
+            return ''.join(out)
+        for src in sources:
+            src = self.abspath(session, src)
+            local = os.path.join(dest, os.path.basename(src)) if os.path.isdir(dest) else dest
+            if os.path.exists(local) and 'f' not in flags:
+                raise NativeCommandError("OVERWRITE_WITHOUT_FORCE_FLAG: {path}".format(
+                    path=local))
+            with conn.data_objects.get(src).open('r') as f, open(local, 'wb') as out:
+                shutil.copyfileobj(f, out)
+
+    def _iput(self, session, args):
+        flags, options, positionals = _parse_args(args, valued='DNnpRX')
+        if flags - set('f') or set(options) - set('DR') or len(positionals) != 2:
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        src, dest = positionals[0], self.abspath(session, positionals[1])
+        put_options = {}
+        if 'f' in flags:
+            put_options[kw.FORCE_FLAG_KW] = ''
+        if 'D' in options:
+            put_options[kw.DATA_TYPE_KW] = options['D']
+        if 'R' in options:
+            put_options[kw.DEST_RESC_NAME_KW] = options['R']
+        if self._is_collection(conn, dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        elif 'f' not in flags and conn.data_objects.exists(dest):
+            raise NativeCommandError("OVERWRITE_WITHOUT_FORCE_FLAG: {path}".format(path=dest))
+        conn.data_objects.put(src, dest, **put_options)
+
+    def _imkdir(self, session, args):
+        flags, options, positionals = _parse_args(args)
+        if flags - set('p') or not positionals:
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        for path in positionals:
+            path = self.abspath(session, path)
+            missing = []
+            while path and path != '/' and not self._is_collection(conn, path):
+                missing.append(path)
+                if 'p' not in flags:
+                    break
+                path = path.rsplit('/', 1)[0]
+            for path in reversed(missing):
+                conn.collections.create(path)
+
+    def _irm(self, session, args):
+        flags, options, positionals = _parse_args(args)
+        if flags - set('rf') or not positionals:
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        for path in positionals:
+            path = self.abspath(session, path)
+            if self._is_collection(conn, path):
+                if 'r' not in flags:
+                    raise NativeCommandError("CANT_RM_NON_EMPTY_COLL: {path}".format(path=path))
+                conn.collections.remove(path, recurse=True, force='f' in flags)
+            else:
+                conn.data_objects.unlink(path, force='f' in flags)
+
+    def _imv(self, session, args):
+        flags, options, positionals = _parse_args(args)
+        if flags or len(positionals) < 2:
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        dest = self.abspath(session, positionals[-1])
+        for src in positionals[:-1]:
+            src = self.abspath(session, src)
+            if self._is_collection(conn, src):
+                conn.collections.move(src, dest)
+            else:
+                conn.data_objects.move(src, dest)
+
+    def _icp(self, session, args):
+        flags, options, positionals = _parse_args(args, valued='NnRX')
+        if flags - set('rf') or set(options) - set('R') or len(positionals) != 2:
+            raise UnsupportedCommand()
+        conn = self.connection(session)
+        copy_options = {}
+        if 'f' in flags:
+            copy_options[kw.FORCE_FLAG_KW] = ''
+        if 'R' in options:
+            copy_options[kw.DEST_RESC_NAME_KW] = options['R']
+        src = self.abspath(session, positionals[0])
+        dest = self.abspath(session, positionals[1])
+        if self._is_collection(conn, dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        if not self._is_collection(conn, src):
+            conn.data_objects.copy(src, dest, **copy_options)
+            return
+        if 'r' not in flags:
+            raise NativeCommandError("USER_INPUT_OPTION_ERR: collection copy needs -r")
+        for coll, subcollections, data_objects in conn.collections.get(src).walk():
+            target = dest + coll.path[len(src):]
+            if not self._is_collection(conn, target):
+                conn.collections.create(target)
+            for obj in data_objects:
+                conn.data_objects.copy(obj.path, os.path.join(target, obj.name),
+                                       **copy_options)
@@ -0,0 +1,355 @@
+"""Write batches for IrodsStorage.
+
+    with istorage.batch() as batch:
+        batch.moveFile(src, dest)
+        batch.saveFile(local, name)
+        batch.setAVU(coll, 'bag_modified', 'true')
+
+records the operations and carries them out when the block exits, using as few
+icommands as possible. Runs of consecutive operations of the same kind are
+merged, and the order between runs is kept:
+
+- collections needed by saveFile, copyFiles and moveFile, and those asked for with
+  mkdir, are created with one imkdir -p, skipping ones already created in the batch;
+- consecutive saveFile and copyFiles run as concurrent iput and icp;
+- consecutive moveFile to collection/basename(src) for the same collection become
+  one multi-source imv, unless the dest is an existing collection, which moveFile
+  would move the source into;
+- consecutive setAVU become one imeta reading its commands from stdin;
+- consecutive delete become one irm -rf.
+
+When a merged imv or irm fails, the catalog is checked to tell which of its
+operations took effect; a failed merged imeta is repeated one command at a time.
+
+batch.results holds an OperationResult per operation in recorded order. After a
+failed run the following runs are skipped and reported as such, and with
+raise_on_error (the default) WriteBatchError is raised once the batch is done.
+Nothing runs if the block raises.
+"""
+
+import posixpath
+from collections import namedtuple
+
+from django_irods.icommands import BatchException, SessionException
+
+# maximum number of paths given to one imkdir, imv or irm
+PATHS_PER_COMMAND = 100
+
+Operation = namedtuple('Operation', ['kind', 'args'])
+# error is None on success
+OperationResult = namedtuple('OperationResult', ['kind', 'args', 'error'])
+
+SKIPPED = 'not run because an earlier operation of the batch failed'
+
+
+class WriteBatchError(SessionException):
+    """Raised when operations of a write batch failed; results holds every
+    OperationResult of the batch.
+    """
+    def __init__(self, results):
+        failures = [r for r in results if r.error is not None and r.error != SKIPPED]
+        super(WriteBatchError, self).__init__(-1, '', '\n'.join(
+            '{kind} {args}: {error}'.format(kind=r.kind, args=r.args, error=r.error)
+            for r in failures))
+        self.results = results
+        self.failures = failures
+
+
+def _imeta_quote(value):
+    return '"' + value + '"'
+
+
+class WriteBatch(object):
+    def __init__(self, storage, raise_on_error=True, timeout=None):
+        self.storage = storage
+        self.session = storage.session
+        self.raise_on_error = raise_on_error
+        self.timeout = storage._timeout(timeout)
+        self.operations = []
+        self.results = None
+        self._created = set()
+
+    def mkdir(self, name):
+        self.operations.append(Operation('mkdir', (name,)))
+
+    def saveFile(self, from_name, to_name, create_directory=False, data_type_str=''):
+        self.operations.append(Operation('put', (from_name, to_name, create_directory,
+                                                 data_type_str)))
+
+    def copyFiles(self, src_name, dest_name, ires=None):
+        self.operations.append(Operation('copy', (src_name, dest_name, ires)))
+
+    def moveFile(self, src_name, dest_name):
+        self.operations.append(Operation('move', (src_name, dest_name)))
+
+    def setAVU(self, name, attName, attVal, attUnit=None):
+        if '"' in name + attName + attVal + (attUnit or ''):
+            # cannot be quoted for imeta's command reader; run it on its own
+            self.operations.append(Operation('avu_single', (name, attName, attVal, attUnit)))
+        else:
+            self.operations.append(Operation('avu', (name, attName, attVal, attUnit)))
+
+    def delete(self, name):
+        self.operations.append(Operation('delete', (name,)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.run()
+
+    def _runs(self):
+        """Splits the operations into runs of consecutive operations of one kind, with
+        saveFile and copyFiles sharing runs.
+        """
+        runs = []
+        for index, operation in enumerate(self.operations):
+            kind = 'transfer' if operation.kind in ('put', 'copy') else operation.kind
+            if runs and runs[-1][0] == kind and kind != 'avu_single':
+                runs[-1][1].append(index)
+            else:
+                runs.append((kind, [index]))
+        return runs
+
+    def run(self):
+        """Carries out the recorded operations and returns their OperationResult list.
+        """
+        names = set()
+        for operation in self.operations:
+            if operation.kind == 'move':
+                names.update(operation.args)
+            elif operation.kind in ('put', 'copy'):
+                names.add(operation.args[1])
+            else:
+                names.add(operation.args[0])
+        errors = {}
+        with self.storage._modifying(*names, recursive=True):
+            failed = False
+            for kind, indexes in self._runs():
+                if failed:
+                    errors.update((i, SKIPPED) for i in indexes)
+                    continue
+                run_errors = getattr(self, '_run_' + kind)(
+                    [self.operations[i] for i in indexes])
+                errors.update((i, error) for i, error in zip(indexes, run_errors))
+                failed = any(error is not None for error in run_errors)
+        self.results = [OperationResult(op.kind if op.kind != 'avu_single' else 'avu',
+                                        op.args, errors.get(i))
+                        for i, op in enumerate(self.operations)]
+        if self.raise_on_error and any(r.error is not None for r in self.results):
+            raise WriteBatchError(self.results)
+        return self.results
+
+    def _run(self, icommand, *args, **kwargs):
+        """Runs one icommand and returns None or its error message.
+        """
+        try:
+            self.session.run(icommand, kwargs.get('data'), *args, timeout=self.timeout,
+                             retry=kwargs.get('retry'))
+        except SessionException as ex:
+            return ex.stderr or 'failed'
+        return None
+
+    def _make_collections(self, collections):
+        """Creates the collections not yet created in this batch with imkdir -p and
+        returns None or the error message.
+        """
+        wanted = set(c.rstrip('/') or '/' for c in collections if c and c not in self._created)
+        # with -p, a collection is created along with its ancestors. Sorted by path
+        # component, the descendants of a collection directly follow it, so it is a leaf
+        # unless the next one is below it
+        ordered = sorted(wanted, key=lambda c: c.split('/'))
+        leaves = [c for c, following in zip(ordered, ordered[1:] + [None])
+                  if following is None or not following.startswith(c.rstrip('/') + '/')]
+        for i in range(0, len(leaves), PATHS_PER_COMMAND):
+            error = self._run('imkdir', '-p', *leaves[i:i + PATHS_PER_COMMAND],
+                              retry=self.storage.retry_policy)
+            if error is not None:
+                return error
+        for collection in wanted:
+            while collection not in ('', '/') and collection not in self._created:
+                self._created.add(collection)
+                collection = posixpath.dirname(collection)
+        return None
+
+    def _parents(self, names):
+        return [self.storage._abspath(name.rsplit('/', 1)[0]) for name in names if '/' in name]
+
+    def _run_mkdir(self, operations):
+        error = self._make_collections([self.storage._abspath(op.args[0])
+                                        for op in operations])
+        return [error] * len(operations)
+
+    def _run_transfer(self, operations):
+        parents = self._parents(op.args[1] for op in operations
+                                if op.kind == 'copy' or op.args[2])
+        error = self._make_collections(parents)
+        if error is not None:
+            return [error] * len(operations)
+        commands = []
+        indexes = []
+        for index, op in enumerate(operations):
+            if op.kind == 'put':
+                from_name, to_name, _, data_type_str = op.args
+                if not from_name:
+                    continue  # only the collection was asked for, as with saveFile
+                args = ['-D', data_type_str] if data_type_str else []
+                commands.append(('iput', args + ['-f', from_name, to_name]))
+            else:
+                src_name, dest_name, ires = op.args
+                args = ['-R', ires] if ires else []
+                commands.append(('icp', ['-rf'] + args + [src_name, dest_name]))
+            indexes.append(index)
+        errors = [None] * len(operations)
+        if not commands:
+            return errors
+        try:
+            outcomes = self.session.run_many(commands, timeout=self.timeout,
+                                             retry=self.storage.retry_policy)
+        except BatchException as ex:
+            outcomes = ex.results
+        for index, outcome in zip(indexes, outcomes):
+            if outcome.exitcode:
+                errors[index] = outcome.stderr or 'failed'
+        return errors
+
+    def _run_move(self, operations):
+        error = self._make_collections(self._parents(op.args[1] for op in operations))
+        if error is not None:
+            return [error] * len(operations)
+        # adjacent moves to collection/basename(src) go into collection together; only
+        # adjacent ones, so that a move depending on an earlier one stays after it
+        groups = []
+        for index, op in enumerate(operations):
+            src_name, dest_name = op.args
+            dest = self.storage._abspath(dest_name)
+            collection = posixpath.dirname(dest)
+            if posixpath.basename(dest) == posixpath.basename(self.storage._abspath(src_name)):
+                if groups and groups[-1][0] == collection:
+                    groups[-1][1].append(index)
+                    continue
+                groups.append((collection, [index]))
+            else:
+                groups.append((None, [index]))
+        groups = self._groupable(operations, groups)
+        errors = [None] * len(operations)
+        for target, indexes in groups:
+            for i in range(0, len(indexes), PATHS_PER_COMMAND):
+                chunk = indexes[i:i + PATHS_PER_COMMAND]
+                if any(error is not None for error in errors):
+                    # later moves may depend on the failed one
+                    for j in chunk:
+                        errors[j] = SKIPPED
+                    continue
+                if len(chunk) == 1:
+                    args = operations[chunk[0]].args
+                else:
+                    args = [operations[j].args[0] for j in chunk] + [target]
+                error = self._run('imv', *args)
+                if error is None:
+                    continue
+                if len(chunk) == 1:
+                    errors[chunk[0]] = error
+                    continue
+                # imv moves what it can, so see which of the sources are at their target
+                found = self._stat([name for j in chunk for name in operations[j].args])
+                for j in chunk:
+                    src_name, dest_name = operations[j].args
+                    if found is None or found[src_name] is not None or \
+                            found[dest_name] is None:
+                        errors[j] = error
+        return errors
+
+    def _groupable(self, operations, groups):
+        """Returns groups with the moves imv cannot carry out together with the others
+        split off, in order, into groups of their own with target None. The source of a
+        move to an existing collection goes into that collection, and a group of one
+        moves to its dest_name, as moveFile() does.
+        """
+        dests = [operations[i].args[1] for target, indexes in groups
+                 if target is not None and len(indexes) > 1 for i in indexes]
+        found = self._stat(dests) if dests else {}
+        result = []
+
+        def add(target, indexes):
+            if indexes:
+                result.append((target if len(indexes) > 1 else None, indexes))
+
+        seen = set()
+        for target, indexes in groups:
+            grouped = []
+            for i in indexes:
+                dest_name = operations[i].args[1]
+                dest = self.storage._abspath(dest_name)
+                stat = found.get(dest_name) if found else None
+                if target is None or found is None or dest in seen or \
+                        stat is not None and stat.is_collection:
+                    add(target, grouped)
+                    add(None, [i])
+                    grouped = []
+                else:
+                    grouped.append(i)
+                seen.add(dest)
+            add(target, grouped)
+        return result
+
+    def _stat(self, names):
+        """Returns storage.stat() of the list of names, or None if the query failed.
+        """
+        try:
+            return self.storage.stat(names, timeout=self.timeout)
+        except SessionException:
+            return None
+
+    def _avu_line(self, op):
+        name, attName, attVal, attUnit = op.args
+        args = ['set', '-C', name, attName, attVal] + ([attUnit] if attUnit else [])
+        return ' '.join([args[0], args[1]] + [_imeta_quote(a) for a in args[2:]])
+
+    def _run_imeta(self, lines):
+        """Runs the imeta commands of lines in one imeta and returns None or the error.
+        """
+        try:
+            stdout, stderr = self.session.run('imeta', '\n'.join(lines + ['quit']) + '\n',
+                                              timeout=self.timeout)
+        except SessionException as ex:
+            return ex.stderr or 'failed'
+        # imeta keeps reading commands after one failed, so errors only show in the output
+        return (stderr or stdout) if 'ERROR' in stderr or 'ERROR' in stdout else None
+
+    def _run_avu(self, operations):
+        lines = [self._avu_line(op) for op in operations]
+        error = self._run_imeta(lines)
+        if error is None or len(lines) == 1:
+            return [error] * len(operations)
+        # the output does not tell which command failed; imeta set can be repeated, so
+        # run them one by one to find out
+        return [self._run_imeta([line]) for line in lines]
+
+    def _run_avu_single(self, operations):
+        name, attName, attVal, attUnit = operations[0].args
+        try:
+            self.storage.setAVU(name, attName, attVal, attUnit, timeout=self.timeout)
+        except SessionException as ex:
+            return [ex.stderr or 'failed']
+        return [None]
+
+    def _run_delete(self, operations):
+        names = [op.args[0] for op in operations]
+        errors = []
+        for i in range(0, len(names), PATHS_PER_COMMAND):
+            chunk = names[i:i + PATHS_PER_COMMAND]
+            error = self._run('irm', '-rf', *chunk)
+            if error is not None and len(chunk) > 1:
+                # irm removes what it can, so see which of the paths are gone
+                found = self._stat(chunk)
+                errors.extend(error if found is None or found[name] is not None else None
+                              for name in chunk)
+            else:
+                errors.extend([error] * len(chunk))
+        for name in names:
+            path = self.storage._abspath(name)
+            self._created = set(c for c in self._created
+                                if c != path and not c.startswith(path + '/'))
+        return errors
@@ -0,0 +1,194 @@
+"""Cache of iRODS metadata lookups made by IrodsStorage.
+
+stat(), exists(), size(), getAVU() and getAVUs() results are kept for
+IRODS_METADATA_CACHE['ttl'] seconds. IrodsStorage invalidates the paths it
+modifies, and the ancestors of those paths, so that its own writes show up at
+once. Changes made outside this app are only seen once the entries expire.
+
+The cache is disabled unless IRODS_METADATA_CACHE is set to a dict such as
+
+    IRODS_METADATA_CACHE = {'ttl': 60, 'max_size': 10000}
+
+which keeps entries in an LRU dict per process, or
+
+    IRODS_METADATA_CACHE = {'ttl': 60, 'backend': 'django', 'cache_alias': 'default'}
+
+which shares them between workers through Django's cache framework.
+
+Invalidation stores a fresh random token for the invalidated path instead of
+deleting entries. Every entry holds the tokens that were current when it was
+looked up. These are the entry's own path token and the subtree tokens of the
+path and of all its ancestors. Any change to those tokens makes the entry
+stale, so invalidating a collection recursively costs one write whatever the
+size of the collection.
+
+Entries are kept per zone and user, since what a lookup finds depends on the
+permissions of the user making it. Tokens are kept per zone only, so a change
+made through any user's storage invalidates the entries of every user.
+"""
+
+import hashlib
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+
+
+class LocalBackend(object):
+    """Thread-safe in-process store with per-key expiry and optional LRU bound.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_purge = 1024
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del self._entries[key]
+                    continue
+                if self.max_size is not None:
+                    self._entries[key] = self._entries.pop(key)  # most recently used
+                found[key] = entry[1]
+        return found
+
+    def set_many(self, values, timeout):
+        expires = time.time() + timeout
+        with self._lock:
+            for key, value in values.items():
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, value)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            elif len(self._entries) > self._next_purge:
+                now = time.time()
+                for key in [k for k, v in self._entries.items() if v[0] <= now]:
+                    del self._entries[key]
+                self._next_purge = 2 * len(self._entries) + 1024
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend(object):
+    """Store backed by one of the caches configured in CACHES.
+    """
+    def __init__(self, alias='default'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_many(self, values, timeout):
+        self.cache.set_many(values, timeout)
+
+    def clear(self):
+        pass  # the Django cache may be shared with other data; entries simply expire
+
+
+def _ancestors(path):
+    """Returns path and all its parent collections, starting with path.
+    """
+    paths = [path]
+    while path not in ('/', ''):
+        path = posixpath.dirname(path)
+        paths.append(path)
+    return paths
+
+
+class MetadataCache(object):
+    def __init__(self, ttl=60, backend=None, tokens=None, prefix='django_irods:meta:'):
+        """
+        :param ttl: seconds a looked up value is kept
+        :param backend: store of the cached values, a LocalBackend by default
+        :param tokens: store of the invalidation tokens. It defaults to the backend
+        unless that is a LocalBackend, whose LRU bound must not evict tokens
+        :param prefix: prefix of the keys written to the stores
+        """
+        self.ttl = ttl
+        self.backend = backend if backend is not None else LocalBackend()
+        if tokens is None:
+            tokens = LocalBackend() if isinstance(self.backend, LocalBackend) else self.backend
+        self.tokens = tokens
+        self.prefix = prefix
+
+    def _key(self, scope, kind, path):
+        parts = (x if isinstance(x, bytes) else x.encode('utf-8') for x in (scope, kind, path))
+        return self.prefix + hashlib.md5(b'\0'.join(parts)).hexdigest()
+
+    def _token_keys(self, scope, path):
+        paths = _ancestors(path)
+        return [self._key(scope, 'self', path)] + [self._key(scope, 'tree', p) for p in paths]
+
+    def get(self, path, kind, compute, scope='', user=''):
+        """Returns the cached value of kind (e.g. 'size' or 'avu:<attribute>') for the
+        absolute iRODS path as seen by user, calling compute() to look it up when it is
+        missing or stale. Exceptions raised by compute() propagate and are not cached.
+        """
+        token_keys = self._token_keys(scope, path)
+        key = self._key(u'{}\0{}'.format(scope, user), kind, path)
+        found = self.tokens.get_many(token_keys)
+        tokens = tuple(found.get(k) for k in token_keys)
+        entry = self.backend.get_many([key]).get(key)
+        if entry is not None and entry[0] == tokens:
+            return entry[1]
+        # the tokens were read before compute() runs, so a concurrent invalidation
+        # leaves this value stale rather than letting it hide the change
+        value = compute()
+        self.backend.set_many({key: (tokens, value)}, self.ttl)
+        return value
+
+    def invalidate(self, path, recursive=False, scope=''):
+        """Invalidates the entries of the absolute iRODS path and its ancestors, and
+        with recursive also those of everything below path, for all users of scope.
+        """
+        paths = _ancestors(path)
+        keys = [self._key(scope, 'self', p) for p in paths]
+        if recursive:
+            keys.append(self._key(scope, 'tree', path))
+        token = uuid4().hex
+        # tokens outlive every entry that may have recorded the previous ones
+        self.tokens.set_many(dict((k, token) for k in keys), self.ttl)
+
+    def clear(self):
+        self.backend.clear()
+        self.tokens.clear()
+
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+
+
+def get_metadata_cache():
+    """Returns the process-wide MetadataCache configured by IRODS_METADATA_CACHE, or
+    None if the cache is disabled.
+    """
+    global _metadata_cache
+    options = getattr(settings, 'IRODS_METADATA_CACHE', None)
+    if not options:
+        return None
+    with _metadata_cache_lock:
+        if _metadata_cache is None:
+            options = dict(options)
+            kind = options.pop('backend', 'local')
+            alias = options.pop('cache_alias', 'default')
+            max_size = options.pop('max_size', 10000)
+            if kind == 'django':
+                backend = DjangoCacheBackend(alias)
+            else:
+                backend = LocalBackend(max_size=max_size)
+            _metadata_cache = MetadataCache(backend=backend, **options)
+        return _metadata_cache
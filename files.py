@@ -0,0 +1,143 @@
+"""Lazy, seekable file object over an iRODS data object.
+
+IrodsStorage._open returns an IrodsFile, which does not fetch anything until the
+first read() and then streams the data object with Session.iget_stream, so
+reading the header of a 10 GB object costs no more than the header. seek()
+skips forward within the running stream when the target is close and otherwise
+restarts it at the new offset. Backends that can open a data object at an
+offset (ClientBackend) start there directly; with iget the bytes before the
+offset are read and discarded.
+
+Callers that seek back and forth can pass spool_threshold. Everything read is
+then also kept in a SpooledTemporaryFile, in memory up to that many bytes and on
+local disk beyond, and the stream is never restarted. The IRODS_OPEN_SPOOL_THRESHOLD
+setting applies it to every file opened by IrodsStorage.
+"""
+
+import os
+from tempfile import SpooledTemporaryFile
+
+from django.core.files.base import File
+
+# forward seeks up to this many bytes read through the running stream rather than
+# restarting it
+SEEK_SKIP_LIMIT = 1024 * 1024
+
+
+class IrodsFile(File):
+    def __init__(self, storage, name, mode='rb', spool_threshold=None):
+        """
+        :param storage: the IrodsStorage the data object is read through
+        :param name: the data object name
+        :param spool_threshold: None to restart the stream on backward seeks, or the bytes
+        kept in memory before the data read so far is spooled to local disk
+        """
+        self.storage = storage
+        self.name = name
+        self.mode = mode
+        self.file = None
+        self.spool_threshold = spool_threshold
+        self._stream = None
+        self._stream_pos = 0  # offset of the next byte the stream returns
+        self._pos = 0
+        self._spool = None
+        self._eof = None  # size of the data object once a stream reached its end
+        self._closed = False
+
+    def _get_size_from_underlying_file(self):
+        if self._eof is not None:
+            return self._eof
+        return self.storage.size(self.name)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def open(self, mode=None):
+        self.seek(0)
+        self._closed = False
+        return self
+
+    def _start(self, offset):
+        self._stop()
+        self._stream = self.storage.session.iget_stream(self.name, offset=offset,
+                                                        timeout=self.storage.timeout)
+        self._stream_pos = offset
+
+    def _stop(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _read_stream(self, size):
+        """Reads up to size bytes (all if size < 0) from the stream at self._stream_pos.
+        """
+        if self._stream is None:
+            self._start(self._stream_pos)
+        data = self._stream.read(size)
+        self._stream_pos += len(data)
+        if not data or size < 0:
+            self._stop()
+            self._eof = self._stream_pos
+        return data
+
+    def read(self, size=-1):
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        if self.spool_threshold is not None:
+            return self._read_spooled(size)
+        if size == 0 or self._eof is not None and self._pos >= self._eof:
+            return ''
+        skip = self._pos - self._stream_pos
+        if self._stream is not None and 0 < skip <= SEEK_SKIP_LIMIT:
+            while self._stream is not None and self._stream_pos < self._pos:
+                self._read_stream(min(self._pos - self._stream_pos, File.DEFAULT_CHUNK_SIZE))
+        if self._stream_pos != self._pos:
+            self._stop()
+            self._stream_pos = self._pos
+        data = self._read_stream(size)
+        self._pos += len(data)
+        return data
+
+    def _read_spooled(self, size):
+        if self._spool is None:
+            self._spool = SpooledTemporaryFile(max_size=self.spool_threshold)
+        # extend the spool sequentially up to the end of the requested range
+        end = self._pos + size if size >= 0 else None
+        self._spool.seek(0, os.SEEK_END)
+        while self._eof is None and (end is None or self._stream_pos < end):
+            chunk_size = File.DEFAULT_CHUNK_SIZE if end is None else \
+                min(end - self._stream_pos, File.DEFAULT_CHUNK_SIZE)
+            chunk = self._read_stream(chunk_size)
+            if not chunk:
+                break
+            self._spool.write(chunk)
+        self._spool.seek(self._pos)
+        data = self._spool.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Invalid seek offset: {}".format(offset))
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._stop()
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        # open() reads the data object afresh, as it may have changed meanwhile
+        self._stream_pos = 0
+        self._pos = 0
+        self._eof = None
+        self.__dict__.pop('_size', None)  # cached by File.size
+        self._closed = True
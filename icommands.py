@@ -2,11 +2,18 @@
 
 import os
 import shutil
-import subprocess
+import signal
 import textwrap
-from cStringIO import StringIO
+import threading
+import time
 from django.conf import settings
-from collections import namedtuple
+from django.utils.functional import SimpleLazyObject
+from collections import deque, namedtuple
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+
+from django_irods import metrics
+from django_irods.backends import CommandTimeout, get_backend
 
 
 class SessionException(Exception):
@@ -19,6 +26,298 @@ class SessionException(Exception):
         self.stderr = stderr
         self.exitcode = exitcode
 
+    @property
+    def auth_error(self):
+        """True if the failure was caused by expired or invalid authentication.
+        """
+        return _is_auth_error(self.stdout, self.stderr)
+
+
+# iRODS errors meaning the session has to authenticate again with iinit
+AUTH_ERRORS = ('CAT_INVALID_AUTHENTICATION', 'CAT_PASSWORD_EXPIRED', 'AUTH_FILE_DOES_NOT_EXIST',
+               '-826000', '-840000')
+
+
+def _is_auth_error(stdout, stderr):
+    output = (stdout or '') + (stderr or '')
+    return any(error in output for error in AUTH_ERRORS)
+
+
+class SessionTimeoutException(SessionException):
+    """Raised when an icommand is killed because its timeout or deadline expired.
+    """
+    def __init__(self, timeout, stdout='', stderr=''):
+        super(SessionTimeoutException, self).__init__(
+            TIMEOUT_EXITCODE, stdout,
+            "{stderr}icommand timed out after {timeout:.1f} seconds".format(
+                stderr=stderr, timeout=timeout))
+        self.timeout = timeout
+
+
+# exit code reported for icommands killed by a timeout
+TIMEOUT_EXITCODE = -signal.SIGKILL
+
+_local = threading.local()
+
+
+def current_deadline():
+    """Returns the absolute time (as time.time()) by which icommands run by this thread
+    must finish, or None.
+    """
+    deadlines = getattr(_local, 'deadlines', None)
+    return deadlines[-1] if deadlines else None
+
+
+class deadline(object):
+    """Bounds the total wall time of the icommands this thread runs within it.
+
+        with icommands.deadline(30):
+            istorage.getAVU(...)
+            istorage.exists(...)
+
+    A command running when the deadline expires is killed with
+    SessionTimeoutException and later commands fail immediately. Nested deadlines
+    can only shorten the enclosing one. Can also be used as a view decorator.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __enter__(self):
+        expires = current_deadline()
+        if self.seconds is not None:
+            mine = time.time() + self.seconds
+            if expires is None or mine < expires:
+                expires = mine
+        if not hasattr(_local, 'deadlines'):
+            _local.deadlines = []
+        _local.deadlines.append(expires)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.deadlines.pop()
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with deadline(self.seconds):
+                return func(*args, **kwargs)
+        return inner
+
+
+class BatchException(SessionException):
+    """Raised by Session.run_many when commands of a batch fail.
+
+    results holds one CommandResult per submitted command in input order (None for
+    commands never started after a fail-fast abort); failures holds the failed ones.
+    """
+    def __init__(self, results):
+        failures = [r for r in results if r is not None and r.exitcode]
+        stderr = "\n".join("{icommand} {args}: {stderr}".format(
+            icommand=r.icommand, args=' '.join(r.args), stderr=r.stderr) for r in failures)
+        super(BatchException, self).__init__(failures[0].exitcode, failures[0].stdout, stderr)
+        self.results = results
+        self.failures = failures
+
+
+CommandResult = namedtuple(
+    'CommandResult',
+    ['icommand', 'args', 'exitcode', 'stdout', 'stderr', 'elapsed']
+)
+
+# error modes for Session.run_many
+FAIL_FAST = 'fail_fast'
+COLLECT_ALL = 'collect_all'
+
+# default read size of Session.stream and the stderr kept from a streamed command
+STREAM_CHUNK_SIZE = 64 * 1024
+STDERR_LIMIT = 64 * 1024
+
+
+class StderrDrain(threading.Thread):
+    """Reads a process' stderr in the background so the child can never block on a
+    full stderr pipe, keeping only the last limit bytes.
+    """
+    def __init__(self, pipe, limit=STDERR_LIMIT, on_eof=None):
+        super(StderrDrain, self).__init__()
+        self.daemon = True
+        self.pipe = pipe
+        self.limit = limit
+        self.on_eof = on_eof  # called with the drain once stderr is closed
+        self.total = 0
+        self._chunks = deque()
+        self._size = 0
+
+    def run(self):
+        try:
+            for chunk in iter(lambda: self.pipe.read(4096), ''):
+                self.total += len(chunk)
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+                while self._size - len(self._chunks[0]) >= self.limit:
+                    self._size -= len(self._chunks.popleft())
+        except (IOError, ValueError):
+            pass  # pipe closed under us after the process was killed
+        if self.on_eof is not None:
+            self.on_eof(self)
+
+    @property
+    def value(self):
+        return ''.join(self._chunks)[-self.limit:]
+
+
+class CommandStream(object):
+    """Iterable, file-like stdout of a running icommand.
+
+    Chunks are only read from the child as the consumer asks for them, so memory use
+    does not depend on the size of the output. When stdout is exhausted the exit
+    code is checked and SessionException raised on failure; closing the stream
+    before that kills the child. The first skip bytes of stdout are discarded.
+
+    If the command fails before writing anything, restart is called once with its
+    stderr and may return a (proc, on_finish, skip) triple for a new attempt, which
+    the stream then reads from instead.
+    """
+    def __init__(self, proc, chunk_size=STREAM_CHUNK_SIZE, stderr_limit=STDERR_LIMIT,
+                 on_finish=None, timeout=None, kill=None, skip=0, restart=None):
+        self.proc = proc
+        self.restart = restart
+        self.chunk_size = chunk_size
+        self.skip = skip
+        self.stderr = StderrDrain(proc.stderr, stderr_limit)
+        self.stderr.start()
+        self.finished = False
+        self.on_finish = on_finish  # called with (exitcode, stdout bytes, stderr bytes)
+        self.bytes_read = 0
+        self.kill = kill or (lambda proc: proc.kill())
+        self.timeout = timeout
+        self.timed_out = False
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self):
+        self.timed_out = True
+        self.kill(self.proc)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self.read(self.chunk_size)
+        if not chunk:
+            raise StopIteration
+        return chunk
+
+    __next__ = next
+
+    def read(self, size=-1):
+        if self.finished:
+            return ''
+        while self.skip:
+            chunk = self.proc.stdout.read(min(self.skip, self.chunk_size))
+            self.bytes_read += len(chunk)
+            if not chunk:
+                if self._restart():
+                    return self.read(size)
+                self._finish()
+                return ''
+            self.skip -= len(chunk)
+        chunk = self.proc.stdout.read(size)
+        self.bytes_read += len(chunk)
+        if not chunk and self._restart():
+            return self.read(size)
+        if not chunk or size < 0:
+            self._finish()
+        return chunk
+
+    def _restart(self):
+        """Replaces the failed process by the one restart() starts, if the command failed
+        before writing anything; returns whether it did.
+        """
+        restart, self.restart = self.restart, None
+        if restart is None or self.bytes_read:
+            return False
+        returncode = self.proc.wait()
+        self.stderr.join()
+        if not returncode or self.timed_out:
+            return False
+        started = restart(self.stderr.value)
+        if started is None:
+            return False
+        if self.on_finish is not None:
+            self.on_finish(returncode, 0, self.stderr.total)
+        self.proc, self.on_finish, self.skip = started
+        self.stderr = StderrDrain(self.proc.stderr, self.stderr.limit)
+        self.stderr.start()
+        return True
+
+    def _finish(self):
+        self.finished = True
+        returncode = self.proc.wait()
+        if self._timer is not None:
+            self._timer.cancel()
+        self.stderr.join()
+        if self.on_finish is not None:
+            self.on_finish(returncode, self.bytes_read, self.stderr.total)
+        if self.timed_out:
+            raise SessionTimeoutException(self.timeout, '', self.stderr.value)
+        if returncode:
+            raise SessionException(returncode, '', self.stderr.value)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if not self.finished:
+            self.finished = True
+            self.kill(self.proc)
+            returncode = self.proc.wait()
+            if self.on_finish is not None:
+                self.on_finish(returncode, self.bytes_read, self.stderr.total)
+        if not self.proc.stdout.closed:
+            self.proc.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UploadStream(object):
+    """Writable file object storing a data object through the session backend.
+
+    Used as a context manager, an exception inside the block records the upload as
+    failed in the metrics.
+    """
+    def __init__(self, fileobj, on_finish):
+        self.file = fileobj
+        self.on_finish = on_finish  # called with the exit code once closed
+        self.bytes_written = 0
+        self.closed = False
+
+    def write(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+    def close(self, exitcode=0):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.file.close()
+            except Exception:
+                exitcode = exitcode or 1
+                raise
+            finally:
+                self.on_finish(exitcode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(exitcode=1 if exc_type is not None else 0)
+
 
 IRodsEnv = namedtuple(
     'IRodsEnv',
@@ -32,13 +331,25 @@ class Session(object):
     iRODS client sessions at the same time, using icommands.
     """
 
-    def __init__(self, root=None, icommands_path=None, session_id='default_session'):
+    def __init__(self, root=None, icommands_path=None, session_id='default_session',
+                 backend=None, default_timeout=None):
         self.root = root or settings.IRODS_ROOT  # main directory to store session and log dirs
         self.icommands_path = icommands_path or settings.IRODS_ICOMMANDS_PATH  # where the icommand
         # binaries are
         self.session_id = session_id
         self.session_path = "{root}/{session_id}".format(root=self.root,
                                                          session_id=self.session_id)
+        if backend is None or isinstance(backend, basestring):
+            backend = get_backend(backend)
+        self.backend = backend  # how icommands are executed, see backends.py
+        # seconds after which an icommand is killed unless the call gives its own timeout
+        self.default_timeout = default_timeout if default_timeout is not None else \
+            getattr(settings, 'IRODS_DEFAULT_TIMEOUT', None)
+        self._auth = None  # password of the last successful iinit, to re-authenticate
+        self._auth_lock = threading.Lock()
+        self._auth_generation = 0  # counts the successful iinit calls
+        self._active = 0  # icommands, streams and uploads started and not finished yet
+        self._active_lock = threading.Lock()
 
     def create_environment(self, myEnv=None):
         """Creates session files in temporary directory.
@@ -103,6 +414,7 @@ class Session(object):
 
         To be called after self.runCmd('iexit').
         """
+        self.backend.close(self)
         shutil.rmtree(self.session_path)
 
     def session_file_exists(self):
@@ -149,118 +461,351 @@ class Session(object):
         envfile.close()
         return user_name
 
-    def run(self, icommand, data=None, *args):
-        """Runs an icommand with optional argument list and
-        returns tuple (stdout, stderr) from subprocess execution.
+    def _metric_labels(self):
+        labels = ()
+        if getattr(settings, 'IRODS_METRICS_SESSION_LABEL', False):
+            labels += (('session_id', self.session_id),)
+        if getattr(settings, 'IRODS_METRICS_ZONE_LABEL', False):
+            labels += (('zone', self.zone.strip('",')),)
+        return labels
 
-        Set of valid commands can be extended.
+    @property
+    def busy(self):
+        """True while an icommand, stream or upload of the session is running.
         """
+        return self._active > 0
 
-        myenv = os.environ.copy()
-        myenv['IRODS_ENVIRONMENT_FILE'] = os.path.join(self.session_path, "irods_environment.json")
-        myenv['IRODS_AUTHENTICATION_FILE'] = os.path.join(self.session_path, ".irodsA")
+    def _observe(self, icommand, args):
+        """Starts timing icommand and returns a callable recording its completion with
+        (exitcode, stdout_bytes, stderr_bytes) in the metrics registry.
 
-        cmdStr = os.path.join(self.icommands_path, icommand)
-        argList = [cmdStr]
+        The session counts as busy until the callable is called.
+        """
+        labels = self._metric_labels()
+        finishers = metrics.REGISTRY.start(self, icommand, args, labels)
+        start = time.time()
+        with self._active_lock:
+            self._active += 1
+        finished = []
+
+        def finish(exitcode, stdout_bytes=None, stderr_bytes=None):
+            with self._active_lock:
+                if finished:
+                    return
+                finished.append(True)
+                self._active -= 1
+            metrics.REGISTRY.record(icommand, exitcode, time.time() - start, stdout_bytes,
+                                    stderr_bytes, labels=labels, finishers=finishers)
+        return finish
+
+    def _expires(self, timeout=None):
+        """Returns the absolute time by which a command started now with timeout (or the
+        session default) must finish, taking the thread's deadline into account.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout is not None else None
+        inherited = current_deadline()
+        if inherited is not None and (expires is None or inherited < expires):
+            expires = inherited
+        return expires
+
+    def _call_backend(self, icommand, args, data=None, expires=None):
+        timeout = None
+        if expires is not None:
+            timeout = expires - time.time()
+            if timeout <= 0:
+                raise SessionTimeoutException(0)
+        finish = self._observe(icommand, args)
+        try:
+            returncode, stdout, stderr = self.backend.execute(self, icommand, args, data=data,
+                                                              timeout=timeout)
+        except CommandTimeout as ex:
+            finish(TIMEOUT_EXITCODE, len(ex.stdout or ''), len(ex.stderr or ''))
+            raise SessionTimeoutException(ex.timeout, ex.stdout, ex.stderr)
+        except Exception:
+            finish(1)
+            raise
+        finish(returncode, len(stdout or ''), len(stderr or ''))
+        return returncode, stdout, stderr
+
+    def _execute_once(self, icommand, args, data=None, expires=None):
+        """Runs icommand through the backend and returns (returncode, stdout, stderr).
+
+        Raises SessionTimeoutException if the command does not finish by expires.
+        A command failing because the authentication expired or became invalid is
+        retried once after re-running iinit with the password of the last iinit.
+        """
+        generation = self._auth_generation
+        returncode, stdout, stderr = self._call_backend(icommand, args, data=data,
+                                                        expires=expires)
+        if icommand == 'iinit':
+            if not returncode:
+                with self._auth_lock:
+                    self._auth = args[0] if args else ''
+                    self._auth_generation += 1
+        elif returncode and self._auth is not None and _is_auth_error(stdout, stderr):
+            if self._reauthenticate(generation, expires):
+                returncode, stdout, stderr = self._call_backend(icommand, args, data=data,
+                                                                expires=expires)
+        return returncode, stdout, stderr
+
+    def _reauthenticate(self, generation, expires):
+        """Re-runs iinit with the password of the last iinit unless another thread did so
+        since generation was read from _auth_generation; returns whether the session is
+        authenticated again.
+        """
+        with self._auth_lock:
+            if self._auth_generation != generation:
+                return True
+            reinit = self._call_backend('iinit', [self._auth], expires=expires)
+            if reinit[0]:
+                return False
+            self._auth_generation += 1
+            return True
+
+    def _execute(self, icommand, args, data=None, expires=None, retry=None):
+        """Like _execute_once, retrying failures the way the RetryPolicy retry allows.
+        """
+        started = time.time()
+        attempt = 1
+        while True:
+            timed_out = None
+            try:
+                returncode, stdout, stderr = self._execute_once(icommand, args, data=data,
+                                                                expires=expires)
+            except SessionTimeoutException as ex:
+                timed_out = ex
+                returncode, stdout, stderr = ex.exitcode, ex.stdout, ex.stderr
+            if not returncode or retry is None:
+                break
+            now = time.time()
+            delay = retry.next_delay(attempt, returncode, stdout, stderr, now - started,
+                                     expires - now if expires is not None else None)
+            if delay is None:
+                break
+            metrics.REGISTRY.record_retry(icommand, labels=self._metric_labels())
+            time.sleep(delay)
+            attempt += 1
+        if timed_out is not None:
+            raise timed_out
+        return returncode, stdout, stderr
+
+    def run(self, icommand, data=None, *args, **kwargs):
+        """Runs an icommand with optional argument list and
+        returns tuple (stdout, stderr) from the execution backend.
+
+        The optional keyword argument timeout overrides the session default_timeout;
+        SessionTimeoutException is raised when it or the current deadline expires.
+        The optional keyword argument retry is a retry.RetryPolicy applied to failures
+        of commands that are safe to repeat.
+
+        Set of valid commands can be extended.
+        """
         uargs = [x.encode('utf-8') for x in args]
-        argList.extend(uargs)
-
-        stdin = None
-        if data:
-            stdin = StringIO(data)
-
-        proc = subprocess.Popen(
-            argList,
-            stdin=subprocess.PIPE if stdin else None,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=myenv
-        )
-        stdout, stderr = proc.communicate(input=data) if stdin else proc.communicate()
-
-        if proc.returncode:
-            raise SessionException(proc.returncode, stdout, stderr)
+        returncode, stdout, stderr = self._execute(icommand, uargs, data=data,
+                                                   expires=self._expires(kwargs.get('timeout')),
+                                                   retry=kwargs.get('retry'))
+
+        if returncode:
+            raise SessionException(returncode, stdout, stderr)
         else:
             return stdout, stderr
 
     def run_safe(self, icommand, data=None, *args):
-        myenv = os.environ.copy()
-        myenv['IRODS_ENVIRONMENT_FILE'] = os.path.join(self.session_path, "irods_environment.json")
-        myenv['IRODS_AUTHENTICATION_FILE'] = os.path.join(self.session_path, ".irodsA")
-
-        cmdStr = os.path.join(self.icommands_path, icommand)
-        argList = [cmdStr]
-        argList.extend(args)
-
-        stdin = None
-        if data:
-            print data
-            stdin = StringIO(data)
-
-        proc = subprocess.Popen(
-            argList,
-            stdin=stdin,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=myenv
-        )
+        """Starts an icommand and returns the Popen-like process without waiting for it.
+
+        stderr is drained in the background by proc.stderr_drain, so only stdout
+        should be read from the returned process.
+        """
+        finish = self._observe(icommand, args)
+        try:
+            proc = self.backend.popen(self, icommand, list(args), data=data)
+        except Exception:
+            finish(1)
+            raise
+        proc.stderr_drain = StderrDrain(
+            proc.stderr, on_eof=lambda drain: finish(proc.wait(), None, drain.total))
+        proc.stderr_drain.start()
         return proc
 
-    def runbatch(self, *icommands):
-        myenv = os.environ.copy()
-        myenv['IRODS_ENVIRONMENT_FILE'] = os.path.join(self.session_path, "irods_environment.json")
-        myenv['IRODS_AUTHENTICATION_FILE'] = os.path.join(self.session_path, ".irodsA")
-        return_codes = []
-
-        for icommand, args in icommands:
-            cmdStr = os.path.join(self.icommands_path, icommand)
-            argList = [cmdStr]
-            argList.extend(args)
-
-            return_codes.append(subprocess.Popen(
-                argList,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=myenv
-            ).communicate())
-        return return_codes
-
-    def admin(self, *args):
-        """Runs the iadmin icommand with optional argument list and
-        returns tuple (stdout, stderr) from subprocess execution.
+    def stream(self, icommand, *args, **kwargs):
+        """Starts an icommand and returns a CommandStream over its stdout.
+
+        Keyword arguments chunk_size (bytes yielded per iteration), stderr_limit
+        (bytes of stderr kept for the SessionException) and timeout (seconds the whole
+        transfer may take, bounded by the current deadline) are optional.
         """
+        return self._stream(icommand, args, 0, kwargs)
+
+    def iget_stream(self, path, offset=0, **kwargs):
+        """Returns a CommandStream over the contents of data object path from byte offset
+        on; keyword arguments as for stream().
 
-        # should probably also add a condition to restrict
-        # possible values for icommandsDir
-        myenv = os.environ.copy()
-        myenv['IRODS_ENVIRONMENT_FILE'] = "%s/irods_environment.json" % (self.session_path)
-        myenv['IRODS_AUTHENTICATION_FILE'] = "%s/.irodsA" % (self.session_path)
+        The backend opens the data object at offset where it can; otherwise iget starts
+        from the beginning and the bytes before offset are discarded.
+        """
+        return self._stream('iget', (path, '-'), offset, kwargs)
 
-        cmdStr = "{icommands}/iadmin".format(icommands=self.icommands_path)
+    def open_upload(self, path):
+        """Returns an UploadStream replacing data object path with what is written to it,
+        or None if the session backend cannot stream uploads.
+        """
+        upath = path.encode('utf-8')
+        fileobj = self.backend.open_write(self, upath)
+        if fileobj is None:
+            return None
+        return UploadStream(fileobj, self._observe('iput', [upath]))
+
+    def _stream(self, icommand, args, offset, kwargs):
+        """Starts icommand for a CommandStream. A command failing because the
+        authentication expired or became invalid is started again once after re-running
+        iinit with the password of the last iinit, as _execute_once does.
+        """
+        expires = self._expires(kwargs.pop('timeout', None))
+        timeout = None
+        if expires is not None:
+            timeout = expires - time.time()
+            if timeout <= 0:
+                raise SessionTimeoutException(0)
+        uargs = [x.encode('utf-8') for x in args]
 
-        argList = [cmdStr]
-        argList.extend(args)
+        def start():
+            finish = self._observe(icommand, uargs)
+            try:
+                proc = self.backend.popen_at(self, uargs[0], offset) if offset else None
+                if proc is None:
+                    return self.backend.popen(self, icommand, uargs), finish, offset
+            except Exception:
+                finish(1)
+                raise
+            return proc, finish, 0
+
+        def restart(stderr):
+            if self._auth is None or not _is_auth_error('', stderr):
+                return None
+            return start() if self._reauthenticate(generation, expires) else None
+
+        generation = self._auth_generation
+        proc, finish, skip = start()
+        return CommandStream(proc, on_finish=finish, timeout=timeout, kill=self.backend.kill,
+                             skip=skip, restart=restart, **kwargs)
+
+    def _run_batch(self, icommands, max_workers=None, fail_fast=False, timeout=None,
+                   retry=None):
+        """Runs (icommand, args) pairs on a bounded pool of worker threads.
+
+        Returns a list of CommandResult in input order. With fail_fast, commands not
+        yet started when one fails are skipped and their result is None. timeout and
+        the current deadline bound the batch as a whole.
+        """
+        expires = self._expires(timeout)
+        icommands = [(icommand, list(args)) for icommand, args in icommands]
+        if max_workers is None:
+            max_workers = getattr(settings, 'IRODS_BATCH_MAX_WORKERS', 4)
+        max_workers = max(1, min(max_workers, len(icommands)))
+        failed = threading.Event()
+
+        def execute(icommand_args):
+            icommand, args = icommand_args
+            if fail_fast and failed.is_set():
+                return None
+            start = time.time()
+            try:
+                returncode, stdout, stderr = self._execute(icommand, args, expires=expires,
+                                                           retry=retry)
+            except SessionTimeoutException as ex:
+                returncode, stdout, stderr = ex.exitcode, ex.stdout, ex.stderr
+            if returncode:
+                failed.set()
+            return CommandResult(icommand, args, returncode, stdout, stderr,
+                                 time.time() - start)
+
+        if max_workers <= 1:
+            return [execute(icommand_args) for icommand_args in icommands]
+        pool = ThreadPool(max_workers)
+        try:
+            return pool.map(execute, icommands)
+        finally:
+            pool.close()
+            pool.join()
+
+    def run_many(self, icommands, max_workers=None, mode=COLLECT_ALL, timeout=None,
+                 retry=None):
+        """Runs independent (icommand, args) pairs concurrently and returns a list of
+        CommandResult (exit code, stdout, stderr, elapsed seconds) in input order.
+
+        max_workers bounds the number of commands in flight and defaults to the
+        IRODS_BATCH_MAX_WORKERS setting. If any command fails, BatchException is
+        raised: in COLLECT_ALL mode after every command has run, in FAIL_FAST mode
+        as soon as possible without starting the remaining commands. Commands killed
+        because timeout (seconds for the whole batch) or the deadline expired are
+        reported with exit code TIMEOUT_EXITCODE. retry is an optional
+        retry.RetryPolicy applied to each command.
+        """
+        results = self._run_batch(icommands, max_workers=max_workers,
+                                  fail_fast=(mode == FAIL_FAST), timeout=timeout, retry=retry)
+        if any(r is not None and r.exitcode for r in results):
+            raise BatchException(results)
+        return results
+
+    def runbatch(self, *icommands, **kwargs):
+        """Runs (icommand, args) pairs one after the other and returns their (stdout,
+        stderr) tuples in input order, whether or not they succeeded. Callers pass
+        commands depending on earlier ones, so they only run concurrently when the
+        keyword argument max_workers asks for it; see run_many().
+        """
+        results = self._run_batch(icommands, max_workers=kwargs.get('max_workers', 1),
+                                  timeout=kwargs.get('timeout'))
+        return [(r.stdout, r.stderr) for r in results]
 
-        proc = subprocess.Popen(
-            argList,
-            stdin=None,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=myenv
-        )
+    def admin(self, *args, **kwargs):
+        """Runs the iadmin icommand with optional argument list and
+        returns tuple (stdout, stderr) from the execution backend.
 
-        stdout, stderr = proc.communicate()
+        Accepts the same timeout and retry keyword arguments as run().
+        """
+        returncode, stdout, stderr = self._execute('iadmin', list(args),
+                                                   expires=self._expires(kwargs.get('timeout')),
+                                                   retry=kwargs.get('retry'))
 
-        if proc.returncode:
-            raise SessionException(proc.returncode, stdout, stderr)
+        if returncode:
+            raise SessionException(returncode, stdout, stderr)
         else:
             return stdout, stderr
 
 
+_global_lock = threading.Lock()
+_global_session = None
+_global_environment = None
+
+
+def get_global_session():
+    """Returns the global session, creating and authenticating it on first use.
+
+    Creation is retried on the next call if iinit fails, e.g. while iRODS is down.
+    """
+    global _global_session, _global_environment
+    if _global_session is None:
+        with _global_lock:
+            if _global_session is None:
+                session = Session()
+                environment = session.create_environment()
+                session.run('iinit', None, environment.auth)
+                _global_environment = environment
+                _global_session = session
+    return _global_session
+
+
+def get_global_environment():
+    get_global_session()
+    return _global_environment
+
+
 if getattr(settings, 'IRODS_GLOBAL_SESSION', False) and getattr(settings, 'USE_IRODS', False):
-    GLOBAL_SESSION = Session()
-    GLOBAL_ENVIRONMENT = GLOBAL_SESSION.create_environment()
-    GLOBAL_SESSION.run('iinit', None, GLOBAL_ENVIRONMENT.auth)
+    # created lazily so that importing this module never blocks on iRODS
+    GLOBAL_SESSION = SimpleLazyObject(get_global_session)
+    GLOBAL_ENVIRONMENT = SimpleLazyObject(get_global_environment)
 else:
     GLOBAL_SESSION = None
     GLOBAL_ENVIRONMENT = None
@@ -0,0 +1,165 @@
+"""In-process instrumentation of icommand invocations.
+
+Every command run through a Session is recorded in REGISTRY: call counts,
+latency histograms, exit code tallies, stdout/stderr byte counts and retries per
+icommand. Setting IRODS_METRICS_SESSION_LABEL and IRODS_METRICS_ZONE_LABEL adds
+session_id and zone labels (beware that per-user sessions have unique ids).
+The registry is exported in Prometheus text format by views.metrics.
+
+Callers can attach their own timers with add_hook(hook). hook(session,
+icommand, args) is called when a command starts and may return a callable that
+is called with (exitcode, elapsed) when it completes.
+"""
+
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{key}="{value}"'.format(
+        key=key,
+        value=str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels) + '}'
+
+
+class MetricsRegistry(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.exit_codes = {}
+            self.latency = {}
+            self.stdout_bytes = {}
+            self.stderr_bytes = {}
+            self.retries = {}
+
+    def add_hook(self, hook):
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def start(self, session, icommand, args, labels=()):
+        """Notifies the hooks that icommand starts and returns the callables to be
+        called with (exitcode, elapsed) once it completes.
+        """
+        finishers = []
+        for hook in list(self._hooks):
+            try:
+                finish = hook(session, icommand, args)
+            except Exception:
+                logger.exception("iRODS metrics hook %r failed", hook)
+                continue
+            if finish is not None:
+                finishers.append(finish)
+        return finishers
+
+    def record(self, icommand, exitcode, elapsed, stdout_bytes=None, stderr_bytes=None,
+               labels=(), finishers=()):
+        """Records one completed invocation of icommand.
+        """
+        key = (('icommand', icommand),) + tuple(labels)
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            code_key = key + (('exitcode', exitcode),)
+            self.exit_codes[code_key] = self.exit_codes.get(code_key, 0) + 1
+            if key not in self.latency:
+                self.latency[key] = Histogram(self.buckets)
+            self.latency[key].observe(elapsed)
+            if stdout_bytes is not None:
+                self.stdout_bytes[key] = self.stdout_bytes.get(key, 0) + stdout_bytes
+            if stderr_bytes is not None:
+                self.stderr_bytes[key] = self.stderr_bytes.get(key, 0) + stderr_bytes
+        for finish in finishers:
+            try:
+                finish(exitcode, elapsed)
+            except Exception:
+                logger.exception("iRODS metrics hook %r failed", finish)
+
+    def record_retry(self, icommand, labels=()):
+        """Records that a failed invocation of icommand is being retried.
+        """
+        key = (('icommand', icommand),) + tuple(labels)
+        with self._lock:
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def prometheus_text(self):
+        """Returns the registry in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def counter(name, help_text, values):
+            lines.append('# HELP {name} {help}'.format(name=name, help=help_text))
+            lines.append('# TYPE {name} counter'.format(name=name))
+            for key, value in sorted(values.items()):
+                lines.append('{name}{labels} {value}'.format(
+                    name=name, labels=_format_labels(key), value=value))
+
+        with self._lock:
+            counter('irods_icommand_calls_total', 'Number of completed icommand invocations.',
+                    self.calls)
+            counter('irods_icommand_exit_codes_total', 'Completed icommands by exit code.',
+                    self.exit_codes)
+            counter('irods_icommand_stdout_bytes_total', 'Bytes written to stdout by icommands.',
+                    self.stdout_bytes)
+            counter('irods_icommand_stderr_bytes_total', 'Bytes written to stderr by icommands.',
+                    self.stderr_bytes)
+            counter('irods_icommand_retries_total', 'Failed icommands that were retried.',
+                    self.retries)
+
+            name = 'irods_icommand_duration_seconds'
+            lines.append('# HELP {name} Wall time of icommand invocations.'.format(name=name))
+            lines.append('# TYPE {name} histogram'.format(name=name))
+            for key, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                bounds = [repr(b) for b in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('{name}_bucket{labels} {value}'.format(
+                        name=name, labels=_format_labels(key + (('le', bound),)),
+                        value=cumulative))
+                lines.append('{name}_sum{labels} {value!r}'.format(
+                    name=name, labels=_format_labels(key), value=histogram.sum))
+                lines.append('{name}_count{labels} {value}'.format(
+                    name=name, labels=_format_labels(key), value=histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+def add_hook(hook):
+    REGISTRY.add_hook(hook)
+
+
+def remove_hook(hook):
+    REGISTRY.remove_hook(hook)
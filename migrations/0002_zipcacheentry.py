@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_irods', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZipCacheEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(unique=True, max_length=64)),
+                ('resource_id', models.CharField(max_length=255, db_index=True)),
+                ('input_path', models.TextField()),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('zip_dir', models.TextField()),
+                ('zip_path', models.TextField()),
+                ('federated', models.BooleanField(default=False)),
+                ('size', models.BigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_used', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Cached zip',
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -23,3 +23,24 @@ class RodsEnvironment(m.Model):
 
     class Meta:
         verbose_name = 'iRODS Environment'
+
+
+class ZipCacheEntry(m.Model):
+    """A zip of a resource folder or aggregation kept in iRODS by zipcache for reuse.
+    """
+    key = m.CharField(max_length=64, unique=True)
+    resource_id = m.CharField(max_length=255, db_index=True)
+    input_path = m.TextField()
+    fingerprint = m.CharField(max_length=64)
+    zip_dir = m.TextField()
+    zip_path = m.TextField()
+    federated = m.BooleanField(default=False)
+    size = m.BigIntegerField(default=0)
+    created = m.DateTimeField(auto_now_add=True)
+    last_used = m.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return self.zip_path
+
+    class Meta:
+        verbose_name = 'Cached zip'
@@ -0,0 +1,145 @@
+"""Process-wide pool of authenticated per-user and federated sessions.
+
+Creating a Session means writing its irods_environment.json and running iinit,
+so IrodsStorage takes user sessions from SESSION_POOL instead of creating a new
+one on every call. Sessions are keyed by (host, port, zone, user, resource),
+kept in LRU order up to IRODS_SESSION_POOL_SIZE entries and re-authenticated
+with iinit once older than IRODS_SESSION_POOL_TTL seconds.
+
+An evicted session may still be held by an IrodsStorage, e.g. one streaming a
+download, so its session directory is not deleted right away. The session is
+retired instead, and its directory is deleted once it is not busy running an
+icommand and has been retired for IRODS_SESSION_POOL_GRACE seconds (300).
+Retired sessions are reaped whenever a session is taken from the pool.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+
+from django_irods.icommands import Session
+
+
+class PooledSession(object):
+    def __init__(self, session, environment):
+        self.session = session
+        self.environment = environment
+        self.authenticated_at = None
+        self.retired_at = None
+
+
+class SessionPool(object):
+    def __init__(self, max_size=None, ttl=None, grace=None):
+        self.max_size = max_size if max_size is not None else \
+            getattr(settings, 'IRODS_SESSION_POOL_SIZE', 32)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'IRODS_SESSION_POOL_TTL', 3600)
+        self.grace = grace if grace is not None else \
+            getattr(settings, 'IRODS_SESSION_POOL_GRACE', 300)
+        self._entries = OrderedDict()
+        self._retired = []
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(environment):
+        return (environment.host, environment.port, environment.zone, environment.username,
+                environment.def_res)
+
+    def get(self, environment, session_id=None):
+        """Returns a (session, environment) pair authenticated for environment, an
+        IRodsEnv, reusing the pooled session when there is one.
+
+        session_id prefixes the name of the session directory when a new session has to
+        be created. The name is made unique, so that a session created for a key whose
+        previous session was evicted never shares the directory of the retired one.
+        """
+        key = self.key(environment)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._entries[key] = entry  # now the most recently used
+            if entry is None:
+                session = Session(session_id='{}-{}'.format(session_id, uuid4().hex)
+                                  if session_id else uuid4())
+                entry = PooledSession(session, session.create_environment(myEnv=environment))
+            elif not entry.session.session_file_exists():
+                # the session directory was removed behind the pool's back
+                entry.session.create_environment(myEnv=environment)
+                entry.authenticated_at = None
+            stale = entry.authenticated_at is None or \
+                time.time() - entry.authenticated_at > self.ttl or \
+                entry.environment.auth != environment.auth
+            if stale:
+                entry.environment = environment
+                entry.authenticated_at = None
+                try:
+                    entry.session.run('iinit', None, environment.auth)
+                except Exception:
+                    if key not in self._entries:
+                        entry.session.delete_environment()
+                    raise
+                entry.authenticated_at = time.time()
+            with self._lock:
+                pooled = self._entries.get(key)
+                if pooled is None:
+                    self._entries[key] = entry
+                    self._evict()
+                elif pooled is not entry:
+                    # created concurrently after the key lock was pruned; use the pooled one
+                    self._retire(entry)
+                    entry = pooled
+        self._reap()
+        return entry.session, entry.environment
+
+    def owns(self, session):
+        with self._lock:
+            return any(entry.session is session
+                       for entry in list(self._entries.values()) + self._retired)
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            key, entry = self._entries.popitem(last=False)
+            key_lock = self._key_locks.get(key)
+            if key_lock is not None and not key_lock.locked():
+                del self._key_locks[key]
+            self._retire(entry)
+
+    def _retire(self, entry):
+        entry.retired_at = time.time()
+        self._retired.append(entry)
+
+    def _reap(self, grace=None):
+        """Deletes the session directories of the retired sessions that are idle and
+        were retired at least grace seconds (the pool's grace) ago.
+        """
+        if grace is None:
+            grace = self.grace
+        now = time.time()
+        with self._lock:
+            reaped = [entry for entry in self._retired
+                      if now - entry.retired_at >= grace and not entry.session.busy]
+            self._retired = [entry for entry in self._retired if entry not in reaped]
+            live = set(entry.session.session_path for entry in self._entries.values())
+        for entry in reaped:
+            if entry.session.session_path not in live and entry.session.session_file_exists():
+                entry.session.delete_environment()
+
+    def clear(self):
+        """Empties the pool, deleting the session directories of the idle sessions.
+        Busy ones are deleted by a later reap once they are done.
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                self._retire(entry)
+            self._entries.clear()
+            self._key_locks.clear()
+        self._reap(grace=0)
+
+
+SESSION_POOL = SessionPool()
@@ -0,0 +1,200 @@
+"""HTTP Range and conditional request handling for views.download.
+
+Data objects are served with a strong ETag made from their iRODS checksum and a
+Last-Modified date from the catalog. not_modified() evaluates If-None-Match and
+If-Modified-Since against them, and requested_ranges() reads the Range header,
+which is ignored when an If-Range validator no longer matches.
+
+partial_response() builds the 206 response for the ranges. One range is streamed
+from its offset; several become a multipart/byteranges body with one stream per
+range. Overlapping and adjacent ranges are merged. More than
+IRODS_DOWNLOAD_MAX_RANGES ranges are answered with the whole file instead, which
+RFC 7233 allows, because every range costs an iget.
+
+Backends that cannot open a data object at an offset (SubprocessBackend) stream
+it from the beginning and discard the bytes before the range, so resuming near
+the end of a large file costs as much as downloading all of it. With such
+backends a range starting more than IRODS_DOWNLOAD_MAX_SKIP bytes (64 MB) into
+the data object is also answered with the whole file, which at the same cost
+to iRODS at least gives the client every byte transferred.
+"""
+
+import re
+from uuid import uuid4
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+# bytes read from a stream at a time when copying a range into the response
+RANGE_CHUNK_SIZE = 64 * 1024
+
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def entity_tag(stat):
+    """Returns the quoted strong ETag of the StatResult, or None if its data object has
+    no checksum registered.
+    """
+    if not stat.checksum:
+        return None
+    return quote_etag(stat.checksum)
+
+
+def set_validators(response, etag, last_modified):
+    if etag is not None:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+
+
+def not_modified(request, etag, last_modified):
+    """Returns True if the conditional headers of the GET or HEAD request show that the
+    client's copy is current.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is present
+        if etag is None:
+            return False
+        tags = parse_etags(if_none_match)
+        return '*' in tags or parse_etags(etag)[0] in tags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date_safe(if_modified_since)
+        return since is not None and int(last_modified) <= since
+    return False
+
+
+def not_modified_response(etag, last_modified):
+    response = HttpResponse(status=304)
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def parse_range(header, size):
+    """Returns the sorted, merged (first, last) byte positions requested by the Range
+    header for a file of size bytes, [] if none of them can be satisfied, or None if the
+    header is missing, empty or malformed and the whole file is to be sent.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [spec for spec in specs.split(',') if spec.strip()]
+    if not specs:
+        return None
+    ranges = []
+    for spec in specs:
+        match = _RANGE_SPEC.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if not first:
+            if not last:
+                return None
+            # suffix range: the last bytes of the file
+            if int(last) > 0 and size > 0:
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        if last and int(last) < int(first):
+            return None
+        if int(first) < size:
+            ranges.append((int(first), min(int(last), size - 1) if last else size - 1))
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges):
+    """Returns the (first, last) ranges sorted, with overlapping and adjacent ones merged.
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def requested_ranges(request, size, etag, last_modified, seekable=True):
+    """Returns the ranges of the request as parse_range() does, or None if the whole file
+    is to be sent because If-Range does not match, there are too many ranges, or the
+    streams cannot be opened at an offset (not seekable) and a range starts too far in.
+    """
+    ranges = parse_range(request.META.get('HTTP_RANGE'), size)
+    if ranges is None:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+    if if_range:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # If-Range needs the strong comparison
+            if etag is None or if_range != etag:
+                return None
+        elif last_modified is None or parse_http_date_safe(if_range) != int(last_modified):
+            return None
+    if len(ranges) > getattr(settings, 'IRODS_DOWNLOAD_MAX_RANGES', 8):
+        return None
+    max_skip = getattr(settings, 'IRODS_DOWNLOAD_MAX_SKIP', 64 * 1024 * 1024)
+    if not seekable and ranges and max_skip is not None and ranges[-1][0] > max_skip:
+        return None
+    return ranges
+
+
+def unsatisfiable_response(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = 'bytes */{}'.format(size)
+    return response
+
+
+def _read_range(open_stream, first, last, chunk_size):
+    """Yields bytes first to last of the stream open_stream(first) returns, closing it as
+    soon as they are read so that the rest of the data object is never transferred.
+    """
+    stream = open_stream(first)
+    remaining = last - first + 1
+    try:
+        while remaining > 0:
+            chunk = stream.read(min(remaining, chunk_size))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+
+def _multipart(open_stream, parts, boundary, chunk_size):
+    for header, first, last in parts:
+        yield header
+        for chunk in _read_range(open_stream, first, last, chunk_size):
+            yield chunk
+        yield '\r\n'
+    yield '--{}--\r\n'.format(boundary)
+
+
+def partial_response(open_stream, ranges, size, content_type, chunk_size=RANGE_CHUNK_SIZE):
+    """Returns the 206 response with the non-empty list of ranges of a file of size bytes.
+
+    :param open_stream: callable returning a stream of the file from the given offset on
+    :param chunk_size: bytes read from the streams at a time
+    """
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        response = StreamingHttpResponse(_read_range(open_stream, first, last, chunk_size),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+        response['Content-Length'] = last - first + 1
+        return response
+    boundary = uuid4().hex
+    parts = [('--{boundary}\r\nContent-Type: {type}\r\n'
+              'Content-Range: bytes {first}-{last}/{size}\r\n\r\n'.format(
+                  boundary=boundary, type=content_type, first=first, last=last, size=size),
+              first, last) for first, last in ranges]
+    length = sum(len(header) + last - first + 1 + 2 for header, first, last in parts) + \
+        len('--{}--\r\n'.format(boundary))
+    response = StreamingHttpResponse(
+        _multipart(open_stream, parts, boundary, chunk_size), status=206,
+        content_type='multipart/byteranges; boundary={}'.format(boundary))
+    response['Content-Length'] = length
+    return response
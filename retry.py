@@ -0,0 +1,184 @@
+"""Retry policies for idempotent icommands.
+
+A RetryPolicy classifies a failed icommand from its exit code and output into
+fatal errors, which are reported at once, and transient ones, which are retried
+with exponential backoff and full jitter until max_attempts or max_elapsed
+seconds (or the deadline of the call) run out. Errors matching neither list are
+retried only if retry_unknown is set, which is the default because iRODS
+sometimes fails the first iput for no reported reason.
+
+    session.run('imkdir', None, '-p', path, retry=retry.default_policy())
+
+max_attempts and max_elapsed bound a single call. During an iRODS outage every
+call still retries up to them, so the policies returned by default_policy()
+also share a RetryBudget, a token bucket that every retry takes a token from.
+Once a burst of retries has emptied it, the process retries no more often than
+it refills and failures are reported at once. IRODS_RETRY_BUDGET sets its
+capacity and refill_rate (tokens per second), or disables it when set to None.
+The bucket is kept per process.
+
+Only pass a policy for commands that are safe to repeat, e.g. iput -f,
+imkdir -p, imeta set and ils.
+"""
+
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from django_irods.icommands import TIMEOUT_EXITCODE
+
+# errors that will not go away by trying again
+FATAL_ERRORS = (
+    'USER_FILE_DOES_NOT_EXIST',
+    'does not exist',
+    'CAT_NO_ROWS_FOUND',
+    'CAT_NO_ACCESS_PERMISSION',
+    'CAT_UNKNOWN_COLLECTION',
+    'CAT_UNKNOWN_FILE',
+    'CAT_NAME_EXISTS_AS_COLLECTION',
+    'CAT_NAME_EXISTS_AS_DATAOBJ',
+    'CAT_INVALID_ARGUMENT',
+    'CAT_INVALID_AUTHENTICATION',
+    'CAT_PASSWORD_EXPIRED',
+    'OVERWRITE_WITHOUT_FORCE_FLAG',
+    'USER_INPUT_PATH_ERR',
+    'USER_INPUT_OPTION_ERR',
+    'SYS_NOT_ALLOWED',
+)
+
+# errors caused by network, server load or other transient conditions
+RETRYABLE_ERRORS = (
+    'SYS_SOCK_',
+    'SYS_HEADER_READ_LEN_ERR',
+    'SYS_HEADER_WRITE_LEN_ERR',
+    'SYS_AGENT_INIT_ERR',
+    'SYS_CONNECT_CONTROL_CONFIG_ERR',
+    'SYS_OUT_OF_FILE_DESC',
+    'CAT_SQL_ERR',
+    'connectToRhost',
+    'Connection refused',
+    'Connection reset',
+    'timed out',
+)
+
+FATAL = 'fatal'
+RETRYABLE = 'retryable'
+
+
+class RetryBudget(object):
+    """Thread-safe token bucket limiting the retries of the policies sharing it.
+    """
+    def __init__(self, capacity=20, refill_rate=2.0):
+        """
+        :param capacity: tokens the bucket holds, i.e. the retries a burst may make
+        :param refill_rate: tokens added per second
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token and returns True, or returns False if the bucket is empty.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.refill_rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=10.0, max_elapsed=30.0,
+                 retry_unknown=True, fatal_errors=FATAL_ERRORS,
+                 retryable_errors=RETRYABLE_ERRORS, retry_budget=None, budget=None):
+        """
+        :param max_attempts: total number of attempts, including the first one
+        :param base_delay: upper bound in seconds of the first backoff delay, doubled
+        on every further attempt
+        :param max_delay: cap in seconds of any single backoff delay
+        :param max_elapsed: seconds after the first attempt of a call started beyond
+        which the call starts no retry
+        :param retry_unknown: whether errors matching no pattern are retried
+        :param retry_budget: None or a RetryBudget every retry must take a token from
+        :param budget: former name of max_elapsed
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed if budget is None else budget
+        self.retry_unknown = retry_unknown
+        self.retry_budget = retry_budget
+        self.fatal_errors = fatal_errors
+        self.retryable_errors = retryable_errors
+
+    def classify(self, returncode, stdout, stderr):
+        """Returns FATAL or RETRYABLE for a failed icommand.
+        """
+        if returncode == TIMEOUT_EXITCODE:
+            return RETRYABLE
+        if returncode in (126, 127):  # icommand binary not executable or not found
+            return FATAL
+        output = (stdout or '') + (stderr or '')
+        if any(error in output for error in self.fatal_errors):
+            return FATAL
+        if any(error in output for error in self.retryable_errors):
+            return RETRYABLE
+        return RETRYABLE if self.retry_unknown else FATAL
+
+    def next_delay(self, attempt, returncode, stdout, stderr, elapsed, remaining=None):
+        """Returns the seconds to wait before retrying after the given failed attempt
+        (counted from 1), or None if the failure must be reported.
+
+        elapsed is the time since the first attempt started and remaining the time
+        left before the call's deadline, if any.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        if self.classify(returncode, stdout, stderr) == FATAL:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if elapsed + delay > self.max_elapsed:
+            return None
+        if remaining is not None and delay >= remaining:
+            return None
+        # taken last, so that only retries actually made use up the budget
+        if self.retry_budget is not None and not self.retry_budget.acquire():
+            return None
+        return delay
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+_retry_budget = None
+_retry_budget_lock = threading.Lock()
+
+
+def get_retry_budget():
+    """Returns the process-wide RetryBudget configured by IRODS_RETRY_BUDGET, a dict of
+    RetryBudget keyword arguments, or None if it is set to None.
+    """
+    global _retry_budget
+    options = getattr(settings, 'IRODS_RETRY_BUDGET', {})
+    if options is None:
+        return None
+    with _retry_budget_lock:
+        if _retry_budget is None:
+            _retry_budget = RetryBudget(**options)
+        return _retry_budget
+
+
+def default_policy():
+    """Returns the policy for idempotent operations configured by IRODS_RETRY_POLICY,
+    a dict of RetryPolicy keyword arguments, sharing the process-wide retry budget.
+    """
+    options = dict(getattr(settings, 'IRODS_RETRY_POLICY', {}))
+    options.setdefault('retry_budget', get_retry_budget())
+    return RetryPolicy(**options)
@@ -0,0 +1,143 @@
+"""Single-flight coalescing of the Celery tasks building bags and zips.
+
+Concurrent downloads needing the same bag or zip share one build:
+
+    key = flight_key(res_id, input_path, version)
+    task_id = in_flight(key, create_temp_zip)
+    if task_id is None:
+        task_id, started = start(key, lambda task_id: create_temp_zip.apply_async(
+            args, task_id=task_id))
+
+The task id of a running build is kept under its key in the Django cache named by
+IRODS_SINGLE_FLIGHT_CACHE ('default'), and requests for the same key attach to
+it. Cache add() makes sure only one request starts the task, also across worker
+processes. Once the task is done, in_flight() clears the key, so the caller can
+decide whether to reuse the result or build again.
+
+A task id stays PENDING while its task is queued, but also forever if the task
+was lost, e.g. because the broker dropped it. Keys are therefore added for
+IRODS_SINGLE_FLIGHT_PENDING_TTL seconds (600) and only extended to
+IRODS_SINGLE_FLIGHT_TTL seconds (3600) once the result backend reports another
+state. Running builds are only reported as STARTED with CELERY_TRACK_STARTED
+enabled; without it a build taking longer than the pending TTL may be started a
+second time. A key whose task never finishes, e.g. because its worker died,
+expires after IRODS_SINGLE_FLIGHT_TTL seconds.
+
+Requests that build synchronously, in the web worker, wait for a task in flight
+with wait() and run their own build through run(), which lets one request at a
+time build for a key while the others wait for it:
+
+    task_id = in_flight(key, create_bag_by_irods)
+    if task_id is not None:
+        status = wait(key, create_bag_by_irods, task_id)
+    else:
+        status = run(key, build)
+
+version identifies the content being built, such as an IrodsStorage.fingerprint()
+of the input collection, so that a changed collection never attaches to a build
+of its previous content.
+"""
+
+import hashlib
+import time
+from uuid import uuid4
+
+from django.conf import settings
+
+KEY_PREFIX = 'django_irods:flight:'
+
+# seconds between checks of a build another request is waiting for
+POLL_INTERVAL = 1
+
+
+def _cache():
+    from django.core.cache import caches
+    return caches[getattr(settings, 'IRODS_SINGLE_FLIGHT_CACHE', 'default')]
+
+
+def flight_key(resource_id, input_path, version=''):
+    parts = (x if isinstance(x, bytes) else x.encode('utf-8')
+             for x in (resource_id, input_path, version or ''))
+    return KEY_PREFIX + hashlib.md5(b'\0'.join(parts)).hexdigest()
+
+
+def in_flight(key, task):
+    """Returns the id of the task of the celery task class running for key, or None if
+    there is none.
+    """
+    cache = _cache()
+    task_id = cache.get(key)
+    if task_id is None:
+        return None
+    result = task.AsyncResult(task_id)
+    if result.ready():
+        # a finished build; only clear the key if no new one replaced it meanwhile
+        if cache.get(key) == task_id:
+            cache.delete(key)
+        return None
+    if result.state != 'PENDING' and cache.get(key) == task_id:
+        # known to the result backend, so not lost; keep the key for the full TTL
+        cache.set(key, task_id, getattr(settings, 'IRODS_SINGLE_FLIGHT_TTL', 3600))
+    return task_id
+
+
+def wait(key, task, task_id):
+    """Waits for the task in flight for key under task_id to finish and returns its
+    result, or None if it failed or its key expired first because the task was lost.
+    """
+    while in_flight(key, task) == task_id:
+        time.sleep(POLL_INTERVAL)
+    result = task.AsyncResult(task_id)
+    return result.result if result.successful() else None
+
+
+def run(key, build):
+    """Returns build() called in this request, unless another request is running a
+    build for key through run(). Then waits for that build and returns its result, or
+    builds after all if the other request died before it finished.
+    """
+    cache = _cache()
+    lock_key = key + ':local'
+    ttl = getattr(settings, 'IRODS_SINGLE_FLIGHT_TTL', 3600)
+    while True:
+        holder = str(uuid4())
+        if cache.add(lock_key, holder, ttl):
+            try:
+                result = build()
+                # waiters read it within a POLL_INTERVAL of the lock being released
+                cache.set(lock_key + ':' + holder, result, 60)
+                return result
+            finally:
+                if cache.get(lock_key) == holder:
+                    cache.delete(lock_key)
+        holder = cache.get(lock_key)
+        while holder is not None and cache.get(lock_key) == holder:
+            time.sleep(POLL_INTERVAL)
+        if holder is not None:
+            result = cache.get(lock_key + ':' + holder)
+            if result is not None:
+                return result
+
+
+def start(key, launch):
+    """Calls launch(task_id) to start the task for key under a new task id unless another
+    request just started one, and returns (task id, whether this call started it).
+    """
+    cache = _cache()
+    ttl = getattr(settings, 'IRODS_SINGLE_FLIGHT_PENDING_TTL', 600)
+    for _ in range(3):
+        task_id = str(uuid4())
+        if cache.add(key, task_id, ttl):
+            try:
+                launch(task_id)
+            except Exception:
+                cache.delete(key)
+                raise
+            return task_id, True
+        current = cache.get(key)
+        if current is not None:
+            return current, False
+        # the key expired or was cleared between add() and get(); try again
+    task_id = str(uuid4())
+    launch(task_id)
+    return task_id, True
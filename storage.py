@@ -1,4 +1,12 @@
+import base64
+import hashlib
 import os
+import posixpath
+import tarfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
 from tempfile import NamedTemporaryFile
 from uuid import uuid4
 
@@ -7,14 +15,113 @@ from django.conf import settings
 from django.core.files.storage import Storage
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 from django_irods import icommands
-from icommands import Session, GLOBAL_SESSION, GLOBAL_ENVIRONMENT, SessionException, IRodsEnv
+from django_irods.batch import WriteBatch
+from django_irods.cache import get_metadata_cache
+from django_irods.files import IrodsFile
+from django_irods.pool import SESSION_POOL
+from django_irods.retry import default_policy
+from django_irods.transfer import CopyEngine
+from icommands import GLOBAL_SESSION, GLOBAL_ENVIRONMENT, SessionException, IRodsEnv
+
+
+# delimiters of the iquest output fields and rows; control characters not expected in
+# iRODS names and metadata
+IQUEST_FIELD_SEP = '\x1f'
+IQUEST_ROW_SEP = '\x1e'
+# maximum number of values in one GenQuery "in" condition
+IQUEST_IN_LIMIT = 256
+
+
+# the columns of data object queries, in the order of the StatResult fields
+DATA_OBJECT_COLUMNS = ['COLL_NAME', 'DATA_NAME', 'DATA_SIZE', 'DATA_CHECKSUM', 'DATA_RESC_NAME',
+                       'DATA_REPL_NUM', 'DATA_CREATE_TIME', 'DATA_MODIFY_TIME']
+# default number of entries returned by IrodsStorage.listdir_page()
+LISTDIR_PAGE_SIZE = 1000
+
+# result of IrodsStorage.stat(). created and modified are in seconds since the epoch; for
+# data objects with several replicas, the fields are those of the most recently modified
+# replica and replicas is their number
+StatResult = namedtuple('StatResult', ['path', 'is_collection', 'size', 'checksum', 'resource',
+                                       'replicas', 'created', 'modified'])
+
+
+# result of IrodsStorage.collection_usage(): total bytes and number of data objects in
+# collection path, and for a recursive query the totals of each of its subcollections
+# (including theirs), by subcollection name. Replicas are counted like separate objects
+UsageResult = namedtuple('UsageResult', ['path', 'size', 'count', 'subcollections'])
+
+# result of IrodsStorage.save_many() for one data object: error is None on success,
+# bundled tells whether it went up in a tar bundle rather than with its own iput
+SaveResult = namedtuple('SaveResult', ['name', 'size', 'bundled', 'error'])
+
+# maximum number of paths given to one imkdir or irm
+IMKDIR_BATCH_SIZE = 100
+# maximum number of data objects fetched by one iget
+IGET_BATCH_SIZE = 100
+
+# result of IrodsStorage.getFiles() for one data object: error is None on success
+FetchResult = namedtuple('FetchResult', ['name', 'local', 'size', 'error'])
+# summary of IrodsStorage.getFiles(): results in input order, bytes fetched successfully,
+# wall time in seconds and bytes per second
+FetchReport = namedtuple('FetchReport', ['results', 'bytes', 'elapsed', 'throughput'])
+
+
+def _iquest_args(columns, condition):
+    query = 'SELECT ' + ', '.join(columns)
+    if condition:
+        query += ' WHERE ' + condition
+    row_format = IQUEST_FIELD_SEP.join(['%s'] * len(columns)) + IQUEST_ROW_SEP
+    return '--no-page', row_format, query
+
+
+def _merge_replicas(rows):
+    """
+    generate one StatResult per data object from rows of DATA_OBJECT_COLUMNS ordered by
+    collection and data name, so that the replicas of an object are adjacent
+    """
+    current = None
+    for coll, data_name, size, checksum, resource, _, created, modified in rows:
+        path = posixpath.join(coll, data_name)
+        if current is not None and current.path == path:
+            if int(modified) > current.modified:
+                current = StatResult(path, False, int(size), checksum or None, resource,
+                                     current.replicas + 1, int(created), int(modified))
+            else:
+                current = current._replace(replicas=current.replicas + 1)
+            continue
+        if current is not None:
+            yield current
+        current = StatResult(path, False, int(size), checksum or None, resource, 1,
+                             int(created), int(modified))
+    if current is not None:
+        yield current
+
+
+def _genquery_list(values):
+    """
+    quote values for a GenQuery "in" condition. GenQuery has no way to escape quotes, so
+    names containing a single quote cannot be queried this way
+    """
+    for value in values:
+        if "'" in value:
+            raise ValueError(str.format("Cannot query iRODS for a name containing a quote: {}",
+                                        value))
+    return ', '.join("'" + value + "'" for value in values)
 
 
 @deconstructible
 class IrodsStorage(Storage):
-    def __init__(self, option=None):
+    def __init__(self, option=None, timeout=None):
+        # default timeout in seconds of the icommands run by this storage, on top of the
+        # session default; most methods also accept a timeout of their own
+        self.timeout = timeout
+        # retries of the idempotent icommands run by this storage
+        self.retry_policy = default_policy()
+        # cache of exists/size/getAVU results, None unless IRODS_METADATA_CACHE is set
+        self.metadata_cache = get_metadata_cache()
         if option == 'federated':
             # resource should be saved in federated zone
             self.set_fed_zone_session()
@@ -39,17 +146,9 @@ class IrodsStorage(Storage):
             auth=password,
             irods_default_hash_scheme='MD5'
         )
-        if sess_id is None:
-            self.session = Session(session_id=uuid4())
-            self.environment = self.session.create_environment(myEnv=userEnv)
-        else:
-            self.session = Session(session_id=sess_id)
-            if self.session.session_file_exists():
-                self.environment = userEnv
-            else:
-                self.environment = self.session.create_environment(myEnv=userEnv)
-
-        self.session.run('iinit', None, self.environment.auth)
+        # sessions are shared through the pool; sess_id only prefixes the name of the session
+        # directory when there is no pooled session for this user yet
+        self.session, self.environment = SESSION_POOL.get(userEnv, session_id=sess_id)
         icommands.ACTIVE_SESSION = self.session
 
     # Set iRODS session to wwwHydroProxy for irods_storage input object for iRODS federated
@@ -65,16 +164,149 @@ class IrodsStorage(Storage):
                                   sess_id='federated_session')
 
     def delete_user_session(self):
-        if self.session != GLOBAL_SESSION and self.session.session_file_exists():
+        # pooled sessions are reused and deleted by the pool when evicted
+        if self.session != GLOBAL_SESSION and not SESSION_POOL.owns(self.session) and \
+                self.session.session_file_exists():
             self.session.delete_environment()
 
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    def batch(self, raise_on_error=True, timeout=None):
+        """
+        return a WriteBatch context manager recording saveFile, copyFiles, moveFile, setAVU,
+        delete and mkdir operations and running them merged into few icommands when the
+        block exits; see batch.py
+        """
+        return WriteBatch(self, raise_on_error=raise_on_error, timeout=timeout)
+
+    def _abspath(self, name):
+        return posixpath.normpath(posixpath.join(self.environment.cwd or '/', name))
+
+    def _cache_scope(self):
+        return u'{}:{}'.format(self.environment.host, self.environment.zone)
+
+    def _cached(self, name, kind, compute):
+        if self.metadata_cache is None:
+            return compute()
+        return self.metadata_cache.get(self._abspath(name), kind, compute,
+                                       scope=self._cache_scope(), user=self.environment.username)
+
+    @contextmanager
+    def _modifying(self, *names, **kwargs):
+        """Invalidates the cached metadata of names and their ancestors once the block
+        exits, even when it failed part way; recursive=True also invalidates everything
+        below names.
+        """
+        try:
+            yield
+        finally:
+            if self.metadata_cache is not None:
+                for name in names:
+                    self.metadata_cache.invalidate(self._abspath(name),
+                                                   recursive=kwargs.get('recursive', False),
+                                                   scope=self._cache_scope())
+
     def download(self, name):
         return self._open(name, mode='rb')
 
-    def getFile(self, src_name, dest_name):
-        self.session.run("iget", None, '-f', src_name, dest_name)
+    def getFile(self, src_name, dest_name, timeout=None):
+        timeout = self._timeout(timeout)
+        self.session.run("iget", None, '-f', src_name, dest_name, timeout=timeout)
+
+    def getFiles(self, pairs, timeout=None, max_workers=None):
+        """
+        fetch many data objects to local files at once
+
+        Data objects of at most IRODS_FETCH_GROUP_SIZE bytes (default 1 MB) going to the
+        same local directory under their own name are fetched IGET_BATCH_SIZE at a time by
+        one iget. Larger ones get an iget each. The igets run concurrently, at most
+        max_workers (default IRODS_BATCH_MAX_WORKERS) at a time.
+
+        Parameters:
+        :param
+        pairs: list of (data object name, local file name) tuples. Missing local
+        directories are created
+        timeout: the seconds the concurrent igets may take as a whole
+        :return: a FetchReport. Failures are reported in its results rather than raised;
+        when a shared iget fails, all of its data objects are reported failed
+        """
+        pairs = list(pairs)
+        stats = self.stat([name for name, _ in pairs], timeout=timeout)
+        return self._fetch([(name, local, stats[name]) for name, local in pairs], timeout,
+                           max_workers)
+
+    def fetch_tree(self, name, local_dir, timeout=None, max_workers=None):
+        """
+        fetch collection name with everything below it into local directory local_dir,
+        listing it with walk() and fetching it as getFiles() does
+
+        :return: a FetchReport
+        """
+        root = self._abspath(name).rstrip('/') + '/'
+        entries = []
+        for entry in self.walk(name, timeout=timeout):
+            local = os.path.join(local_dir, *entry.path[len(root):].split('/'))
+            if entry.is_collection:
+                if not os.path.isdir(local):
+                    os.makedirs(local)
+            else:
+                entries.append((entry.path, local, entry))
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        return self._fetch(entries, timeout, max_workers)
+
+    def _fetch(self, entries, timeout, max_workers):
+        """
+        fetch (data object name, local file name, StatResult or None) entries and return
+        a FetchReport
+        """
+        start = time.time()
+        timeout = self._timeout(timeout)
+        group_size = getattr(settings, 'IRODS_FETCH_GROUP_SIZE', 1024 * 1024)
+        results = [None] * len(entries)
+        groups = {}
+        commands = []  # (indexes into entries, iget arguments)
+        for index, (name, local, stat) in enumerate(entries):
+            if stat is None or stat.is_collection:
+                results[index] = FetchResult(name, local, None, str.format(
+                    "ERROR: {} does not exist or is not a data object", name))
+                continue
+            directory = os.path.dirname(os.path.abspath(local))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            if stat.size <= group_size and \
+                    os.path.basename(local) == posixpath.basename(stat.path):
+                group = groups.setdefault(directory, [])
+                group.append(index)
+                if len(group) == IGET_BATCH_SIZE:
+                    commands.append((group, ['-f'] + [entries[i][0] for i in group] +
+                                     [directory]))
+                    groups[directory] = []
+            else:
+                commands.append(([index], ['-f', name, local]))
+        for directory, group in groups.items():
+            if group:
+                commands.append((group, ['-f'] + [entries[i][0] for i in group] + [directory]))
+
+        if commands:
+            try:
+                outcomes = self.session.run_many([('iget', args) for _, args in commands],
+                                                 max_workers=max_workers, timeout=timeout,
+                                                 retry=self.retry_policy)
+            except icommands.BatchException as ex:
+                outcomes = ex.results
+            for (indexes, _), outcome in zip(commands, outcomes):
+                error = (outcome.stderr or 'failed') if outcome.exitcode else None
+                for index in indexes:
+                    name, local, stat = entries[index]
+                    results[index] = FetchResult(name, local, stat.size, error)
+
+        elapsed = time.time() - start
+        fetched = sum(r.size for r in results if r.error is None)
+        return FetchReport(results, fetched, elapsed, fetched / elapsed if elapsed else 0.0)
 
-    def runBagitRule(self, rule_name, input_path, input_resource):
+    def runBagitRule(self, rule_name, input_path, input_resource, timeout=None):
         """
         run iRODS bagit rule which generated bag-releated files without bundling
         :param rule_name: the iRODS rule name to run
@@ -85,20 +317,24 @@ class IrodsStorage(Storage):
         :return: None
         """
         # SessionException will be raised from run() in icommands.py
-        self.session.run("irule", None, '-F', rule_name, input_path, input_resource)
+        self.session.run("irule", None, '-F', rule_name, input_path, input_resource,
+                         timeout=self._timeout(timeout))
 
-    def zipup(self, in_name, out_name):
+    def zipup(self, in_name, out_name, timeout=None):
         """
         run iRODS ibun command to generate zip file for the bag
         :param in_name: input parameter to indicate the collection path to generate zip
         :param out_name: the output zipped file name
         :return: None
         """
-        self.session.run("imkdir", None, '-p', out_name.rsplit('/', 1)[0])
-        # SessionException will be raised from run() in icommands.py
-        self.session.run("ibun", None, '-cDzip', '-f', out_name, in_name)
+        timeout = self._timeout(timeout)
+        with self._modifying(out_name):
+            self.session.run("imkdir", None, '-p', out_name.rsplit('/', 1)[0],
+                             timeout=timeout, retry=self.retry_policy)
+            # SessionException will be raised from run() in icommands.py
+            self.session.run("ibun", None, '-cDzip', '-f', out_name, in_name, timeout=timeout)
 
-    def setAVU(self, name, attName, attVal, attUnit=None):
+    def setAVU(self, name, attName, attVal, attUnit=None, timeout=None):
         """
         set AVU on resource collection - this is used for on-demand bagging by indicating
         whether the resource has been modified via AVU pairs
@@ -113,12 +349,16 @@ class IrodsStorage(Storage):
         """
 
         # SessionException will be raised from run() in icommands.py
-        if attUnit:
-            self.session.run("imeta", None, 'set', '-C', name, attName, attVal, attUnit)
-        else:
-            self.session.run("imeta", None, 'set', '-C', name, attName, attVal)
+        timeout = self._timeout(timeout)
+        with self._modifying(name):
+            if attUnit:
+                self.session.run("imeta", None, 'set', '-C', name, attName, attVal, attUnit,
+                                 timeout=timeout, retry=self.retry_policy)
+            else:
+                self.session.run("imeta", None, 'set', '-C', name, attName, attVal,
+                                 timeout=timeout, retry=self.retry_policy)
 
-    def getAVU(self, name, attName):
+    def getAVU(self, name, attName, timeout=None):
         """
         set AVU on resource collection - this is used for on-demand bagging by indicating
         whether the resource has been modified via AVU pairs
@@ -132,37 +372,141 @@ class IrodsStorage(Storage):
         indicate additional info
         """
 
-        # SessionException will be raised from run() in icommands.py
-        stdout = self.session.run("imeta", None, 'ls', '-C', name, attName)[0].split("\n")
-        ret_att = stdout[1].strip()
-        if ret_att == 'None':  # queried attribute does not exist
-            return None
-        else:
-            vals = stdout[2].split(":")
-            return vals[1].strip()
+        def lookup():
+            # SessionException will be raised from run() in icommands.py
+            stdout = self.session.run("imeta", None, 'ls', '-C', name, attName,
+                                      timeout=self._timeout(timeout),
+                                      retry=self.retry_policy)[0].split("\n")
+            ret_att = stdout[1].strip()
+            if ret_att == 'None':  # queried attribute does not exist
+                return None
+            else:
+                vals = stdout[2].split(":")
+                return vals[1].strip()
+
+        return self._cached(name, u'avu:' + attName, lookup)
+
+    def _iquest(self, columns, condition, timeout=None):
+        """
+        run one iquest GenQuery and return its rows
+        :param columns: list of the GenQuery columns to select, e.g. ['COLL_NAME', 'DATA_NAME']
+        :param condition: the WHERE clause of the query, or '' to select all rows
+        :return: list of tuples of the column values, as strings
+        """
+        try:
+            stdout = self.session.run("iquest", None, *_iquest_args(columns, condition),
+                                      timeout=self._timeout(timeout),
+                                      retry=self.retry_policy)[0]
+        except SessionException as ex:
+            if 'CAT_NO_ROWS_FOUND' in (ex.stdout or '') + (ex.stderr or ''):
+                return []
+            raise
+        rows = []
+        for line in stdout.split(IQUEST_ROW_SEP + '\n'):
+            fields = line.split(IQUEST_FIELD_SEP)
+            if len(fields) == len(columns):
+                rows.append(tuple(fields))
+        return rows
+
+    def _iquest_stream(self, columns, condition, timeout=None):
+        """
+        run one iquest GenQuery and yield its rows as iquest prints them, so that memory
+        use does not depend on the number of rows; see _iquest()
+        """
+        stream = self.session.stream("iquest", *_iquest_args(columns, condition),
+                                     timeout=timeout)
+        separator = IQUEST_ROW_SEP + '\n'
+        pending = ''
+        found = False
+        try:
+            for chunk in stream:
+                lines = (pending + chunk).split(separator)
+                pending = lines.pop()
+                for line in lines:
+                    fields = line.split(IQUEST_FIELD_SEP)
+                    if len(fields) == len(columns):
+                        found = True
+                        yield tuple(fields)
+        except SessionException as ex:
+            if found or 'CAT_NO_ROWS_FOUND' not in pending + (ex.stderr or ''):
+                raise
+        finally:
+            stream.close()
+
+    def getAVUs(self, name, attNames=None, timeout=None):
+        """
+        get AVUs of one or many collections with a single iquest query per
+        IQUEST_IN_LIMIT collections
+
+        Parameters:
+        :param
+        name: the collection name, or a list of collection names
+        attNames: the attribute names to return, default is None for all attributes
+        :return: dict of attribute name -> (value, unit) for a single collection name, or
+        dict of collection name -> such dict for a list of names. Unit is None when not set
+        """
+        if isinstance(name, basestring):
+            kind = u'avus:' + (u'\0'.join(sorted(attNames)) if attNames is not None else u'*')
+            return self._cached(name, kind,
+                                lambda: self.getAVUs([name], attNames, timeout=timeout)[name])
+
+        names = list(name)
+        paths = dict((n, self._abspath(n)) for n in names)
+        avus = dict((path, {}) for path in paths.values())
+        path_list = sorted(avus)
+        for i in range(0, len(path_list), IQUEST_IN_LIMIT):
+            condition = 'COLL_NAME in ({})'.format(_genquery_list(path_list[i:i + IQUEST_IN_LIMIT]))
+            if attNames is not None:
+                condition += ' and META_COLL_ATTR_NAME in ({})'.format(
+                    _genquery_list(attNames))
+            rows = self._iquest(['COLL_NAME', 'META_COLL_ATTR_NAME', 'META_COLL_ATTR_VALUE',
+                                 'META_COLL_ATTR_UNITS'], condition, timeout=timeout)
+            for coll, attName, attVal, attUnit in rows:
+                if coll in avus:
+                    avus[coll][attName] = (attVal, attUnit or None)
+        return dict((n, avus[paths[n]]) for n in names)
 
-    def copyFiles(self, src_name, dest_name, ires=None):
+    def getAllAVUs(self, name, timeout=None):
+        """
+        get all AVUs of one or many collections; see getAVUs()
+        """
+        return self.getAVUs(name, timeout=timeout)
+
+    def copyFiles(self, src_name, dest_name, ires=None, timeout=None, workers=None,
+                  journal=None, progress=None):
         """
         Parameters:
         :param
         src_name: the iRODS data-object or collection name to be copied from.
         dest_name: the iRODS data-object or collection name to be copied to
+        workers, journal, progress: if any is given and src_name is a collection, it is
+        copied by a transfer.CopyEngine with that many concurrent icp, resumable through
+        the local journal file and reporting to the progress callable, and its CopyResult
+        is returned; dest_name then becomes the copy of src_name
         copyFiles() copied an irods data-object (file) or collection (directory)
         to another data-object or collection
         """
-
+        timeout = self._timeout(timeout)
+        if src_name and dest_name and (workers or journal or progress):
+            entry = self.stat(src_name, timeout=timeout)
+            if entry is not None and entry.is_collection:
+                return CopyEngine(self, src_name, dest_name, workers=workers, journal=journal,
+                                  progress=progress, ires=ires, timeout=timeout).run()
         if src_name and dest_name:
-            if '/' in dest_name:
-                splitstrs = dest_name.rsplit('/', 1)
-                if not self.exists(splitstrs[0]):
-                    self.session.run("imkdir", None, '-p', splitstrs[0])
-            if ires:
-                self.session.run("icp", None, '-rf', '-R', ires, src_name, dest_name)
-            else:
-                self.session.run("icp", None, '-rf', src_name, dest_name)
+            with self._modifying(dest_name, recursive=True):
+                if '/' in dest_name:
+                    splitstrs = dest_name.rsplit('/', 1)
+                    if not self.exists(splitstrs[0], timeout=timeout):
+                        self.session.run("imkdir", None, '-p', splitstrs[0], timeout=timeout,
+                                         retry=self.retry_policy)
+                if ires:
+                    self.session.run("icp", None, '-rf', '-R', ires, src_name, dest_name,
+                                     timeout=timeout)
+                else:
+                    self.session.run("icp", None, '-rf', src_name, dest_name, timeout=timeout)
         return
 
-    def moveFile(self, src_name, dest_name):
+    def moveFile(self, src_name, dest_name, timeout=None):
         """
         Parameters:
         :param
@@ -171,15 +515,19 @@ class IrodsStorage(Storage):
         moveFile() moves/renames an irods data-object (file) or collection
         (directory) to another data-object or collection
         """
+        timeout = self._timeout(timeout)
         if src_name and dest_name:
-            if '/' in dest_name:
-                splitstrs = dest_name.rsplit('/', 1)
-                if not self.exists(splitstrs[0]):
-                    self.session.run("imkdir", None, '-p', splitstrs[0])
-            self.session.run("imv", None, src_name, dest_name)
+            with self._modifying(src_name, dest_name, recursive=True):
+                if '/' in dest_name:
+                    splitstrs = dest_name.rsplit('/', 1)
+                    if not self.exists(splitstrs[0], timeout=timeout):
+                        self.session.run("imkdir", None, '-p', splitstrs[0], timeout=timeout,
+                                         retry=self.retry_policy)
+                self.session.run("imv", None, src_name, dest_name, timeout=timeout)
         return
 
-    def saveFile(self, from_name, to_name, create_directory=False, data_type_str=''):
+    def saveFile(self, from_name, to_name, create_directory=False, data_type_str='',
+                 timeout=None):
         """
         Parameters:
         :param
@@ -189,76 +537,570 @@ class IrodsStorage(Storage):
         Note if only directory needs to be created without saving a file, from_name should be empty
         and to_name should have "/" as the last character
         """
-        if create_directory:
-            splitstrs = to_name.rsplit('/', 1)
-            self.session.run("imkdir", None, '-p', splitstrs[0])
-            if len(splitstrs) <= 1:
-                return
+        timeout = self._timeout(timeout)
+        with self._modifying(to_name):
+            if create_directory:
+                splitstrs = to_name.rsplit('/', 1)
+                self.session.run("imkdir", None, '-p', splitstrs[0], timeout=timeout,
+                                 retry=self.retry_policy)
+                if len(splitstrs) <= 1:
+                    return
 
-        if from_name:
-            try:
-                if data_type_str:
-                    self.session.run("iput", None, '-D', data_type_str, '-f', from_name, to_name)
-                else:
-                    self.session.run("iput", None, '-f', from_name, to_name)
-            except:
+            if from_name:
+                # iput -f is idempotent; IRODS 4.0.2 sometimes fails it on the first try
                 if data_type_str:
-                    self.session.run("iput", None, '-D', data_type_str, '-f', from_name, to_name)
+                    self.session.run("iput", None, '-D', data_type_str, '-f', from_name,
+                                     to_name, timeout=timeout, retry=self.retry_policy)
                 else:
-                    # IRODS 4.0.2, sometimes iput fails on the first try.
-                    # A second try seems to fix it.
-                    self.session.run("iput", None, '-f', from_name, to_name)
+                    self.session.run("iput", None, '-f', from_name, to_name, timeout=timeout,
+                                     retry=self.retry_policy)
         return
 
-    def _open(self, name, mode='rb'):
-        tmp = NamedTemporaryFile()
-        self.session.run("iget", None, '-f', name, tmp.name)
-        return tmp
+    def save_many(self, mapping, timeout=None):
+        """
+        upload many local files at once
 
-    def _save(self, name, content):
-        self.session.run("imkdir", None, '-p', name.rsplit('/', 1)[0])
-        with NamedTemporaryFile(delete=False) as f:
-            for chunk in content.chunks():
-                f.write(chunk)
-            f.flush()
-            f.close()
+        Files of at most IRODS_BUNDLE_FILE_SIZE bytes (default 1 MB) are bundled into one
+        local tar file when there are at least IRODS_BUNDLE_MIN_FILES (default 10) of them.
+        The tar is uploaded with a single iput and extracted in iRODS with ibun -x, then
+        removed. The other files are uploaded with concurrent iput -f, at most
+        IRODS_BATCH_MAX_WORKERS at a time. The collections needed are created first with
+        a few imkdir -p calls.
+
+        Parameters:
+        :param
+        mapping: dict of data object name -> local file name
+        timeout: the seconds each icommand, or the concurrent iputs as a whole, may take
+        :return: dict of data object name -> SaveResult. Failures are reported there
+        rather than raised, including local files that cannot be read, whose size is None;
+        when the bundle fails, all files in it are reported failed
+        """
+        timeout = self._timeout(timeout)
+        results = {}
+        sizes = {}
+        for name, local in mapping.items():
+            try:
+                sizes[name] = os.path.getsize(local)
+            except OSError as ex:
+                results[name] = SaveResult(name, None, False, str(ex))
+        mapping = dict((name, local) for name, local in mapping.items() if name in sizes)
+        paths = dict((name, self._abspath(name)) for name in mapping)
+        small = [name for name in mapping
+                 if sizes[name] <= getattr(settings, 'IRODS_BUNDLE_FILE_SIZE', 1024 * 1024)]
+        if len(small) < getattr(settings, 'IRODS_BUNDLE_MIN_FILES', 10):
+            small = []
+        small_set = set(small)
+        single = [name for name in mapping if name not in small_set]
+        if not mapping:
+            return results
+        with self._modifying(*paths.values()):
+            collections = sorted(set(posixpath.dirname(path) for path in paths.values()))
             try:
-                self.session.run("iput", None, '-f', f.name, name)
-            except:
-                # IRODS 4.0.2, sometimes iput fails on the first try. A second try seems to fix it.
-                self.session.run("iput", None, '-f', f.name, name)
-            os.unlink(f.name)
+                for i in range(0, len(collections), IMKDIR_BATCH_SIZE):
+                    self.session.run("imkdir", None, '-p',
+                                     *collections[i:i + IMKDIR_BATCH_SIZE],
+                                     timeout=timeout, retry=self.retry_policy)
+            except SessionException as ex:
+                results.update((name, SaveResult(name, sizes[name], False, ex.stderr))
+                               for name in mapping)
+                return results
+
+            if small:
+                error = self._save_bundle(dict((paths[name], mapping[name]) for name in small),
+                                          timeout)
+                for name in small:
+                    results[name] = SaveResult(name, sizes[name], True, error)
+
+            if single:
+                puts = [('iput', ['-f', mapping[name], paths[name]]) for name in single]
+                try:
+                    outcomes = self.session.run_many(puts, timeout=timeout,
+                                                     retry=self.retry_policy)
+                except icommands.BatchException as ex:
+                    outcomes = ex.results
+                for name, outcome in zip(single, outcomes):
+                    error = (outcome.stderr or 'failed') if outcome.exitcode else None
+                    results[name] = SaveResult(name, sizes[name], False, error)
+        return results
+
+    def _save_bundle(self, files, timeout):
+        """
+        upload files, a dict of absolute data object name -> local file name, as one tar
+        extracted below their deepest common collection. Returns None on success or the
+        error message; the local and the uploaded tar are removed in any case. When the
+        extraction fails, the data objects it created are removed again
+        """
+        split = [posixpath.dirname(path).split('/') for path in files]
+        root = []
+        for parts in zip(*split):
+            if len(set(parts)) > 1:
+                break
+            root.append(parts[0])
+        root = '/'.join(root) or '/'
+        bundle = posixpath.join(root, '.bundle-{}.tar'.format(uuid4().hex))
+        tmp = NamedTemporaryFile(suffix='.tar', delete=False)
+        try:
+            with tarfile.open(fileobj=tmp, mode='w') as tar:
+                for path, local in files.items():
+                    tar.add(local, arcname=posixpath.relpath(path, root), recursive=False)
+            tmp.close()
+            self.session.run("iput", None, '-f', '-D', 'tar file', tmp.name, bundle,
+                             timeout=timeout, retry=self.retry_policy)
+            try:
+                existing = self.stat(list(files), timeout=timeout)
+                try:
+                    self.session.run("ibun", None, '-x', '-f', bundle, root, timeout=timeout)
+                except SessionException:
+                    self._remove_extracted([path for path in files if existing[path] is None],
+                                           timeout)
+                    raise
+            finally:
+                self.session.run("irm", None, '-f', bundle, timeout=timeout)
+        except SessionException as ex:
+            return ex.stderr or 'failed'
+        finally:
+            tmp.close()
+            os.unlink(tmp.name)
+        return None
+
+    def _remove_extracted(self, paths, timeout):
+        """
+        remove the data objects of paths a failed ibun -x created, keeping the error of
+        the extraction rather than one of the removal
+        """
+        try:
+            created = [path for path, stat in self.stat(paths, timeout=timeout).items()
+                       if stat is not None]
+            for i in range(0, len(created), IMKDIR_BATCH_SIZE):
+                self.session.run("irm", None, '-f', *created[i:i + IMKDIR_BATCH_SIZE],
+                                 timeout=timeout)
+        except SessionException:
+            pass
+
+    def _open(self, name, mode='rb', spool_threshold=None):
+        """
+        open data object name for reading. Nothing is fetched until the file is read, and
+        then the data object is streamed; see files.py. spool_threshold defaults to the
+        IRODS_OPEN_SPOOL_THRESHOLD setting
+        """
+        if any(c in mode for c in 'wa+'):
+            # writing was never sent back to iRODS; keep handing out a local copy
+            tmp = NamedTemporaryFile()
+            self.session.run("iget", None, '-f', name, tmp.name, timeout=self.timeout)
+            return tmp
+        if spool_threshold is None:
+            spool_threshold = getattr(settings, 'IRODS_OPEN_SPOOL_THRESHOLD', None)
+        return IrodsFile(self, name, mode=mode, spool_threshold=spool_threshold)
+
+    def _save(self, name, content):
+        with self._modifying(name):
+            self.session.run("imkdir", None, '-p', name.rsplit('/', 1)[0],
+                             timeout=self.timeout, retry=self.retry_policy)
+            # checksums are computed as the chunks go by, in the server's two schemes
+            md5, sha256 = hashlib.md5(), hashlib.sha256()
+            # streamed to a temporary data object, so that a failed read or a checksum
+            # mismatch leaves the previous content of name in place
+            parent, slash, base = name.rpartition('/')
+            tmp_name = parent + slash + '.upload-{}-{}'.format(uuid4().hex, base)
+            upload = self.session.open_upload(tmp_name)
+            if upload is not None:
+                # the backend writes the data object directly, without a local copy
+                try:
+                    with upload:
+                        for chunk in content.chunks():
+                            md5.update(chunk)
+                            sha256.update(chunk)
+                            upload.write(chunk)
+                    self._verify_upload(tmp_name, md5, sha256)
+                    try:
+                        # imv does not replace an existing data object
+                        self.session.run("irm", None, '-f', name, timeout=self.timeout)
+                    except SessionException:
+                        pass  # there was none; a real failure shows in imv
+                    self.session.run("imv", None, tmp_name, name, timeout=self.timeout)
+                except Exception:
+                    try:
+                        self.session.run("irm", None, '-f', tmp_name, timeout=self.timeout)
+                    except SessionException:
+                        pass
+                    raise
+            else:
+                with NamedTemporaryFile(delete=False) as f:
+                    try:
+                        for chunk in content.chunks():
+                            md5.update(chunk)
+                            sha256.update(chunk)
+                            f.write(chunk)
+                        f.flush()
+                        f.close()
+                        # iput -f is idempotent; IRODS 4.0.2 sometimes fails it on the
+                        # first try
+                        self.session.run("iput", None, '-f', f.name, name,
+                                         timeout=self.timeout, retry=self.retry_policy)
+                    finally:
+                        os.unlink(f.name)
+                self._verify_upload(name, md5, sha256)
         return name
 
-    def delete(self, name):
-        self.session.run("irm", None, "-rf", name)
+    def _verify_upload(self, name, md5, sha256):
+        if getattr(settings, 'IRODS_VERIFY_UPLOADS', True):
+            self._verify_checksum(name, md5, sha256)
+
+    def _verify_checksum(self, name, md5, sha256):
+        """
+        compare the checksum iRODS has for data object name, computing it if not yet
+        registered, with the hashes of the uploaded content, which were computed as it
+        was read so that the data is not read a second time
+        """
+        stdout = self.session.run("ichksum", None, name, timeout=self.timeout,
+                                  retry=self.retry_policy)[0]
+        lines = [line for line in stdout.splitlines()
+                 if line.strip() and not line.startswith('Total checksum')]
+        checksum = lines[0].split()[-1] if lines else ''
+        if checksum.startswith('sha2:'):
+            expected = 'sha2:' + base64.b64encode(sha256.digest())
+        else:
+            expected = md5.hexdigest()
+        if checksum != expected:
+            raise SessionException(-1, stdout, str.format(
+                "ERROR: checksum mismatch for {}: iRODS has {}, uploaded {}",
+                name, checksum, expected))
+
+    def delete(self, name, timeout=None):
+        with self._modifying(name, recursive=True):
+            self.session.run("irm", None, "-rf", name, timeout=self._timeout(timeout))
+
+    def stat(self, name, timeout=None):
+        """
+        get the catalog information of data objects and collections with one iquest query
+        for the data objects and one for the remaining paths, per IQUEST_IN_LIMIT paths
+
+        Parameters:
+        :param
+        name: the data object or collection name, or a list of names
+        :return: a StatResult, or None if the path does not exist, for a single name, or a
+        dict of name -> StatResult or None for a list of names
+        """
+        if isinstance(name, basestring):
+            return self._cached(name, 'stat', lambda: self.stat([name], timeout=timeout)[name])
+
+        names = list(name)
+        paths = dict((n, self._abspath(n)) for n in names)
+        found = {}
+        pending = sorted(set(paths.values()))
+        for i in range(0, len(pending), IQUEST_IN_LIMIT):
+            found.update(self._stat_data_objects(pending[i:i + IQUEST_IN_LIMIT], timeout))
+        pending = [path for path in pending if path not in found]
+        for i in range(0, len(pending), IQUEST_IN_LIMIT):
+            found.update(self._stat_collections(pending[i:i + IQUEST_IN_LIMIT], timeout))
+        return dict((n, found.get(paths[n])) for n in names)
+
+    def _stat_query(self, columns, condition_by_column, paths, timeout):
+        # GenQuery cannot escape quotes, so paths containing one are looked up on their own
+        # with "like", in which "_" matches the quote; callers filter the rows by exact path
+        plain = [path for path in paths if "'" not in path]
+        rows = []
+        if plain:
+            rows.extend(self._iquest(columns, condition_by_column(plain, False), timeout))
+        for path in paths:
+            if "'" in path:
+                rows.extend(self._iquest(columns, condition_by_column([path], True), timeout))
+        return rows
+
+    def _stat_data_objects(self, paths, timeout=None):
+        def condition(paths, like):
+            colls = sorted(set(posixpath.dirname(p) for p in paths))
+            data_names = sorted(set(posixpath.basename(p) for p in paths))
+            if like:
+                return "COLL_NAME like '{}' and DATA_NAME like '{}'".format(
+                    colls[0].replace("'", '_'), data_names[0].replace("'", '_'))
+            return 'COLL_NAME in ({}) and DATA_NAME in ({})'.format(
+                _genquery_list(colls), _genquery_list(data_names))
+
+        wanted = set(paths)
+        found = {}
+        seen = set()
+        rows = self._stat_query(DATA_OBJECT_COLUMNS, condition, paths, timeout)
+        for coll, data_name, size, checksum, resource, replica, created, modified in rows:
+            path = posixpath.join(coll, data_name)
+            if path not in wanted or (path, replica) in seen:
+                continue
+            seen.add((path, replica))
+            previous = found.get(path)
+            replicas = previous.replicas + 1 if previous else 1
+            if previous and previous.modified >= int(modified):
+                found[path] = previous._replace(replicas=replicas)
+            else:
+                found[path] = StatResult(path, False, int(size), checksum or None, resource,
+                                         replicas, int(created), int(modified))
+        return found
+
+    def _stat_collections(self, paths, timeout=None):
+        def condition(paths, like):
+            if like:
+                return "COLL_NAME like '{}'".format(paths[0].replace("'", '_'))
+            return 'COLL_NAME in ({})'.format(_genquery_list(paths))
+
+        wanted = set(paths)
+        rows = self._stat_query(['COLL_NAME', 'COLL_CREATE_TIME', 'COLL_MODIFY_TIME'],
+                                condition, paths, timeout)
+        return dict((coll, StatResult(coll, True, 0, None, None, 0, int(created), int(modified)))
+                    for coll, created, modified in rows if coll in wanted)
 
-    def exists(self, name):
+    def exists(self, name, timeout=None):
         try:
-            stdout = self.session.run("ils", None, name)[0]
-            return stdout != ""
+            return self.stat(name, timeout=timeout) is not None
         except SessionException:
             return False
 
-    def listdir(self, path):
-        stdout = self.session.run("ils", None, path)[0].split("\n")
+    def listdir(self, path, timeout=None):
         listing = ([], [])
-        directory = stdout[0][0:-1]
-        directory_prefix = "  C- " + directory + "/"
-        for i in range(1, len(stdout)):
-            if stdout[i][:len(directory_prefix)] == directory_prefix:
-                dirname = stdout[i][len(directory_prefix):].strip()
-                if dirname:
-                    listing[0].append(dirname)
-            else:
-                filename = stdout[i].strip()
-                if filename:
-                    listing[1].append(filename)
+        for entry in self.iterdir(path, timeout=timeout):
+            listing[0 if entry.is_collection else 1].append(posixpath.basename(entry.path))
+        if not listing[0] and not listing[1] and not self.exists(path, timeout=timeout):
+            raise SessionException(-1, '', str.format("ERROR: {} does not exist", path))
         return listing
 
-    def size(self, name):
-        stdout = self.session.run("ils", None, "-l", name)[0].split()
-        return int(stdout[3])
+    def iterdir(self, path, marker=None, timeout=None):
+        """
+        generate StatResult for the subcollections and then the data objects directly in
+        collection path, each ordered by name, streamed from the catalog
+
+        Parameters:
+        :param
+        path: the collection name
+        marker: only generate the entries after the one with this marker, as returned by
+        listdir_page()
+        timeout: the seconds each of the two catalog queries may take
+        """
+        path = self._abspath(path)
+        timeout = self._timeout(timeout)
+        kind, _, after = marker.partition('/') if marker else ('', '', '')
+        if kind != 'd':
+            rows = self._ordered_rows(
+                ['order(COLL_NAME)', 'COLL_CREATE_TIME', 'COLL_MODIFY_TIME'],
+                'COLL_PARENT_NAME', path, 0, posixpath.join(path, after) if after else '',
+                # the root collection is its own parent
+                lambda row: row[0] != path and posixpath.dirname(row[0]) == path, timeout)
+            for coll, created, modified in rows:
+                yield StatResult(coll, True, 0, None, None, 0, int(created), int(modified))
+            after = ''
+        columns = ['COLL_NAME', 'order(DATA_NAME)'] + DATA_OBJECT_COLUMNS[2:]
+        rows = self._ordered_rows(columns, 'COLL_NAME', path, 1, after,
+                                  lambda row: row[0] == path, timeout)
+        for entry in _merge_replicas(rows):
+            yield entry
+
+    def _ordered_rows(self, columns, parent_column, parent, name_index, after, keep, timeout):
+        """
+        stream the rows where parent_column equals parent and, if after is given, the
+        column at name_index, by which the query is ordered, sorts after it
+
+        GenQuery cannot escape quotes, so a quoted parent is matched with "like" and the
+        rows are filtered exactly with keep(row); the rows up to a quoted marker are
+        skipped here rather than in the query
+        """
+        name_column = columns[name_index].replace('order(', '').rstrip(')')
+        if "'" in parent:
+            conditions = ["{} like '{}'".format(parent_column, parent.replace("'", '_'))]
+        else:
+            conditions = ["{} = '{}'".format(parent_column, parent)]
+        if after and "'" not in after:
+            conditions.append("{} > '{}'".format(name_column, after))
+        skipping = bool(after) and "'" in after
+        for row in self._iquest_stream(columns, ' and '.join(conditions), timeout=timeout):
+            if not keep(row):
+                continue
+            if skipping:
+                skipping = row[name_index] != after
+                continue
+            yield row
+
+    def listdir_page(self, path, marker=None, limit=LISTDIR_PAGE_SIZE, timeout=None):
+        """
+        list one page of collection path, reading no more of the catalog than needed
+
+        Parameters:
+        :param
+        path: the collection name
+        marker: None for the first page, then the marker returned with the previous page
+        limit: the maximum number of entries in the page
+        :return: tuple (entries, marker) where entries is a list of StatResult as generated by
+        iterdir() and marker is None when there are no further entries
+        """
+        entries = []
+        iterator = self.iterdir(path, marker=marker, timeout=timeout)
+        try:
+            for entry in iterator:
+                if len(entries) == limit:
+                    last = entries[-1]
+                    return entries, ('c/' if last.is_collection else 'd/') + \
+                        posixpath.basename(last.path)
+                entries.append(entry)
+        finally:
+            iterator.close()  # stops the running iquest
+        return entries, None
+
+    def walk(self, path, timeout=None):
+        """
+        generate StatResult for all collections and then all data objects below collection
+        path, streamed from the catalog so that memory use stays bounded whatever the size
+        of the tree; data objects come ordered by collection and name
+        """
+        path = self._abspath(path)
+        timeout = self._timeout(timeout)
+        prefix = path.rstrip('/') + '/'
+        # "_" and "%" in path act as wildcards here, so rows are filtered by prefix
+        pattern = prefix.replace("'", '_') + '%'
+        rows = self._iquest_stream(['COLL_NAME', 'COLL_CREATE_TIME', 'COLL_MODIFY_TIME'],
+                                   "COLL_NAME like '{}'".format(pattern), timeout=timeout)
+        for coll, created, modified in rows:
+            if coll.startswith(prefix):
+                yield StatResult(coll, True, 0, None, None, 0, int(created), int(modified))
+        columns = ['order(COLL_NAME)', 'order(DATA_NAME)'] + DATA_OBJECT_COLUMNS[2:]
+        in_path = "COLL_NAME {} '{}'".format('like' if "'" in path else '=',
+                                             path.replace("'", '_'))
+        below_path = "COLL_NAME like '{}'".format(pattern)
+        for condition, keep in ((in_path, lambda coll: coll == path),
+                                (below_path, lambda coll: coll.startswith(prefix))):
+            rows = self._iquest_stream(columns, condition, timeout=timeout)
+            for entry in _merge_replicas(row for row in rows if keep(row[0])):
+                yield entry
+
+    def collection_usage(self, name, recursive=True, timeout=None):
+        """
+        get the total size and number of data objects of collections, summed by the catalog
+        rather than by listing them. The data objects directly in the collections are summed
+        by one query per IQUEST_IN_LIMIT collections and, if recursive, those below each
+        collection by one query per collection
+
+        Parameters:
+        :param
+        name: the collection name, or a list of collection names
+        recursive: whether data objects in subcollections are included
+        :return: a UsageResult for a single collection name, or a dict of collection name ->
+        UsageResult for a list of names
+        """
+        if isinstance(name, basestring):
+            return self.collection_usage([name], recursive=recursive, timeout=timeout)[name]
+
+        names = list(name)
+        paths = dict((n, self._abspath(n)) for n in names)
+        columns = ['COLL_NAME', 'SUM(DATA_SIZE)', 'COUNT(DATA_ID)']
+        direct = {}
+        unique = sorted(set(paths.values()))
+        plain = [path for path in unique if "'" not in path]
+        conditions = ['COLL_NAME in ({})'.format(_genquery_list(plain[i:i + IQUEST_IN_LIMIT]))
+                      for i in range(0, len(plain), IQUEST_IN_LIMIT)]
+        # GenQuery cannot escape quotes; "_" matches them and rows are filtered by name
+        conditions.extend("COLL_NAME like '{}'".format(path.replace("'", '_'))
+                          for path in unique if "'" in path)
+        for condition in conditions:
+            for coll, size, count in self._iquest(columns, condition, timeout=timeout):
+                direct[coll] = (int(size or 0), int(count or 0))
+
+        usage = {}
+        for path in unique:
+            size, count = direct.get(path, (0, 0))
+            subcollections = {}
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                condition = "COLL_NAME like '{}%'".format(prefix.replace("'", '_'))
+                for coll, coll_size, coll_count in self._iquest(columns, condition,
+                                                                timeout=timeout):
+                    if not coll.startswith(prefix):
+                        continue
+                    child = coll[len(prefix):].split('/', 1)[0]
+                    child_size, child_count = subcollections.get(child, (0, 0))
+                    subcollections[child] = (child_size + int(coll_size or 0),
+                                             child_count + int(coll_count or 0))
+                subcollections = dict(
+                    (child, UsageResult(prefix + child, child_size, child_count, {}))
+                    for child, (child_size, child_count) in subcollections.items())
+            usage[path] = UsageResult(path, size + sum(u.size for u in subcollections.values()),
+                                      count + sum(u.count for u in subcollections.values()),
+                                      subcollections)
+        return dict((n, usage[paths[n]]) for n in names)
+
+    def fingerprint(self, name, timeout=None):
+        """
+        get a digest of the content of a data object or of the whole tree below a collection,
+        which changes whenever a data object is added, removed, renamed or rewritten. Data
+        objects count with their path relative to name, size and checksum, or modify time
+        when no checksum is registered, so that rewriting identical content keeps the
+        digest wherever checksums are kept; empty collections count by path
+
+        Parameters:
+        :param
+        name: the data object or collection name, or a list of names fingerprinted together,
+        in which names that do not exist count as absent
+        :return: the hex digest, or None if name (or every name of the list) does not exist
+        """
+        timeout = self._timeout(timeout)
+        digest = hashlib.sha256()
+
+        def add(path, *values):
+            line = '\0'.join([path] + [str(v) for v in values]) + '\n'
+            digest.update(line if isinstance(line, bytes) else line.encode('utf-8'))
+
+        if not isinstance(name, basestring):
+            parts = [(n, self.fingerprint(n, timeout=timeout)) for n in sorted(name)]
+            if all(part is None for _, part in parts):
+                return None
+            for n, part in parts:
+                add(n, part or '')
+            return digest.hexdigest()
+
+        entry = self.stat(name, timeout=timeout)
+        if entry is None:
+            return None
+
+        if not entry.is_collection:
+            add('', entry.size, entry.checksum or entry.modified)
+            return digest.hexdigest()
+        prefix = entry.path.rstrip('/') + '/'
+        collections = []
+        for entry in self.walk(name, timeout=timeout):
+            if entry.is_collection:
+                collections.append(entry.path[len(prefix):])
+            else:
+                # data objects come in a fixed order; collections do not
+                add(entry.path[len(prefix):], entry.size, entry.checksum or entry.modified)
+        for path in sorted(collections):
+            add(path + '/')
+        return digest.hexdigest()
+
+    def _stat_or_raise(self, name, timeout=None):
+        result = self.stat(name, timeout=timeout)
+        if result is None:
+            raise SessionException(-1, '', str.format("ERROR: {} does not exist", name))
+        return result
+
+    def size(self, name, timeout=None):
+        return self._stat_or_raise(name, timeout=timeout).size
+
+    def _datetime(self, timestamp, aware):
+        if aware:
+            return datetime.utcfromtimestamp(timestamp).replace(tzinfo=timezone.utc)
+        return datetime.fromtimestamp(timestamp)
+
+    def get_created_time(self, name):
+        """
+        time the data object or collection was created, aware if USE_TZ is set
+        """
+        return self._datetime(self._stat_or_raise(name).created, settings.USE_TZ)
+
+    def get_modified_time(self, name):
+        """
+        time the data object or collection was last modified, aware if USE_TZ is set
+        """
+        return self._datetime(self._stat_or_raise(name).modified, settings.USE_TZ)
+
+    def created_time(self, name):
+        return self._datetime(self._stat_or_raise(name).created, False)
+
+    def modified_time(self, name):
+        return self._datetime(self._stat_or_raise(name).modified, False)
 
     def url(self, name):
         return reverse('django_irods.views.download', kwargs={'path': name})
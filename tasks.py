@@ -204,12 +204,10 @@ class IGet(IRODSTask):
 
         options += ('-',) # we're redirecting to stdout.
 
-        proc = self.session(environment).run_safe('iget', None, path, *options)
+        stream = self.session(environment).stream('iget', path, *options, chunk_size=CHUNK_SIZE)
         tmp = tempfile.SpooledTemporaryFile()   # spool to disk if the iget is too large
-        chunk = proc.stdout.read(CHUNK_SIZE)
-        while chunk:
+        for chunk in stream:
             tmp.write(chunk)
-            chunk = proc.stdout.read(CHUNK_SIZE)
 
         tmp.flush()
         tmp.seek(0)
@@ -611,3 +609,17 @@ class Ixmsg(IRODSTask):
     name = 'django_irods.tasks.ixmsg'
 
 
+class SweepZipCache(Task):
+    """
+    Removes expired and least recently used zips from the zip cache; see zipcache.sweep().
+    Scheduled by the downloads that build zips and then by itself while zips are cached;
+    may also be run by celerybeat.
+    """
+    name = 'django_irods.tasks.sweep_zip_cache'
+
+    def run(self):
+        from .zipcache import schedule_sweep, sweep
+        removed = sweep()
+        if m.ZipCacheEntry.objects.exists():
+            schedule_sweep()
+        return removed
@@ -0,0 +1,236 @@
+"""In-memory stand-in for the parts of python-irodsclient ClientBackend uses.
+
+    server = standin.Server('u', 'pw')
+    standin.install(self, server)
+
+makes django_irods.backends use the stand-in for the rest of the test case, so that
+the native commands run against server instead of a real iRODS zone. Setting
+server.stall makes reads of data objects wait that many seconds, or until their
+connection is closed, which then fails them like a dropped connection.
+"""
+
+import posixpath
+import threading
+from datetime import datetime
+
+from django_irods import backends
+
+
+class iRODSException(Exception):
+    pass
+
+
+class CollectionDoesNotExist(iRODSException):
+    pass
+
+
+class DataObjectDoesNotExist(iRODSException):
+    pass
+
+
+class NetworkException(iRODSException):
+    pass
+
+
+class iRODSMeta(object):
+    def __init__(self, name, value, units=None):
+        self.name = name
+        self.value = value
+        self.units = units
+
+
+class kw(object):
+    FORCE_FLAG_KW = 'forceFlag'
+    DATA_TYPE_KW = 'dataType'
+    DEST_RESC_NAME_KW = 'destRescName'
+
+
+class Metadata(object):
+    def __init__(self):
+        self.avus = []
+
+    def get_all(self, name):
+        return [avu for avu in self.avus if avu.name == name]
+
+    def items(self):
+        return list(self.avus)
+
+    def add(self, avu):
+        self.avus.append(avu)
+
+    def remove(self, avu):
+        self.avus.remove(avu)
+
+
+class Server(object):
+    def __init__(self, user, password, zone='z'):
+        self.user = user
+        self.password = password
+        self.collections = {'/': Metadata(), '/' + zone: Metadata()}
+        self.data_objects = {}  # path -> [content, Metadata, modify time]
+        self.stall = None
+        self.sessions = []
+
+
+_server = None
+
+
+def install(testcase, server):
+    """Points django_irods.backends at server until testcase is done.
+    """
+    global _server
+    _server = server
+    replaced = {'iRODSSession': iRODSSession, 'iRODSException': iRODSException,
+                'CollectionDoesNotExist': CollectionDoesNotExist,
+                'DataObjectDoesNotExist': DataObjectDoesNotExist, 'iRODSMeta': iRODSMeta,
+                'kw': kw}
+    for name, value in replaced.items():
+        if name in vars(backends):
+            testcase.addCleanup(setattr, backends, name, getattr(backends, name))
+        else:
+            testcase.addCleanup(delattr, backends, name)
+        setattr(backends, name, value)
+
+
+class Reader(object):
+    def __init__(self, session, content):
+        self.session = session
+        self.content = content
+        self.pos = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        stall = self.session.server.stall
+        if stall is not None and self.session.closed.wait(stall) or self.session.closed.is_set():
+            raise NetworkException('connection closed')
+        end = len(self.content) if size < 0 else self.pos + size
+        chunk = self.content[self.pos:end]
+        self.pos += len(chunk)
+        return chunk
+
+    def seek(self, offset):
+        self.pos = offset
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Writer(object):
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        self.manager._store(self.path, ''.join(self.chunks))
+
+
+class DataObject(object):
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path
+        self.name = posixpath.basename(path)
+        content, self.metadata, self.modify_time = session.server.data_objects[path]
+        self.size = len(content)
+        self.owner_name = session.server.user
+        self.replica_number = 0
+        self.resource_name = 'r'
+
+    def open(self, mode):
+        return Reader(self.session, self.session.server.data_objects[self.path][0])
+
+
+class Collection(object):
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path
+        self.name = posixpath.basename(path)
+        self.metadata = session.server.collections[path]
+
+    @property
+    def data_objects(self):
+        return [DataObject(self.session, path)
+                for path in sorted(self.session.server.data_objects)
+                if posixpath.dirname(path) == self.path]
+
+    @property
+    def subcollections(self):
+        return [Collection(self.session, path)
+                for path in sorted(self.session.server.collections)
+                if path != '/' and posixpath.dirname(path) == self.path]
+
+
+class CollectionManager(object):
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, path):
+        self.session.check()
+        if path not in self.session.server.collections:
+            raise CollectionDoesNotExist(path)
+        return Collection(self.session, path)
+
+    def create(self, path):
+        self.get(posixpath.dirname(path))
+        self.session.server.collections.setdefault(path, Metadata())
+
+
+class DataObjectManager(object):
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, path):
+        self.session.check()
+        if path not in self.session.server.data_objects:
+            raise DataObjectDoesNotExist(path)
+        return DataObject(self.session, path)
+
+    def exists(self, path):
+        return path in self.session.server.data_objects
+
+    def _store(self, path, content):
+        self.session.collections.get(posixpath.dirname(path))
+        previous = self.session.server.data_objects.get(path)
+        self.session.server.data_objects[path] = [
+            content, previous[1] if previous else Metadata(), datetime.now()]
+
+    def put(self, local, path, **options):
+        with open(local, 'rb') as f:
+            self._store(path, f.read())
+
+    def open(self, path, mode):
+        return Writer(self, path)
+
+
+class iRODSSession(object):
+    def __init__(self, host, port, user, zone, password):
+        self.server = _server
+        self.password = password
+        self.connection_timeout = None
+        self.closed = threading.Event()
+        self.collections = CollectionManager(self)
+        self.data_objects = DataObjectManager(self)
+        self.server.sessions.append(self)
+
+    def check(self):
+        if self.closed.is_set():
+            raise NetworkException('connection closed')
+        if self.password != self.server.password:
+            raise iRODSException('CAT_INVALID_AUTHENTICATION')
+
+    @property
+    def server_version(self):
+        self.check()
+        return (4, 2, 8)
+
+    def cleanup(self):
+        self.closed.set()
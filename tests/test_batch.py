@@ -0,0 +1,82 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.test import SimpleTestCase
+
+from django_irods.batch import WriteBatch
+from django_irods.icommands import CommandResult
+from django_irods.storage import IrodsStorage, StatResult
+
+Environment = namedtuple('Environment', ['cwd'])
+
+
+class Session(object):
+    """Session recording the icommands run instead of running them.
+    """
+    def __init__(self):
+        self.commands = []
+        self.retries = []
+
+    def run(self, icommand, data, *args, **kwargs):
+        self.commands.append((icommand,) + args)
+        self.retries.append(kwargs.get('retry'))
+        return '', ''
+
+    def run_many(self, icommands, timeout=None, retry=None):
+        self.commands.extend((icommand,) + tuple(args) for icommand, args in icommands)
+        self.retries.extend(retry for _ in icommands)
+        return [CommandResult(icommand, args, 0, '', '', 0) for icommand, args in icommands]
+
+
+class RecordingStorage(IrodsStorage):
+    def __init__(self, collections=()):
+        self.session = Session()
+        self.environment = Environment('/z/home/u')
+        self.timeout = None
+        self.retry_policy = object()
+        self.collections = set(collections)
+
+    def _timeout(self, timeout):
+        return timeout
+
+    @contextmanager
+    def _modifying(self, *names, **kwargs):
+        yield
+
+    def stat(self, name, timeout=None):
+        return dict((n, StatResult(n, True, 0, None, None, 1, None, None)
+                     if n in self.collections else None) for n in name)
+
+
+class WriteBatchTest(SimpleTestCase):
+    def test_transfers_are_retried(self):
+        storage = RecordingStorage()
+        with WriteBatch(storage) as batch:
+            batch.saveFile('/tmp/a', 'c/a')
+            batch.copyFiles('c/a', 'c/b')
+        self.assertEqual([c[0] for c in storage.session.commands], ['imkdir', 'iput', 'icp'])
+        self.assertEqual(storage.session.retries, [storage.retry_policy] * 3)
+
+    def test_only_leaf_collections_are_made(self):
+        storage = RecordingStorage()
+        batch = WriteBatch(storage)
+        batch._make_collections(['/a/b', '/a/b c', '/a/b/d', '/a', '/e/', '/e/f/g'])
+        self.assertEqual(storage.session.commands,
+                         [('imkdir', '-p', '/a/b/d', '/a/b c', '/e/f/g')])
+
+    def test_moves_to_same_name_are_grouped(self):
+        storage = RecordingStorage(collections=['d/y'])
+        with WriteBatch(storage) as batch:
+            batch.moveFile('s/a', 'd/a')
+            batch.moveFile('s/b', 'd/b')
+            batch.moveFile('s/c', 'd/renamed')
+            batch.moveFile('t/x', 'd/x')
+            batch.moveFile('t/y', 'd/y')
+            batch.moveFile('t/z', 'd/z')
+        self.assertEqual(storage.session.commands[1:], [
+            ('imv', 's/a', 's/b', '/z/home/u/d'),
+            ('imv', 's/c', 'd/renamed'),
+            ('imv', 't/x', 'd/x'),
+            # moveFile puts t/y into the existing collection d/y
+            ('imv', 't/y', 'd/y'),
+            ('imv', 't/z', 'd/z')])
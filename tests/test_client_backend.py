@@ -0,0 +1,83 @@
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from django_irods.backends import ClientBackend, CommandTimeout
+from django_irods.icommands import IRodsEnv, Session, SessionException, SessionTimeoutException
+from django_irods.tests import standin
+
+HOME = '/z/home/u'
+
+
+class ClientBackendTest(SimpleTestCase):
+    def setUp(self):
+        self.server = standin.Server('u', 'pw')
+        self.server.collections.update((path, standin.Metadata())
+                                       for path in ('/z/home', HOME))
+        standin.install(self, self.server)
+        self.root = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.backend = ClientBackend()
+        self.session = Session(root=self.root, icommands_path='/nonexistent',
+                               session_id='client', backend=self.backend)
+        self.session.create_environment(IRodsEnv(
+            pk=None, host='localhost', port=1247, def_res='r', home_coll=HOME, cwd=HOME,
+            username='u', zone='z', auth='pw', irods_default_hash_scheme='MD5'))
+        self.session.run('iinit', None, 'pw')
+        self.addCleanup(self.backend.close, self.session)
+
+    def _local(self, content):
+        path = os.path.join(self.root, 'upload')
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_iput_ils_iget(self):
+        self.session.run('imkdir', None, '-p', HOME + '/c/d')
+        self.session.run('iput', None, '-f', self._local('hello'), 'c/a.txt')
+        stdout = self.session.run('ils', None, HOME + '/c')[0]
+        self.assertIn('  a.txt\n', stdout)
+        self.assertIn('  C- {}/c/d\n'.format(HOME), stdout)
+        self.assertIn(' 5 ', self.session.run('ils', None, '-l', 'c/a.txt')[0])
+        self.assertEqual(self.session.run('iget', None, 'c/a.txt', '-')[0], 'hello')
+        self.assertEqual(''.join(self.session.iget_stream(HOME + '/c/a.txt', offset=1)),
+                         'ello')
+
+    def test_missing_data_object_fails(self):
+        with self.assertRaises(SessionException):
+            self.session.run('iget', None, 'missing.txt', '-')
+
+    def test_imeta_set_replaces_value(self):
+        self.session.run('iput', None, self._local('x'), 'a.txt')
+        self.session.run('imeta', None, 'set', '-d', 'a.txt', 'bag_modified', 'true')
+        self.session.run('imeta', None, 'set', '-d', 'a.txt', 'bag_modified', 'false')
+        stdout = self.session.run('imeta', None, 'ls', '-d', 'a.txt', 'bag_modified')[0]
+        self.assertIn('value: false\n', stdout)
+        self.assertNotIn('value: true\n', stdout)
+
+    def test_wrong_password_fails_iinit(self):
+        with self.assertRaises(SessionException):
+            self.session.run('iinit', None, 'wrong')
+
+    def test_stalled_transfer_times_out(self):
+        self.session.run('iput', None, self._local('x'), 'a.txt')
+        self.server.stall = 30
+        start = time.time()
+        with self.assertRaises(SessionTimeoutException):
+            self.session.run('iget', None, 'a.txt', '-', timeout=0.2)
+        self.assertLess(time.time() - start, 5)
+        # the connection the watchdog closed is not handed out again
+        self.server.stall = None
+        self.assertEqual(self.session.run('iget', None, 'a.txt', '-', timeout=5)[0], 'x')
+
+    @override_settings(IRODS_CLIENT_MAX_CONNECTIONS=1)
+    def test_connections_per_session_are_capped(self):
+        conn = self.backend._checkout(self.session, 5)
+        with self.assertRaises(CommandTimeout):
+            self.backend._checkout(self.session, 0.1)
+        self.backend._checkin(self.session, conn)
+        self.assertIs(self.backend._checkout(self.session, 0.1), conn)
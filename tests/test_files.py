@@ -0,0 +1,67 @@
+from cStringIO import StringIO
+
+from django.test import SimpleTestCase
+
+from django_irods.files import IrodsFile
+
+
+class Stream(object):
+    def __init__(self, data, offset):
+        self.data = StringIO(data[offset:])
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+    def close(self):
+        pass
+
+
+class Session(object):
+    def __init__(self, data):
+        self.data = data
+        self.streams = 0
+
+    def iget_stream(self, path, offset=0, **kwargs):
+        self.streams += 1
+        return Stream(self.data, offset)
+
+
+class Storage(object):
+    timeout = None
+
+    def __init__(self, data):
+        self.session = Session(data)
+
+    def size(self, name):
+        return len(self.session.data)
+
+
+class IrodsFileTest(SimpleTestCase):
+    def test_seek_back_restarts_stream(self):
+        storage = Storage('0123456789')
+        f = IrodsFile(storage, 'a.txt')
+        self.assertEqual(f.read(4), '0123')
+        f.seek(2)
+        self.assertEqual(f.read(), '23456789')
+        self.assertEqual(storage.session.streams, 2)
+
+    def test_spooled_seek_back_reads_once(self):
+        storage = Storage('0123456789')
+        f = IrodsFile(storage, 'a.txt', spool_threshold=4)
+        self.assertEqual(f.read(6), '012345')
+        f.seek(1)
+        self.assertEqual(f.read(3), '123')
+        self.assertEqual(f.read(), '456789')
+        self.assertEqual(storage.session.streams, 1)
+
+    def test_reopen_reads_again(self):
+        for spool_threshold in (None, 4):
+            storage = Storage('0123456789')
+            f = IrodsFile(storage, 'a.txt', spool_threshold=spool_threshold)
+            self.assertEqual(f.read(), '0123456789')
+            self.assertEqual(f.size, 10)
+            f.close()
+            storage.session.data = 'abc'
+            f.open()
+            self.assertEqual(f.read(), 'abc')
+            self.assertEqual(f.size, 3)
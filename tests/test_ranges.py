@@ -0,0 +1,75 @@
+from cStringIO import StringIO
+
+from django.test import RequestFactory, SimpleTestCase
+from django.test.utils import override_settings
+
+from django_irods.ranges import merge_ranges, parse_range, partial_response, requested_ranges
+
+DATA = ''.join(chr(ord('a') + i % 26) for i in range(100))
+
+
+class Stream(object):
+    def __init__(self, offset):
+        self.data = StringIO(DATA[offset:])
+
+    def read(self, size=-1):
+        return self.data.read(size)
+
+    def close(self):
+        pass
+
+
+class ParseRangeTest(SimpleTestCase):
+    def test_missing_or_malformed_header_sends_whole_file(self):
+        for header in (None, '', 'bytes=', 'bytes= , ', 'items=0-1', 'bytes=a-b', 'bytes=5-2',
+                       'bytes=-', 'bytes=0-1,x'):
+            self.assertIsNone(parse_range(header, 100), header)
+
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse_range('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(parse_range('bytes=95-200', 100), [(95, 99)])
+        self.assertEqual(parse_range('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse_range('bytes=-200', 100), [(0, 99)])
+        self.assertEqual(parse_range(' Bytes = 0-1 , 5-6 ', 100), [(0, 1), (5, 6)])
+
+    def test_unsatisfiable_ranges(self):
+        self.assertEqual(parse_range('bytes=100-', 100), [])
+        self.assertEqual(parse_range('bytes=-0', 100), [])
+        self.assertEqual(parse_range('bytes=0-', 0), [])
+
+    def test_merge_ranges(self):
+        self.assertEqual(merge_ranges([(10, 20), (0, 4), (5, 6), (15, 30), (40, 41)]),
+                         [(0, 6), (10, 30), (40, 41)])
+        self.assertEqual(merge_ranges([]), [])
+
+
+class RequestedRangesTest(SimpleTestCase):
+    @override_settings(IRODS_DOWNLOAD_MAX_SKIP=50)
+    def test_far_ranges_send_whole_file_unless_seekable(self):
+        request = RequestFactory().get('/', HTTP_RANGE='bytes=0-9,60-')
+        self.assertEqual(requested_ranges(request, 100, None, None), [(0, 9), (60, 99)])
+        self.assertIsNone(requested_ranges(request, 100, None, None, seekable=False))
+        request = RequestFactory().get('/', HTTP_RANGE='bytes=40-')
+        self.assertEqual(requested_ranges(request, 100, None, None, seekable=False),
+                         [(40, 99)])
+
+
+class PartialResponseTest(SimpleTestCase):
+    def test_single_range(self):
+        response = partial_response(Stream, [(10, 19)], 100, 'text/plain', chunk_size=3)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(''.join(response.streaming_content), DATA[10:20])
+        self.assertEqual(response['Content-Length'], '10')
+
+    def test_multipart_content_length_matches_body(self):
+        response = partial_response(Stream, [(0, 4), (50, 59), (98, 99)], 100, 'text/plain',
+                                    chunk_size=4)
+        body = ''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        boundary = response['Content-Type'].split('boundary=')[1]
+        self.assertTrue(body.endswith('--{}--\r\n'.format(boundary)))
+        for first, last in ((0, 4), (50, 59), (98, 99)):
+            self.assertIn('Content-Range: bytes {}-{}/100\r\n\r\n{}\r\n'.format(
+                first, last, DATA[first:last + 1]), body)
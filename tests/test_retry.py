@@ -0,0 +1,24 @@
+from django.test import SimpleTestCase
+
+from django_irods.retry import RetryBudget, RetryPolicy
+
+
+class RetryBudgetTest(SimpleTestCase):
+    def test_shared_budget_stops_retries_once_spent(self):
+        budget = RetryBudget(capacity=2, refill_rate=0)
+        policies = [RetryPolicy(base_delay=0, retry_budget=budget) for _ in range(3)]
+        delays = [policy.next_delay(1, 1, '', 'SYS_SOCK_CONNECT_ERR', 0) for policy in policies]
+        self.assertEqual(delays[:2], [0, 0])
+        self.assertIsNone(delays[2])
+
+    def test_fatal_errors_take_no_token(self):
+        budget = RetryBudget(capacity=1, refill_rate=0)
+        policy = RetryPolicy(base_delay=0, retry_budget=budget)
+        self.assertIsNone(policy.next_delay(1, 1, '', 'CAT_NO_ACCESS_PERMISSION', 0))
+        self.assertEqual(policy.next_delay(1, 1, '', 'SYS_SOCK_CONNECT_ERR', 0), 0)
+
+    def test_budget_refills(self):
+        budget = RetryBudget(capacity=1, refill_rate=1000)
+        self.assertTrue(budget.acquire())
+        budget._updated -= 0.01
+        self.assertTrue(budget.acquire())
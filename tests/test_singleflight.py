@@ -0,0 +1,82 @@
+import threading
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from django_irods import singleflight
+
+
+class Result(object):
+    def __init__(self, task, task_id):
+        self.state = task.states.get(task_id, 'PENDING')
+        self.result = task.results.get(task_id)
+
+    def ready(self):
+        return self.state in ('SUCCESS', 'FAILURE')
+
+    def successful(self):
+        return self.state == 'SUCCESS'
+
+
+class Task(object):
+    """Celery task class whose task states are set by the test.
+    """
+    def __init__(self):
+        self.states = {}
+        self.results = {}
+
+    def AsyncResult(self, task_id):
+        return Result(self, task_id)
+
+
+class SingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.key = singleflight.flight_key('r', 'bags')
+        self.task = Task()
+        self.poll = singleflight.POLL_INTERVAL
+        singleflight.POLL_INTERVAL = 0.01
+        self.addCleanup(setattr, singleflight, 'POLL_INTERVAL', self.poll)
+
+    @override_settings(IRODS_SINGLE_FLIGHT_PENDING_TTL=1, IRODS_SINGLE_FLIGHT_TTL=60)
+    def test_lost_pending_task_expires_with_pending_ttl(self):
+        task_id, started = singleflight.start(self.key, lambda task_id: None)
+        self.assertTrue(started)
+        self.assertEqual(singleflight.in_flight(self.key, self.task), task_id)
+        # nobody reports on the task, so its key goes with the short TTL
+        self.assertIsNone(singleflight.wait(self.key, self.task, task_id))
+        self.assertIsNone(singleflight.in_flight(self.key, self.task))
+
+    @override_settings(IRODS_SINGLE_FLIGHT_PENDING_TTL=1, IRODS_SINGLE_FLIGHT_TTL=60)
+    def test_started_task_keeps_key_and_result_is_waited_for(self):
+        task_id, _ = singleflight.start(self.key, lambda task_id: None)
+        self.task.states[task_id] = 'STARTED'
+        self.assertEqual(singleflight.in_flight(self.key, self.task), task_id)
+
+        def finish():
+            self.task.results[task_id] = True
+            self.task.states[task_id] = 'SUCCESS'
+        timer = threading.Timer(1.5, finish)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertTrue(singleflight.wait(self.key, self.task, task_id))
+
+    def test_concurrent_runs_share_one_build(self):
+        builds = []
+        release = threading.Event()
+
+        def build():
+            builds.append(1)
+            release.wait(5)
+            return 'bag'
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            singleflight.run(self.key, build))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        threading.Timer(0.2, release.set).start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(builds, [1])
+        self.assertEqual(results, ['bag'] * 3)
@@ -0,0 +1,154 @@
+import posixpath
+from collections import namedtuple
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from django_irods import zipcache
+from django_irods.models import ZipCacheEntry
+from django_irods.batch import OperationResult
+from django_irods.storage import IrodsStorage, StatResult
+
+
+class CatalogStorage(IrodsStorage):
+    """IrodsStorage answering stat() and walk() from a dict of path -> StatResult.
+    """
+    def __init__(self, entries):
+        self.timeout = None
+        self.entries = entries
+
+    def stat(self, name, timeout=None):
+        return self.entries.get(name)
+
+    def walk(self, path, timeout=None):
+        prefix = path.rstrip('/') + '/'
+        below = [e for p, e in sorted(self.entries.items()) if p.startswith(prefix)]
+        return iter([e for e in below if e.is_collection] +
+                    [e for e in below if not e.is_collection])
+
+
+class SweptStorage(CatalogStorage):
+    """CatalogStorage recording the paths deleted in batches; on_stat is called when
+    the sweep reads the zips from the catalog.
+    """
+    def __init__(self, entries, on_stat=None):
+        super(SweptStorage, self).__init__(entries)
+        self.on_stat = on_stat
+        self.deleted = []
+
+    def stat(self, name, timeout=None):
+        if isinstance(name, basestring):
+            return self.entries.get(name)
+        if self.on_stat is not None:
+            self.on_stat()
+        return dict((n, self.entries.get(n)) for n in name)
+
+    def batch(self, raise_on_error=True, timeout=None):
+        return Batch(self)
+
+
+class Batch(namedtuple('Batch', ['storage'])):
+    def __enter__(self):
+        self.storage.deleted[:] = []
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def delete(self, name):
+        self.storage.deleted.append(name)
+
+    @property
+    def results(self):
+        return [OperationResult('delete', (name,), None) for name in self.storage.deleted]
+
+
+def _collection(path):
+    return StatResult(path, True, 0, None, None, 0, 1, 1)
+
+
+def _object(path, size, checksum, modified=1):
+    return StatResult(path, False, size, checksum, 'r', 1, 1, modified)
+
+
+FOLDER = 'r1/data/contents/folder'
+
+
+def _folder():
+    return dict((e.path, e) for e in [
+        _collection(FOLDER), _collection(FOLDER + '/sub'),
+        _object(FOLDER + '/a.txt', 3, 'sha2:a'), _object(FOLDER + '/sub/b.txt', 4, None, 7)])
+
+
+class ZipCacheTest(TestCase):
+    def _download(self, storage):
+        fingerprint = zipcache.fingerprint(storage, FOLDER)
+        return zipcache.get_entry('r1', '/data/contents/folder', fingerprint)
+
+    def test_unchanged_folder_reuses_entry(self):
+        storage = CatalogStorage(_folder())
+        first = self._download(storage)
+        second = self._download(storage)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(first.zip_path, second.zip_path)
+        self.assertEqual(ZipCacheEntry.objects.count(), 1)
+
+    def test_changed_folder_gets_new_entry(self):
+        entries = _folder()
+        first = self._download(CatalogStorage(entries))
+        entries[FOLDER + '/a.txt'] = _object(FOLDER + '/a.txt', 3, 'sha2:changed')
+        second = self._download(CatalogStorage(entries))
+        self.assertNotEqual(first.zip_path, second.zip_path)
+        self.assertEqual(ZipCacheEntry.objects.count(), 2)
+
+    def test_aggregation_metadata_changes_fingerprint(self):
+        name = 'r1/data/contents/logan.tif'
+        base = posixpath.splitext(name)[0]
+        entries = dict((e.path, e) for e in [
+            _object(name, 10, 'sha2:tif'), _object(base + '_meta.xml', 5, 'sha2:meta'),
+            _object(base + '_resmap.xml', 5, 'sha2:map')])
+        before = zipcache.fingerprint(CatalogStorage(entries), name, True)
+        self.assertEqual(before, zipcache.fingerprint(CatalogStorage(entries), name, True))
+        entries[base + '_meta.xml'] = _object(base + '_meta.xml', 6, 'sha2:edited')
+        self.assertNotEqual(before, zipcache.fingerprint(CatalogStorage(entries), name, True))
+        self.assertIsNone(zipcache.fingerprint(CatalogStorage({}), name, True))
+
+
+@override_settings(IRODS_ZIP_CACHE={'max_size': 0, 'grace': 60})
+class SweepTest(TestCase):
+    def _cached_zip(self, input_path, age):
+        entry = zipcache.get_entry('r1', input_path, 'f')
+        ZipCacheEntry.objects.filter(pk=entry.pk).update(
+            size=10, last_used=timezone.now() - timedelta(seconds=age))
+        return ZipCacheEntry.objects.get(pk=entry.pk)
+
+    def _sweep(self, entries, on_stat=None):
+        storage = SweptStorage(dict((e.zip_path, _object(e.zip_path, 10, None))
+                                    for e in entries), on_stat)
+        original = zipcache._storage
+        zipcache._storage = lambda federated: storage
+        try:
+            return zipcache.sweep(), storage.deleted
+        finally:
+            zipcache._storage = original
+
+    def test_removes_least_recently_used_outside_grace(self):
+        old = self._cached_zip('/old', 600)
+        recent = self._cached_zip('/recent', 10)
+        removed, deleted = self._sweep([old, recent])
+        self.assertEqual((removed, deleted), (1, [old.zip_dir]))
+        self.assertEqual(list(ZipCacheEntry.objects.all()), [recent])
+
+    def test_keeps_zip_served_during_sweep(self):
+        old = self._cached_zip('/old', 600)
+        removed, deleted = self._sweep([old], on_stat=lambda: zipcache.touch(old.zip_path))
+        self.assertEqual((removed, deleted), (0, []))
+        self.assertTrue(ZipCacheEntry.objects.filter(pk=old.pk).exists())
+
+    def test_sweep_allows_scheduling_the_next_one(self):
+        cache.set(zipcache.SWEEP_PENDING_KEY, 1, 60)
+        self._sweep([])
+        self.assertIsNone(cache.get(zipcache.SWEEP_PENDING_KEY))
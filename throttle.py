@@ -0,0 +1,155 @@
+"""Per-client limits for streaming large files out of views.download.
+
+Files above FILE_SIZE_LIMIT are only served when IRODS_LARGE_FILE_DOWNLOADS is set,
+for instance to
+
+    IRODS_LARGE_FILE_DOWNLOADS = {'block_size': 8 * 1024 * 1024,
+                                  'rate': 50 * 1024 * 1024,
+                                  'max_per_client': 2}
+
+They are then read in blocks of block_size bytes, so memory use does not depend
+on the file size. Each client may run max_per_client such downloads at a time and
+gets at most rate bytes per second across all of them. The client is the
+authenticated user, or the remote address for anonymous requests. The counters are
+kept in the Django cache named by 'cache_alias' ('default'), so they hold across
+worker processes. A download slot that is never released, e.g. because its worker
+died, expires after 'slot_timeout' seconds (3600).
+
+Downloads are still bounded by IRODS_DOWNLOAD_TIMEOUT when it is set.
+"""
+
+import time
+
+from django.conf import settings
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class DownloadSlot(object):
+    """One of the concurrent large downloads of a client, held until close().
+    """
+    def __init__(self, limiter, key):
+        self.limiter = limiter
+        self.key = key
+        self.released = False
+
+    def refresh(self):
+        self.limiter.cache.set(self.key, 1, self.limiter.slot_timeout)
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            self.limiter.cache.delete(self.key)
+
+
+class _NoSlot(object):
+    """Stands in for a DownloadSlot when concurrency is not limited.
+    """
+    def refresh(self):
+        pass
+
+    def close(self):
+        pass
+
+
+_NO_SLOT = _NoSlot()
+
+
+class ThrottledStream(object):
+    """File-like stream reading from stream at no more than the limiter's rate for the
+    client, and keeping its download slot alive while it is read.
+    """
+    def __init__(self, stream, limiter, client, slot=None):
+        self.stream = stream
+        self.limiter = limiter
+        self.client = client
+        self.slot = slot
+        self._refreshed = time.time()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.limiter.consume(self.client, len(data))
+            if self.slot is not None and \
+                    time.time() - self._refreshed > self.limiter.slot_timeout / 2:
+                self.slot.refresh()
+                self._refreshed = time.time()
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+class DownloadLimiter(object):
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, rate=None, max_per_client=2,
+                 cache_alias='default', slot_timeout=3600, prefix='django_irods:download:'):
+        """
+        :param block_size: bytes read from iRODS and written to the client at a time
+        :param rate: bytes per second a client may download in total, or None
+        :param max_per_client: concurrent downloads a client may run, or None
+        :param cache_alias: the Django cache keeping the counters
+        :param slot_timeout: seconds after which an unreleased slot expires
+        """
+        from django.core.cache import caches
+        self.block_size = block_size
+        self.rate = rate
+        self.max_per_client = max_per_client
+        self.cache = caches[cache_alias]
+        self.slot_timeout = slot_timeout
+        self.prefix = prefix
+
+    def acquire(self, client):
+        """Returns a DownloadSlot for the client, or None if all its slots are taken.
+        """
+        if self.max_per_client is None:
+            return _NO_SLOT
+        for i in range(self.max_per_client):
+            key = '{}slot:{}:{}'.format(self.prefix, client, i)
+            # add() only succeeds for a key not already set, also across processes
+            if self.cache.add(key, 1, self.slot_timeout):
+                return DownloadSlot(self, key)
+        return None
+
+    def consume(self, client, nbytes):
+        """Accounts nbytes sent to the client and sleeps until sending them keeps the
+        client within its rate. Bytes are counted per second-long window.
+        """
+        if not self.rate:
+            return
+        while True:
+            now = time.time()
+            key = '{}rate:{}:{}'.format(self.prefix, client, int(now))
+            self.cache.add(key, 0, 2)
+            try:
+                used = self.cache.incr(key, nbytes)
+            except ValueError:
+                used = nbytes  # expired between add() and incr()
+            if used <= self.rate or used == nbytes:
+                # a block larger than the rate still goes out, one per window
+                return
+            # the window is full: take the block back and try again in the next one
+            try:
+                self.cache.decr(key, nbytes)
+            except ValueError:
+                pass
+            time.sleep(int(now) + 1 - now)
+
+    def stream(self, stream, client, slot=None):
+        return ThrottledStream(stream, self, client, slot)
+
+
+def client_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return 'user:{}'.format(user.pk)
+    return 'addr:{}'.format(request.META.get('REMOTE_ADDR', ''))
+
+
+def get_download_limiter():
+    """Returns the DownloadLimiter configured by IRODS_LARGE_FILE_DOWNLOADS, or None if
+    files above FILE_SIZE_LIMIT are not to be served.
+    """
+    options = getattr(settings, 'IRODS_LARGE_FILE_DOWNLOADS', None)
+    if not options:
+        return None
+    return DownloadLimiter(**(options if isinstance(options, dict) else {}))
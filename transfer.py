@@ -0,0 +1,156 @@
+"""Parallel, resumable copy of iRODS collections.
+
+    engine = CopyEngine(istorage, src, dest, workers=8, journal='/tmp/copy.jsonl',
+                        progress=report)
+    result = engine.run()
+
+copies collection src to dest, which becomes a copy of src as with icp -r to a
+new name. The source tree is listed with IrodsStorage.walk, the collections are
+created up front, and the data objects are copied by concurrent icp. Each copy
+registers the destination checksum, and icp verifies it when the source has one.
+
+Objects whose destination already has the same size and checksum are skipped.
+Each copied object is appended to the journal, a local file with one JSON object
+per line. Running again with the same journal after a failure or restart skips
+the objects it lists whose size still matches, so only the rest is copied.
+
+progress, if given, is called with a CopyProgress after every object.
+"""
+
+import json
+import os
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from django_irods.icommands import SessionException
+
+CopyProgress = namedtuple('CopyProgress', ['objects_done', 'objects_total', 'bytes_done',
+                                           'bytes_total', 'skipped', 'failed', 'path'])
+# result of CopyEngine.run(): failed is a list of (source path, error message)
+CopyResult = namedtuple('CopyResult', ['copied', 'skipped', 'failed', 'bytes', 'elapsed'])
+
+
+class CopyEngine(object):
+    def __init__(self, storage, src_name, dest_name, workers=None, journal=None,
+                 progress=None, ires=None, timeout=None):
+        """
+        :param storage: the IrodsStorage to copy with
+        :param workers: the number of concurrent icp, IRODS_BATCH_MAX_WORKERS by default
+        :param journal: local file name of the resumable journal, or None
+        :param progress: callable taking a CopyProgress, or None
+        :param ires: the resource to copy to, or None for the default
+        :param timeout: the seconds each icommand may take
+        """
+        self.storage = storage
+        self.src = storage._abspath(src_name)
+        self.dest = storage._abspath(dest_name)
+        self.workers = workers or getattr(settings, 'IRODS_BATCH_MAX_WORKERS', 4)
+        self.journal = journal
+        self.progress = progress
+        self.ires = ires
+        self.timeout = storage._timeout(timeout)
+
+    def _dest_path(self, path):
+        return self.dest + path[len(self.src):]
+
+    def _read_journal(self):
+        done = {}
+        if self.journal and os.path.exists(self.journal):
+            with open(self.journal) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    done[entry['src']] = entry['size']
+        return done
+
+    def _existing(self):
+        """Returns dest path -> (size, checksum) of the data objects already below dest.
+        """
+        existing = {}
+        if self.storage.exists(self.dest, timeout=self.timeout):
+            for entry in self.storage.walk(self.dest, timeout=self.timeout):
+                if not entry.is_collection:
+                    existing[entry.path] = (entry.size, entry.checksum)
+        return existing
+
+    def _copy(self, entry):
+        args = ['-f', '-K' if entry.checksum else '-k']
+        if self.ires:
+            args += ['-R', self.ires]
+        try:
+            args += [entry.path, self._dest_path(entry.path)]
+            self.storage.session.run("icp", None, *args, timeout=self.timeout,
+                                     retry=self.storage.retry_policy)
+        except SessionException as ex:
+            return entry, ex.stderr or 'failed'
+        return entry, None
+
+    def run(self):
+        """Copies the tree and returns a CopyResult. Objects that failed to copy are
+        listed in it rather than raised, so that the other objects still get copied.
+        """
+        with self.storage._modifying(self.dest, recursive=True):
+            return self._run()
+
+    def _run(self):
+        start = time.time()
+        collections = [self.dest]
+        objects = []
+        for entry in self.storage.walk(self.src, timeout=self.timeout):
+            if entry.is_collection:
+                collections.append(self._dest_path(entry.path))
+            else:
+                objects.append(entry)
+
+        journaled = self._read_journal()
+        existing = self._existing()
+        pending = []
+        for entry in objects:
+            dest = existing.get(self._dest_path(entry.path))
+            if dest is None or dest[0] != entry.size or \
+                    journaled.get(entry.path) != entry.size and \
+                    (entry.checksum is None or dest[1] != entry.checksum):
+                pending.append(entry)
+        skipped = len(objects) - len(pending)
+
+        with self.storage.batch(timeout=self.timeout) as batch:
+            for collection in collections:
+                batch.mkdir(collection)
+
+        bytes_total = sum(entry.size for entry in objects)
+        bytes_done = bytes_total - sum(entry.size for entry in pending)
+        copied = 0
+        copied_bytes = 0
+        failed = []
+        if not pending:
+            return CopyResult(copied, skipped, failed, copied_bytes, time.time() - start)
+        journal = open(self.journal, 'a') if self.journal else None
+        pool = ThreadPool(min(self.workers, len(pending)))
+        try:
+            # results are handled here as they come, so the journal and the progress
+            # callback are only ever used from this thread
+            for entry, error in pool.imap_unordered(self._copy, pending):
+                if error is None:
+                    copied += 1
+                    copied_bytes += entry.size
+                    if journal is not None:
+                        journal.write(json.dumps({'src': entry.path, 'size': entry.size,
+                                                  'dest': self._dest_path(entry.path)}) + '\n')
+                        journal.flush()
+                else:
+                    failed.append((entry.path, error))
+                bytes_done += entry.size
+                if self.progress is not None:
+                    self.progress(CopyProgress(skipped + copied + len(failed), len(objects),
+                                               bytes_done, bytes_total, skipped, len(failed),
+                                               entry.path))
+        finally:
+            pool.terminate()
+            if journal is not None:
+                journal.close()
+        return CopyResult(copied, skipped, failed, copied_bytes, time.time() - start)
@@ -13,4 +13,6 @@ urlpatterns = patterns(
     url(r'^rest_check_task_status/(?P<task_id>[A-z0-9\-]+)$',
         'django_irods.views.rest_check_task_status',
         name='rest_check_task_status'),
+    # for scraping icommand metrics in Prometheus text format
+    url(r'^metrics/$', 'django_irods.views.metrics', name='irods_metrics'),
 )
@@ -1,8 +1,6 @@
-import datetime
 import json
 import mimetypes
 import os
-import random
 from uuid import uuid4
 
 from django.conf import settings
@@ -10,19 +8,58 @@ from django.core.exceptions import PermissionDenied
 from django.http import HttpResponse, FileResponse, HttpResponseRedirect
 from rest_framework.decorators import api_view
 
-from django_irods import icommands
-from django_irods.storage import IrodsStorage
+from django_irods import aggregations, icommands, metrics as irods_metrics, ranges, \
+    singleflight, zipcache
+from django_irods.storage import IrodsStorage, StatResult
+from django_irods.throttle import client_key, get_download_limiter
 from hs_core.hydroshare import check_resource_type
 from hs_core.hydroshare.hs_bagit import create_bag_files
 from hs_core.hydroshare.resource import FILE_SIZE_LIMIT
 from hs_core.signals import pre_download_file, pre_check_bag_flag
-from hs_core.tasks import create_bag_by_irods, create_temp_zip, delete_zip
+from hs_core.tasks import create_bag_by_irods, create_temp_zip
 from hs_core.views.utils import authorize, ACTION_TO_AUTHORIZE
 from . import models as m
-from .icommands import Session, GLOBAL_SESSION
-from hs_core.models import ResourceFile
+from .icommands import Session, SessionException, GLOBAL_SESSION
 
 
+def _not_found(path, rest_call):
+    content_msg = "file path {} does not exist in iRODS".format(path)
+    response = HttpResponse(status=404)
+    if rest_call:
+        response.content = content_msg
+    else:
+        response.content = "<h1>" + content_msg + "</h1>"
+    return response
+
+
+def _stat_file(istorage, session, path):
+    """Returns the StatResult of the file to download, or None if it does not exist.
+    Sessions other than the storage's only give the size, through ils.
+    """
+    if session is istorage.session:
+        return istorage.stat(path)
+    stdout = session.run("ils", None, "-l", path)[0].split()
+    return StatResult(path, False, int(stdout[3]), None, None, 1, None, None)
+
+
+def _content_type(path):
+    mime_type = mimetypes.guess_type(path)
+    if mime_type[0] is not None:
+        return mime_type[0]
+    return 'application-x/octet-stream'
+
+
+def _file_headers(response, path, file_stat):
+    response['Content-Disposition'] = 'attachment; filename="{name}"'.format(
+        name=path.split('/')[-1])
+    response['Accept-Ranges'] = 'bytes'
+    ranges.set_validators(response, ranges.entity_tag(file_stat), file_stat.modified)
+    return response
+
+
+# IRODS_DOWNLOAD_TIMEOUT bounds the total time the icommands of one download may take,
+# including streaming the file itself
+@icommands.deadline(getattr(settings, 'IRODS_DOWNLOAD_TIMEOUT', None))
 def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=True,
              *args, **kwargs):
     split_path_strs = path.split('/')
@@ -55,10 +92,7 @@ def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=T
             return response
 
     if res.resource_type == "CompositeResource" and not path.endswith(".zip"):
-        for f in ResourceFile.objects.filter(object_id=res.id):
-            if path == f.storage_path:
-                if f.has_logical_file and f.logical_file.is_single_file_aggregation:
-                    is_sf_agg_file = True
+        is_sf_agg_file = aggregations.is_single_file_aggregation(res.id, path)
 
     if res.resource_federation_path:
         # the resource is stored in federated zone
@@ -94,54 +128,101 @@ def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=T
     else:
         res_root = res_id
 
+    if request.method == 'HEAD' and (path.endswith('.zip') or
+                                     not (is_zip_download or is_sf_agg_file)):
+        # answered from the catalog alone: no bag or zip is built and nothing is read
+        file_stat = _stat_file(istorage, session, path)
+        if file_stat is None:
+            return _not_found(path, rest_call)
+        response = _file_headers(HttpResponse(content_type=_content_type(path)), path,
+                                 file_stat)
+        response['Content-Length'] = file_stat.size
+        return response
+
     if is_zip_download or is_sf_agg_file:
         if not path.endswith(".zip"):  # requesting folder that needs to be zipped
             input_path = path.split(res_id)[1]
-            random_hash = random.getrandbits(32)
-            daily_date = datetime.datetime.today().strftime('%Y-%m-%d')
-            random_hash_path = 'zips/{daily_date}/{res_id}/{rand_folder}'.format(
-                daily_date=daily_date, res_id=res_id,
-                rand_folder=random_hash)
-            output_path = '{random_hash_path}{path}.zip'.format(random_hash_path=random_hash_path,
-                                                                path=input_path)
 
             if res.resource_type == "CompositeResource":
                 aggregation_name = input_path[len('/data/contents/'):]
                 res.create_aggregation_xml_documents(aggregation_name=aggregation_name)
 
-            if use_async:
-                task = create_temp_zip.apply_async((res_id, input_path, output_path,
-                                                    is_sf_agg_file), countdown=3)
-                delete_zip.apply_async((random_hash_path, ),
-                                       countdown=(20 * 60))  # delete after 20 minutes
+            # zips are cached by content, so that concurrent and repeated requests for
+            # unchanged content share one build and its result. path is the URL path of
+            # the zip here, so the collection zipped is fingerprinted by its own name
+            input_name = os.path.join(res_root, input_path.lstrip('/'))
+            fingerprint = zipcache.fingerprint(istorage, input_name,
+                                               is_sf_agg_file) or uuid4().hex
+            zip_entry = zipcache.get_entry(res_id, input_path, fingerprint,
+                                           federated=bool(federated_path))
+            output_path = zip_entry.zip_path
+            key = singleflight.flight_key(res_id, input_path, fingerprint)
+            task_id = singleflight.in_flight(key, create_temp_zip)
+
+            if task_id is None and zipcache.use(istorage, zip_entry):
+                path = output_path  # built by an earlier request
+            elif use_async:
+                if task_id is None:
+                    task_id, started = singleflight.start(
+                        key, lambda task_id: create_temp_zip.apply_async(
+                            (res_id, input_path, output_path, is_sf_agg_file), countdown=3,
+                            task_id=task_id))
+                    if started:
+                        zipcache.schedule_sweep()
                 if is_sf_agg_file:
                     download_path = request.path.split(res_id)[0] + output_path
                 else:
                     download_path = request.path.split("zips")[0] + output_path
                 if rest_call:
                     return HttpResponse(json.dumps({'zip_status': 'Not ready',
-                                                    'task_id': task.task_id,
+                                                    'task_id': task_id,
                                                     'download_path': download_path}),
                                         content_type="application/json")
-                request.session['task_id'] = task.task_id
+                request.session['task_id'] = task_id
                 request.session['download_path'] = download_path
                 return HttpResponseRedirect(res.get_absolute_url())
-
-            ret_status = create_temp_zip(res_id, input_path, output_path, is_sf_agg_file)
-            delete_zip.apply_async((random_hash_path, ),
-                                   countdown=(20 * 60))  # delete after 20 minutes
-            if not ret_status:
-                content_msg = "Zip cannot be created successfully. Check log for details."
-                response = HttpResponse()
-                if rest_call:
-                    response.content = content_msg
+            else:
+                if task_id is not None:
+                    # wait for the build already running rather than zipping again
+                    ret_status = singleflight.wait(key, create_temp_zip, task_id)
                 else:
-                    response.content = "<h1>" + content_msg + "</h1>"
-                return response
+                    # built under a name of its own and moved into place once complete, so
+                    # that concurrent requests never find a partly written zip at output_path
+                    build_dir = '{zip_dir}/.build-{build}'.format(zip_dir=zip_entry.zip_dir,
+                                                                  build=uuid4().hex)
+                    build_path = '{build_dir}{path}.zip'.format(build_dir=build_dir,
+                                                                path=input_path)
+                    ret_status = create_temp_zip(res_id, input_path, build_path,
+                                                 is_sf_agg_file)
+                    try:
+                        if ret_status and not istorage.exists(output_path):
+                            istorage.moveFile(build_path, output_path)
+                    except SessionException:
+                        # a concurrent build moved its zip into place first
+                        ret_status = istorage.exists(output_path)
+                    try:
+                        istorage.delete(build_dir)
+                    except SessionException:
+                        pass  # left for the sweep, which removes zip_dir as a whole
+                    zipcache.schedule_sweep()
+                if not ret_status:
+                    content_msg = "Zip cannot be created successfully. Check log for details."
+                    response = HttpResponse()
+                    if rest_call:
+                        response.content = content_msg
+                    else:
+                        response.content = "<h1>" + content_msg + "</h1>"
+                    return response
 
-            path = output_path
+                zipcache.use(istorage, zip_entry)
+                path = output_path
+        else:
+            # keeps a cached zip from being swept while it is downloaded
+            zipcache.touch('/'.join(split_path_strs))
 
-    bag_modified = istorage.getAVU(res_root, 'bag_modified')
+    # both flags are read with a single iquest
+    avus = istorage.getAVUs(res_root, ['bag_modified', 'metadata_dirty'])
+    bag_modified = avus.get('bag_modified', (None, None))[0]
     # make sure if bag_modified is not set to true, we still recreate the bag if the
     # bag file does not exist for some reason to resolve the error to download a nonexistent
     # bag when bag_modified is false due to the flag being out-of-sync with the real bag status
@@ -157,7 +238,7 @@ def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=T
         if not istorage.exists(bag_full_path):
             bag_modified = 'true'
 
-    metadata_dirty = istorage.getAVU(res_root, 'metadata_dirty')
+    metadata_dirty = avus.get('metadata_dirty', (None, None))[0]
     # do on-demand bag creation
     # needs to check whether res_id collection exists before getting/setting AVU on it
     # to accommodate the case where the very same resource gets deleted by another request
@@ -167,23 +248,40 @@ def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=T
         # send signal for pre_check_bag_flag
         pre_check_bag_flag.send(sender=resource_cls, resource=res)
         if bag_modified is None or bag_modified.lower() == "true":
-            if metadata_dirty is None or metadata_dirty.lower() == 'true':
-                create_bag_files(res)
+            # requests for a stale bag share the build in flight; the bag_modified
+            # flag tells whether a finished build is still current
+            key = singleflight.flight_key(res_id, 'bags')
+            task_id = singleflight.in_flight(key, create_bag_by_irods)
             if use_async:
-                # task parameter has to be passed in as a tuple or list, hence (res_id,) is needed
-                # Note that since we are using JSON for task parameter serialization, no complex
-                # object can be passed as parameters to a celery task
-                task = create_bag_by_irods.apply_async((res_id,), countdown=3)
+                if task_id is None:
+                    def build(task_id):
+                        if metadata_dirty is None or metadata_dirty.lower() == 'true':
+                            create_bag_files(res)
+                        # task parameter has to be passed in as a tuple or list, hence
+                        # (res_id,) is needed. Note that since we are using JSON for task
+                        # parameter serialization, no complex object can be passed as
+                        # parameters to a celery task
+                        create_bag_by_irods.apply_async((res_id,), countdown=3,
+                                                        task_id=task_id)
+                    task_id, _ = singleflight.start(key, build)
                 if rest_call:
                     return HttpResponse(json.dumps({'bag_status': 'Not ready',
-                                                    'task_id': task.task_id}),
+                                                    'task_id': task_id}),
                                         content_type="application/json")
 
-                request.session['task_id'] = task.task_id
+                request.session['task_id'] = task_id
                 request.session['download_path'] = request.path
                 return HttpResponseRedirect(res.get_absolute_url())
             else:
-                ret_status = create_bag_by_irods(res_id)
+                if task_id is not None:
+                    # wait for the build already running rather than bagging again
+                    ret_status = singleflight.wait(key, create_bag_by_irods, task_id)
+                else:
+                    def build():
+                        if metadata_dirty is None or metadata_dirty.lower() == 'true':
+                            create_bag_files(res)
+                        return create_bag_by_irods(res_id)
+                    ret_status = singleflight.run(key, build)
                 if not ret_status:
                     content_msg = "Bag cannot be created successfully. Check log for details."
                     response = HttpResponse()
@@ -205,13 +303,16 @@ def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=T
                            request=request)
 
     # obtain mime_type to set content_type
-    mtype = 'application-x/octet-stream'
-    mime_type = mimetypes.guess_type(path)
-    if mime_type[0] is not None:
-        mtype = mime_type[0]
-    # retrieve file size to set up Content-Length header
-    stdout = session.run("ils", None, "-l", path)[0].split()
-    flen = int(stdout[3])
+    mtype = _content_type(path)
+    # retrieve file size to set up Content-Length header, and the validators of
+    # conditional requests
+    file_stat = _stat_file(istorage, session, path)
+    if file_stat is None:
+        return _not_found(path, rest_call)
+    flen = file_stat.size
+    etag = ranges.entity_tag(file_stat)
+    if ranges.not_modified(request, etag, file_stat.modified):
+        return ranges.not_modified_response(etag, file_stat.modified)
 
     # If this path is resource_federation_path, then the file is a local user file
     userpath = '/' + os.path.join(
@@ -244,13 +345,7 @@ def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=T
 
         # stop NGINX targets that are non-existent from hanging forever.
         if not istorage.exists(path):
-            content_msg = "file path {} does not exist in iRODS".format(path)
-            response = HttpResponse(status=404)
-            if rest_call:
-                response.content = content_msg
-            else:
-                response.content = "<h1>" + content_msg + "</h1>"
-            return response
+            return _not_found(path, rest_call)
 
         if not res.is_federated:
             # invoke X-Accel-Redirect on physical vault file in nginx
@@ -278,24 +373,63 @@ def download(request, path, rest_call=False, use_async=True, use_reverse_proxy=T
 
     # if we get here, none of the above conditions are true
     if flen <= FILE_SIZE_LIMIT:
-        options = ('-',)  # we're redirecting to stdout.
-        # this unusual way of calling works for federated or local resources
-        proc = session.run_safe('iget', None, path, *options)
-        response = FileResponse(proc.stdout, content_type=mtype)
-        response['Content-Disposition'] = 'attachment; filename="{name}"'.format(
-            name=path.split('/')[-1])
-        response['Content-Length'] = flen
-        return response
-
+        limiter = slot = None
+        block_size = ranges.RANGE_CHUNK_SIZE
     else:
-        content_msg = "File larger than 1GB cannot be downloaded directly via HTTP. " \
-                      "Please download the large file via iRODS clients."
-        response = HttpResponse(status=403)
-        if rest_call:
-            response.content = content_msg
-        else:
-            response.content = "<h1>" + content_msg + "</h1>"
-        return response
+        limiter = get_download_limiter()
+        if limiter is None:
+            content_msg = "File larger than 1GB cannot be downloaded directly via HTTP. " \
+                          "Please download the large file via iRODS clients."
+            response = HttpResponse(status=403)
+            if rest_call:
+                response.content = content_msg
+            else:
+                response.content = "<h1>" + content_msg + "</h1>"
+            return response
+        client = client_key(request)
+        slot = limiter.acquire(client)
+        if slot is None:
+            content_msg = "Too many large file downloads are running for this client. " \
+                          "Please try again once one of them has finished."
+            response = HttpResponse(status=429)
+            response['Retry-After'] = 60
+            if rest_call:
+                response.content = content_msg
+            else:
+                response.content = "<h1>" + content_msg + "</h1>"
+            return response
+        block_size = limiter.block_size
+
+    def open_stream(offset):
+        # this way of calling works for federated or local resources
+        stream = session.iget_stream(path, offset=offset)
+        if limiter is None:
+            return stream
+        return limiter.stream(stream, client, slot)
+
+    byte_ranges = ranges.requested_ranges(request, flen, etag, file_stat.modified,
+                                          seekable=session.backend.seekable)
+    if byte_ranges == []:
+        if slot is not None:
+            slot.close()
+        return ranges.unsatisfiable_response(flen)
+    if byte_ranges:
+        response = ranges.partial_response(open_stream, byte_ranges, flen, mtype,
+                                           chunk_size=block_size)
+    else:
+        try:
+            stream = open_stream(0)
+        except Exception:
+            if slot is not None:
+                slot.close()
+            raise
+        response = FileResponse(stream, content_type=mtype)
+        response.block_size = block_size
+        response['Content-Length'] = flen
+    if slot is not None:
+        # released when the server closes the response, however the transfer ended
+        response._closable_objects.append(slot)
+    return _file_headers(response, path, file_stat)
 
 
 @api_view(['GET'])
@@ -328,3 +462,23 @@ def check_task_status(request, task_id=None, *args, **kwargs):
 def rest_check_task_status(request, task_id, *args, **kwargs):
     # need to have a separate view function just for REST API call
     return check_task_status(request, task_id, *args, **kwargs)
+
+
+def metrics(request):
+    """
+    A view function exporting the icommand instrumentation in Prometheus text format.
+    Only the client addresses in IRODS_METRICS_ALLOWED_IPS may scrape it; when that is
+    not set, only staff users and scrapers on localhost may.
+    """
+    allowed_ips = getattr(settings, 'IRODS_METRICS_ALLOWED_IPS', None)
+    remote_addr = request.META.get('REMOTE_ADDR')
+    if allowed_ips is not None:
+        allowed = remote_addr in allowed_ips
+    else:
+        user = getattr(request, 'user', None)
+        allowed = remote_addr in ('127.0.0.1', '::1') or \
+            (user is not None and user.is_authenticated() and user.is_staff)
+    if not allowed:
+        raise PermissionDenied()
+    return HttpResponse(irods_metrics.REGISTRY.prometheus_text(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,171 @@
+"""Content-versioned cache of the zips built for folder and aggregation downloads.
+
+A zip is stored at a path derived from the resource, the input path and the
+fingerprint() of the input, so that a repeated download of unchanged
+content finds the zip already built. Each zip is recorded as a ZipCacheEntry
+whose last_used time is updated whenever the zip is served.
+
+Cached zips are removed by sweep(), run by the sweep_zip_cache task, rather than by
+a timer per zip. A sweep is scheduled IRODS_ZIP_CACHE['sweep_interval'] seconds
+after a build starts, unless one is already pending, and every sweep schedules the
+next one while zips remain cached; the task can also be run periodically by
+celerybeat. A sweep
+
+- refreshes the recorded sizes from the catalog and forgets zips that are gone,
+  e.g. because their build failed;
+- removes zips not used for max_age seconds;
+- removes the least recently used zips until the cached zips total at most
+  max_size bytes.
+
+Zips used within the last grace seconds are kept in any case, so that downloads in
+progress are not cut off, and so is a zip served while the sweep runs. The
+defaults are
+
+    IRODS_ZIP_CACHE = {'max_size': 20 * 1024 ** 3, 'max_age': 7 * 24 * 3600,
+                       'grace': 3600, 'sweep_interval': 20 * 60}
+"""
+
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from django_irods.models import ZipCacheEntry
+from django_irods.storage import IrodsStorage
+
+CACHE_DIR = 'zips/cache'
+
+# Django cache key present while a sweep is scheduled
+SWEEP_PENDING_KEY = 'django_irods:zipcache:sweep'
+
+DEFAULTS = {'max_size': 20 * 1024 ** 3, 'max_age': 7 * 24 * 3600, 'grace': 3600,
+            'sweep_interval': 20 * 60}
+
+
+def _options():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, 'IRODS_ZIP_CACHE', None) or {})
+    return options
+
+
+def _key(resource_id, input_path, fingerprint):
+    parts = (x if isinstance(x, bytes) else x.encode('utf-8')
+             for x in (resource_id, input_path, fingerprint))
+    return hashlib.sha256(b'\0'.join(parts)).hexdigest()
+
+
+def fingerprint(istorage, input_name, single_file_aggregation=False):
+    """Returns the IrodsStorage.fingerprint() of what create_temp_zip packs for input_name,
+    or None if it does not exist. For a single file aggregation these are the file and
+    the _meta.xml and _resmap.xml files of the aggregation, so that a metadata edit
+    gives a new zip.
+    """
+    if single_file_aggregation:
+        base = os.path.splitext(input_name)[0]
+        return istorage.fingerprint([input_name, base + '_meta.xml', base + '_resmap.xml'])
+    return istorage.fingerprint(input_name)
+
+
+def get_entry(resource_id, input_path, fingerprint, federated=False):
+    """Returns the ZipCacheEntry of the zip of input_path of the resource with the given
+    content fingerprint, recording it if there is none yet. Its zip may not be built.
+    """
+    key = _key(resource_id, input_path, fingerprint)
+    # the resource id stays the third path component, which download() reads it from
+    zip_dir = '{cache_dir}/{res_id}/{key}'.format(cache_dir=CACHE_DIR, res_id=resource_id,
+                                                  key=key[:32])
+    entry, _ = ZipCacheEntry.objects.get_or_create(
+        key=key, defaults={'resource_id': resource_id, 'input_path': input_path,
+                           'fingerprint': fingerprint, 'zip_dir': zip_dir,
+                           'zip_path': zip_dir + input_path + '.zip', 'federated': federated,
+                           'last_used': timezone.now()})
+    return entry
+
+
+def use(istorage, entry):
+    """Returns True and marks the entry as used if its zip is built, as seen through the
+    IrodsStorage istorage.
+    """
+    stat = istorage.stat(entry.zip_path)
+    if stat is None:
+        return False
+    ZipCacheEntry.objects.filter(pk=entry.pk).update(size=stat.size, last_used=timezone.now())
+    return True
+
+
+def touch(zip_path):
+    """Marks the cached zip at zip_path, as given to download(), as used.
+    """
+    ZipCacheEntry.objects.filter(zip_path=zip_path).update(last_used=timezone.now())
+
+
+def schedule_sweep():
+    """Schedules a sweep sweep_interval seconds from now unless one is already pending.
+    """
+    from django.core.cache import cache
+    from django_irods.tasks import SweepZipCache
+    interval = _options()['sweep_interval']
+    if cache.add(SWEEP_PENDING_KEY, 1, interval * 2):
+        SweepZipCache.apply_async(countdown=interval)
+
+
+def _storage(federated):
+    return IrodsStorage('federated') if federated else IrodsStorage()
+
+
+def sweep():
+    """Removes expired and least recently used zips as described above and returns the
+    number of zips removed.
+    """
+    from django.core.cache import cache
+    # the scheduled sweep is running, so the next one may be scheduled
+    cache.delete(SWEEP_PENDING_KEY)
+    options = _options()
+    now = timezone.now()
+    protected = now - timedelta(seconds=options['grace'])
+    expired = now - timedelta(seconds=options['max_age'])
+    removed = 0
+    for federated in (False, True):
+        entries = list(ZipCacheEntry.objects.filter(federated=federated).order_by('last_used'))
+        if not entries:
+            continue
+        istorage = _storage(federated)
+        found = istorage.stat([entry.zip_path for entry in entries])
+        kept = []
+        for entry in entries:
+            stat = found[entry.zip_path]
+            if stat is None:
+                if entry.last_used < protected:
+                    entry.delete()  # the build failed or the zip was removed elsewhere
+                continue
+            if stat.size != entry.size:
+                entry.size = stat.size
+                entry.save(update_fields=['size'])
+            kept.append(entry)
+
+        total = sum(entry.size for entry in kept)
+        evicted = []
+        for entry in kept:  # least recently used first
+            if entry.last_used >= protected:
+                break
+            if entry.last_used < expired or total > options['max_size']:
+                evicted.append(entry)
+                total -= entry.size
+        # a zip served since its entry was read above is kept; matching the update on
+        # last_used tells in one statement whether it still has the value read
+        evicted = [entry for entry in evicted
+                   if ZipCacheEntry.objects.filter(pk=entry.pk, last_used=entry.last_used)
+                   .update(last_used=entry.last_used)]
+        if not evicted:
+            continue
+        with istorage.batch(raise_on_error=False) as batch:
+            for entry in evicted:
+                batch.delete(entry.zip_dir)
+        for entry, result in zip(evicted, batch.results):
+            # a zip that failed to be deleted stays recorded and is retried next time
+            if result.error is None:
+                entry.delete()
+                removed += 1
+    return removed